@@ -1,26 +1,58 @@
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for, flash, Response
+import time
+_startup_started = time.perf_counter()
+
+from flask import Flask, render_template, request, jsonify, session, redirect, url_for, flash, Response, g, has_request_context, stream_with_context
+from flask.sessions import SecureCookieSession, SecureCookieSessionInterface
+from itsdangerous import BadSignature
 import openai
 import os
 from dotenv import load_dotenv
 import json
 from datetime import datetime
 import csv
-import time
+import math
 import hashlib
-import ssl
-import certifi
-import urllib3
 import re
 import glob
 import uuid
 import zipfile
 import tempfile
+import threading
+import random
+import asyncio
+import queue
+import copy
+import sqlite3
+import atexit
+from collections import deque, OrderedDict
+import concurrent.futures
+from concurrent.futures import Future
 from pathlib import Path
 from functools import lru_cache
+from contextlib import asynccontextmanager
 from werkzeug.utils import secure_filename
-import numpy as np
-from sklearn.cluster import KMeans
+# numpy / scikit-learn は教員用の分析でしか使わないため、使う関数の中で読み込む（起動を速くする）
+
+
+class StartupTimer:
+    """起動処理の段階ごとの所要時間を記録する（コールドスタートの確認用）"""
+
+    def __init__(self, started):
+        self.started = started
+        self._last = started
+        self.phases = OrderedDict()
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases[phase] = round((now - self._last) * 1000, 1)
+        self._last = now
+        print(f"[STARTUP] {phase}: {self.phases[phase]}ms")
+
+    def stats(self):
+        return {'phases_ms': dict(self.phases), 'total_ms': round((self._last - self.started) * 1000, 1)}
 
+startup_timer = StartupTimer(_startup_started)
+startup_timer.mark('import')
 
 # 環境変数を読み込み
 load_dotenv()
@@ -32,11 +64,31 @@ PROMPTS_DIR = Path('prompts')
 # ストレージ設定：GCS（本番環境）またはローカルJSON（開発環境）
 USE_GCS = os.getenv('FLASK_ENV') == 'production' and os.getenv('GCP_PROJECT_ID')
 
+# 外部サービスへのHTTP接続プールの大きさ（同時に通信しうる gunicorn のスレッド数に合わせる）
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', os.getenv('GUNICORN_THREADS', '32')))
+_gcs_http_adapter = None
+
+def _gcs_http_session(storage_module):
+    """接続プールの大きさを指定した、GCS 用の認証済みセッションを作成する
+
+    既定のプール（10接続）ではスレッド数が多いと接続が捨てられ、TLSハンドシェイクがやり直しになる。
+    """
+    global _gcs_http_adapter
+    import google.auth
+    import requests
+    from google.auth.transport.requests import AuthorizedSession
+    credentials, _ = google.auth.default(scopes=storage_module.Client.SCOPE)
+    http_session = AuthorizedSession(credentials)
+    _gcs_http_adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+    http_session.mount('https://', _gcs_http_adapter)
+    return credentials, http_session
+
 if USE_GCS:
     try:
         from google.cloud import storage
         gcp_project = os.getenv('GCP_PROJECT_ID')
-        storage_client = storage.Client(project=gcp_project)
+        gcs_credentials, gcs_http_session = _gcs_http_session(storage)
+        storage_client = storage.Client(project=gcp_project, credentials=gcs_credentials, _http=gcs_http_session)
         bucket_name = os.getenv('GCS_BUCKET_NAME', 'science-buddy-logs')
         bucket = storage_client.bucket(bucket_name)
         # バケット接続確認
@@ -47,13 +99,252 @@ if USE_GCS:
         bucket = None
 else:
     bucket = None
-
-# SSL証明書の設定
-ssl_context = ssl.create_default_context(cafile=certifi.where())
+startup_timer.mark('gcs_init')
 
 app = Flask(__name__)
 app.secret_key = 'your-secret-key-here'  # 本番環境では安全なキーに変更
 
+# サーバーサイドセッション
+# 会話履歴などのセッション内容はサーバー側に保存し、Cookieには署名付きのセッションIDだけを入れる
+# SESSION_BACKEND: memory（開発用・LRU）/ sqlite（単一ノード）/ gcs（Cloud Run）
+SESSION_BACKEND = os.getenv('SESSION_BACKEND', 'gcs' if USE_GCS else 'memory')
+SESSION_SQLITE_PATH = os.getenv('SESSION_SQLITE_PATH', 'server_sessions.sqlite3')
+SESSION_MEMORY_MAX_ENTRIES = int(os.getenv('SESSION_MEMORY_MAX_ENTRIES', '2000'))
+
+class MemorySessionBackend:
+    """プロセス内のLRUセッションストア（開発用）"""
+
+    def __init__(self, max_entries=2000):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, sid, rev=None):
+        with self._lock:
+            item = self._data.get(sid)
+            if item is None:
+                return None
+            self._data.move_to_end(sid)
+            return item
+
+    def save(self, sid, payload, rev):
+        with self._lock:
+            self._data[sid] = (payload, rev)
+            self._data.move_to_end(sid)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, sid):
+        with self._lock:
+            self._data.pop(sid, None)
+
+def _connect_sqlite(path, timeout=10):
+    """WALモードでSQLiteに接続（スレッドごとに1接続を使う）"""
+    conn = sqlite3.connect(path, timeout=timeout)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+class SQLiteSessionBackend:
+    """SQLiteファイルに保存するセッションストア（単一ノード用）"""
+
+    def __init__(self, path, max_age_seconds):
+        self.path = path
+        self.max_age_seconds = max_age_seconds
+        self._local = threading.local()
+        self._save_count = 0
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS server_sessions ("
+            "sid TEXT PRIMARY KEY, payload TEXT NOT NULL, rev INTEGER NOT NULL, updated_at REAL NOT NULL)"
+        )
+        conn.commit()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = _connect_sqlite(self.path)
+            self._local.conn = conn
+        return conn
+
+    def load(self, sid, rev=None):
+        row = self._conn().execute(
+            "SELECT payload, rev FROM server_sessions WHERE sid = ? AND updated_at > ?",
+            (sid, time.time() - self.max_age_seconds)
+        ).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def save(self, sid, payload, rev):
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO server_sessions (sid, payload, rev, updated_at) VALUES (?, ?, ?, ?)",
+            (sid, payload, rev, time.time())
+        )
+        self._save_count += 1
+        if self._save_count % 500 == 0:
+            # 期限切れセッションを定期的に削除
+            conn.execute("DELETE FROM server_sessions WHERE updated_at <= ?",
+                         (time.time() - self.max_age_seconds,))
+        conn.commit()
+
+    def delete(self, sid):
+        conn = self._conn()
+        conn.execute("DELETE FROM server_sessions WHERE sid = ?", (sid,))
+        conn.commit()
+
+class GCSSessionBackend:
+    """GCSに保存するセッションストア（Cloud Run用）
+
+    インスタンス内にリビジョン付きのキャッシュを持ち、Cookieのリビジョン以上であれば
+    GCSを読みに行かない（ストリーミング中の保存で Cookie より新しいリビジョンを保存している場合があるため）。
+    別インスタンスで更新された場合はリビジョンが変わるため再取得する。
+    古いセッションはバケットのライフサイクルルールで削除する想定。
+    """
+
+    def __init__(self, gcs_bucket, prefix='server_sessions/', cache_entries=2000):
+        self.bucket = gcs_bucket
+        self.prefix = prefix
+        self.cache = MemorySessionBackend(max_entries=cache_entries)
+
+    def _blob(self, sid):
+        return self.bucket.blob(f"{self.prefix}{sid}.json")
+
+    def load(self, sid, rev=None):
+        cached = self.cache.load(sid)
+        if cached is not None and rev is not None and cached[1] >= rev:
+            return cached
+        try:
+            blob = self._blob(sid)
+            record = json.loads(blob.download_as_bytes().decode('utf-8'))
+        except Exception:
+            return None
+        item = (record['payload'], record['rev'])
+        self.cache.save(sid, *item)
+        return item
+
+    def save(self, sid, payload, rev):
+        self._blob(sid).upload_from_string(
+            json.dumps({'payload': payload, 'rev': rev}, ensure_ascii=False),
+            content_type='application/json'
+        )
+        self.cache.save(sid, payload, rev)
+
+    def delete(self, sid):
+        self.cache.delete(sid)
+        try:
+            self._blob(sid).delete()
+        except Exception:
+            pass
+
+class ServerSideSession(SecureCookieSession):
+    def __init__(self, initial=None, sid=None, rev=0, new=False):
+        super().__init__(initial)
+        self.sid = sid or uuid.uuid4().hex
+        self.rev = rev
+        self.new = new
+
+class ServerSideSessionInterface(SecureCookieSessionInterface):
+    """セッション本体をバックエンドに保存し、Cookieには {sid, rev} だけを署名して入れる"""
+
+    session_class = ServerSideSession
+    salt = 'server-side-session'
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def open_session(self, app, request):
+        s = self.get_signing_serializer(app)
+        if s is None:
+            return None
+        val = request.cookies.get(self.get_cookie_name(app))
+        if not val:
+            return self.session_class(new=True)
+        max_age = int(app.permanent_session_lifetime.total_seconds())
+        try:
+            token = s.loads(val, max_age=max_age)
+            sid, rev = token['sid'], token['rev']
+        except (BadSignature, KeyError, TypeError):
+            return self.session_class(new=True)
+        try:
+            item = self.backend.load(sid, rev)
+        except Exception as e:
+            print(f"[SESSION_STORE] Load Error - {type(e).__name__}: {str(e)}")
+            item = None
+        if item is None:
+            return self.session_class(sid=sid, new=True)
+        payload, stored_rev = item
+        return self.session_class(self.serializer.loads(payload), sid=sid, rev=stored_rev)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        secure = self.get_cookie_secure(app)
+        samesite = self.get_cookie_samesite(app)
+        httponly = self.get_cookie_httponly(app)
+
+        if session.accessed:
+            response.vary.add("Cookie")
+
+        # 空になったセッションはバックエンドからも削除
+        if not session:
+            if session.modified:
+                if not session.new:
+                    try:
+                        self.backend.delete(session.sid)
+                    except Exception as e:
+                        print(f"[SESSION_STORE] Delete Error - {type(e).__name__}: {str(e)}")
+                response.delete_cookie(name, domain=domain, path=path, secure=secure,
+                                       samesite=samesite, httponly=httponly)
+                response.vary.add("Cookie")
+            return
+
+        if not self.should_set_cookie(app, session):
+            return
+
+        if session.modified or session.new:
+            self._store(session)
+
+        expires = self.get_expiration_time(app, session)
+        val = self.get_signing_serializer(app).dumps({'sid': session.sid, 'rev': session.rev})
+        response.set_cookie(name, val, expires=expires, httponly=httponly, domain=domain,
+                            path=path, secure=secure, samesite=samesite)
+        response.vary.add("Cookie")
+
+    def _store(self, session):
+        """リビジョンを進めてバックエンドへ保存する
+
+        保存に失敗しても応答は返す（ログに残し、リビジョンは保存済みのものに戻す）。
+        """
+        session.rev += 1
+        try:
+            self.backend.save(session.sid, self.serializer.dumps(dict(session)), session.rev)
+            return True
+        except Exception as e:
+            session.rev -= 1
+            print(f"[SESSION_STORE] Save Error - {session.sid[:8]} {type(e).__name__}: {str(e)}")
+            return False
+
+    def save_session_now(self, session):
+        """レスポンス送信後（ストリーミング中など）にセッションの内容をバックエンドへ保存する
+
+        Cookie は送信済みで更新できないが、Cookie には sid しか入っていないため次回以降も同じセッションを読める。
+        保存したリビジョンは Cookie より新しくなるが、GCSSessionBackend はキャッシュのリビジョンが
+        Cookie 以上なら読み直さない。
+        """
+        self._store(session)
+
+def _create_session_backend():
+    """設定に応じてセッションバックエンドを作成"""
+    if SESSION_BACKEND == 'gcs' and USE_GCS and bucket:
+        return GCSSessionBackend(bucket)
+    if SESSION_BACKEND == 'sqlite':
+        return SQLiteSessionBackend(SESSION_SQLITE_PATH, int(app.permanent_session_lifetime.total_seconds()))
+    return MemorySessionBackend(max_entries=SESSION_MEMORY_MAX_ENTRIES)
+
+app.session_interface = ServerSideSessionInterface(_create_session_backend())
+print(f"[INIT] Session backend: {type(app.session_interface.backend).__name__}")
+
 # ファイルアップロード設定
 UPLOAD_FOLDER = 'uploads'  # 一時的なアップロード用
 ALLOWED_EXTENSIONS = {'md', 'txt'}  # Markdownとテキストファイルのみ
@@ -172,19 +463,368 @@ def require_teacher_auth(f):
     decorated_function.__name__ = f.__name__
     return decorated_function
 
+# 書き込み遅延（write-behind）キュー
+# 応答を返した後にバックグラウンドでストレージへ書き込む
+WRITE_BEHIND_ENABLED = os.getenv('WRITE_BEHIND_ENABLED', 'true').lower() == 'true'
+WRITE_BEHIND_MAX_PENDING = int(os.getenv('WRITE_BEHIND_MAX_PENDING', '1000'))
+
+class WriteBehindQueue:
+    """ストレージ書き込みをバックグラウンドスレッドで順に実行するキュー
+
+    - key を指定した書き込みは未実行のものを最新の内容で置き換える（合流）
+    - 上限を超えた場合は呼び出し元で同期的に書き込む（メモリを使い切らない）
+    - プロセス終了時に残りを書き出す
+    """
+
+    def __init__(self, max_pending=1000, name='write-behind'):
+        self.max_pending = max_pending
+        self.name = name
+        self._pending = {}  # key -> (func, args, kwargs, enqueued_at)
+        self._order = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._busy = False
+        self._seq = 0
+        self._stats = {
+            'enqueued': 0,
+            'coalesced': 0,
+            'written': 0,
+            'failed': 0,
+            'sync_fallback': 0,
+            'max_depth': 0,
+            'last_lag_ms': 0.0,
+            'max_lag_ms': 0.0,
+        }
+
+    def submit(self, func, *args, key=None, **kwargs):
+        """書き込み処理を登録する。key が同じ未実行の処理は置き換える"""
+        with self._cond:
+            if key is None:
+                self._seq += 1
+                key = ('_seq', self._seq)
+            if key in self._pending:
+                enqueued_at = self._pending[key][3]
+                self._pending[key] = (func, args, kwargs, enqueued_at)
+                self._stats['coalesced'] += 1
+                return
+            if len(self._pending) < self.max_pending:
+                self._pending[key] = (func, args, kwargs, time.time())
+                self._order.append(key)
+                self._stats['enqueued'] += 1
+                self._stats['max_depth'] = max(self._stats['max_depth'], len(self._pending))
+                self._ensure_thread()
+                self._cond.notify()
+                return
+            self._stats['sync_fallback'] += 1
+
+        # キューが満杯：呼び出し元で書き込む
+        self._run(func, args, kwargs, time.time())
+
+    def flush(self, timeout=10.0):
+        """未実行の書き込みがなくなるまで待つ"""
+        deadline = time.time() + timeout
+        with self._cond:
+            while self._pending or self._busy:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    print(f"[{self.name}] flush timeout: {len(self._pending)} pending")
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def stats(self):
+        with self._cond:
+            oldest = min((item[3] for item in self._pending.values()), default=None)
+            return dict(
+                self._stats,
+                depth=len(self._pending),
+                oldest_pending_ms=round((time.time() - oldest) * 1000, 1) if oldest else 0.0,
+            )
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._worker, name=self.name, daemon=True)
+            self._thread.start()
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._order:
+                    self._cond.wait()
+                key = self._order.popleft()
+                func, args, kwargs, enqueued_at = self._pending.pop(key)
+                self._busy = True
+            try:
+                self._run(func, args, kwargs, enqueued_at)
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+    def _run(self, func, args, kwargs, enqueued_at):
+        try:
+            func(*args, **kwargs)
+            lag_ms = (time.time() - enqueued_at) * 1000
+            with self._cond:
+                self._stats['written'] += 1
+                self._stats['last_lag_ms'] = round(lag_ms, 1)
+                self._stats['max_lag_ms'] = round(max(self._stats['max_lag_ms'], lag_ms), 1)
+        except Exception as e:
+            with self._cond:
+                self._stats['failed'] += 1
+            print(f"[{self.name}] write failed - {type(e).__name__}: {str(e)}")
+
+persistence_queue = WriteBehindQueue(max_pending=WRITE_BEHIND_MAX_PENDING, name='PERSIST_QUEUE')
+atexit.register(persistence_queue.flush)
+
+# ローカルストレージの設定
+# STORAGE_BACKEND: json（session_storage.json などのJSONファイル）/ sqlite（WALモードのSQLite）
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'json')
+STORAGE_SQLITE_PATH = os.getenv('STORAGE_SQLITE_PATH', 'science_buddy.sqlite3')
+SUMMARY_STORAGE_FILE = 'summary_storage.json'
+
+class SQLiteStorage:
+    """セッション・まとめ・学習進行状況を保存するSQLiteストレージ
+
+    (student_id, unit, stage) を主キーにしているため、1件の読み書きは索引で完結する。
+    接続はスレッドごとに持ち、WALモードで読み込みと書き込みを並行させる。
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            student_id TEXT NOT NULL,
+            unit TEXT NOT NULL,
+            stage TEXT NOT NULL,
+            timestamp TEXT,
+            conversation TEXT NOT NULL,
+            PRIMARY KEY (student_id, unit, stage)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS summaries (
+            student_id TEXT NOT NULL,
+            unit TEXT NOT NULL,
+            stage TEXT NOT NULL,
+            summary TEXT NOT NULL,
+            saved_at TEXT,
+            PRIMARY KEY (student_id, unit, stage)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS progress (
+            student_id TEXT NOT NULL,
+            unit TEXT NOT NULL,
+            data TEXT NOT NULL,
+            updated_at TEXT,
+            PRIMARY KEY (student_id, unit)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS summary_cache (
+            cache_key TEXT PRIMARY KEY,
+            summary TEXT NOT NULL,
+            created_at TEXT
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.executescript(self.SCHEMA)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = _connect_sqlite(self.path)
+            self._local.conn = conn
+        return conn
+
+    def is_empty(self):
+        conn = self._conn()
+        return not any(
+            conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone()
+            for table in ('sessions', 'summaries', 'progress')
+        )
+
+    # --- セッション ---
+    def save_session(self, session_entry):
+        with self._conn() as conn:
+            conn.execute(
+                "INSERT INTO sessions (student_id, unit, stage, timestamp, conversation) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(student_id, unit, stage) DO UPDATE SET "
+                "timestamp = excluded.timestamp, conversation = excluded.conversation",
+                (session_entry['student_id'], session_entry['unit'], session_entry['stage'],
+                 session_entry.get('timestamp'),
+                 json.dumps(session_entry.get('conversation', []), ensure_ascii=False))
+            )
+
+    def load_session(self, student_id, unit, stage):
+        row = self._conn().execute(
+            "SELECT conversation FROM sessions WHERE student_id = ? AND unit = ? AND stage = ?",
+            (student_id, unit, stage)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    # --- まとめ ---
+    def save_summary(self, student_id, unit, stage, summary_text, saved_at=None):
+        with self._conn() as conn:
+            conn.execute(
+                "INSERT INTO summaries (student_id, unit, stage, summary, saved_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(student_id, unit, stage) DO UPDATE SET "
+                "summary = excluded.summary, saved_at = excluded.saved_at",
+                (student_id, unit, stage, summary_text, saved_at or datetime.now().isoformat())
+            )
+
+    def load_summary(self, student_id, unit, stage):
+        row = self._conn().execute(
+            "SELECT summary FROM summaries WHERE student_id = ? AND unit = ? AND stage = ?",
+            (student_id, unit, stage)
+        ).fetchone()
+        return row[0] if row else None
+
+    # --- まとめの生成結果キャッシュ ---
+    def save_cached_summary(self, cache_key, summary_text):
+        with self._conn() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO summary_cache (cache_key, summary, created_at) VALUES (?, ?, ?)",
+                (cache_key, summary_text, datetime.now().isoformat())
+            )
+
+    def load_cached_summary(self, cache_key):
+        row = self._conn().execute(
+            "SELECT summary FROM summary_cache WHERE cache_key = ?", (cache_key,)
+        ).fetchone()
+        return row[0] if row else None
+
+    # --- 学習進行状況 ---
+    def save_progress(self, student_id, unit, progress):
+        with self._conn() as conn:
+            self._upsert_progress(conn, student_id, unit, progress)
+
+    def save_all_progress(self, progress_data):
+        with self._conn() as conn:
+            for student_id, units in progress_data.items():
+                if not isinstance(units, dict):
+                    continue
+                for unit, progress in units.items():
+                    self._upsert_progress(conn, student_id, unit, progress)
+
+    def _upsert_progress(self, conn, student_id, unit, progress):
+        conn.execute(
+            "INSERT INTO progress (student_id, unit, data, updated_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(student_id, unit) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+            (student_id, unit, json.dumps(progress, ensure_ascii=False), datetime.now().isoformat())
+        )
+
+    def load_progress(self, student_id, unit):
+        row = self._conn().execute(
+            "SELECT data FROM progress WHERE student_id = ? AND unit = ?",
+            (student_id, unit)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def load_progress_for_units(self, student_id, units):
+        units = list(units)
+        if not units:
+            return {}
+        placeholders = ', '.join('?' for _ in units)
+        rows = self._conn().execute(
+            f"SELECT unit, data FROM progress WHERE student_id = ? AND unit IN ({placeholders})",
+            (student_id, *units)
+        )
+        return {unit: json.loads(data) for unit, data in rows}
+
+    def load_all_progress(self):
+        progress_data = {}
+        for student_id, unit, data in self._conn().execute("SELECT student_id, unit, data FROM progress"):
+            progress_data.setdefault(student_id, {})[unit] = json.loads(data)
+        return progress_data
+
+    def has_student(self, student_id):
+        return self._conn().execute(
+            "SELECT 1 FROM progress WHERE student_id = ? LIMIT 1", (student_id,)
+        ).fetchone() is not None
+
+    def rename_student(self, old_student_id, new_student_id):
+        """旧形式の学習者ID（lab_N など）の進行状況を新しいIDへ移す"""
+        with self._conn() as conn:
+            conn.execute("UPDATE OR IGNORE progress SET student_id = ? WHERE student_id = ?",
+                         (new_student_id, old_student_id))
+            conn.execute("DELETE FROM progress WHERE student_id = ?", (old_student_id,))
+
+    # --- 移行 ---
+    def import_json_files(self, session_file, summary_file, progress_file):
+        """既存のJSONファイルを取り込む（同じキーは上書き）
+
+        Returns:
+            dict: 取り込んだ件数
+        """
+        counts = {'sessions': 0, 'summaries': 0, 'progress': 0}
+
+        sessions = _read_json_file(session_file, {})
+        for entry in sessions.values():
+            if isinstance(entry, dict) and all(k in entry for k in ('student_id', 'unit', 'stage')):
+                self.save_session(entry)
+                counts['sessions'] += 1
+
+        summaries = _read_json_file(summary_file, {})
+        for entry in summaries.values():
+            if isinstance(entry, dict) and all(k in entry for k in ('student_id', 'unit', 'stage')):
+                self.save_summary(entry['student_id'], entry['unit'], entry['stage'],
+                                  entry.get('summary', ''),
+                                  entry.get('saved_at') or entry.get('timestamp'))
+                counts['summaries'] += 1
+
+        progress_data = _read_json_file(progress_file, {})
+        self.save_all_progress(progress_data)
+        counts['progress'] = sum(len(u) for u in progress_data.values() if isinstance(u, dict))
+
+        return counts
+
+def _read_json_file(path, default):
+    if not os.path.exists(path):
+        return default
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (json.JSONDecodeError, OSError) as e:
+        print(f"[STORAGE] Could not read {path}: {e}")
+        return default
+
+def _create_sqlite_storage():
+    """STORAGE_BACKEND=sqlite の場合にストレージを作成し、初回はJSONファイルを取り込む"""
+    if STORAGE_BACKEND != 'sqlite':
+        return None
+    storage = SQLiteStorage(STORAGE_SQLITE_PATH)
+    if storage.is_empty():
+        counts = storage.import_json_files(SESSION_STORAGE_FILE, SUMMARY_STORAGE_FILE, LEARNING_PROGRESS_FILE)
+        print(f"[STORAGE] Imported JSON files into {STORAGE_SQLITE_PATH}: {counts}")
+    print(f"[INIT] Storage backend: sqlite ({STORAGE_SQLITE_PATH})")
+    return storage
+
 # セッション管理機能（ブラウザ閉鎖後の復帰対応）
 SESSION_STORAGE_FILE = 'session_storage.json'
 
-def save_session_to_db(student_id, unit, stage, conversation_data):
-    """セッションデータをデータベースに保存（GCS/ローカルハイブリッド）"""
+sqlite_storage = _create_sqlite_storage()
+startup_timer.mark('storage_init')
+
+def save_session_to_db(student_id, unit, stage, conversation_data, background=False):
+    """セッションデータをデータベースに保存（GCS/ローカルハイブリッド）
+
+    background=True の場合は書き込み遅延キューに登録し、すぐに戻る。
+    同じ student_id/unit/stage の未書き込みスナップショットは最新のものだけが書き込まれる。
+    """
     session_entry = {
         'timestamp': datetime.now().isoformat(),
         'student_id': student_id,
         'unit': unit,
         'stage': stage,  # 'prediction' or 'reflection'
-        'conversation': conversation_data
+        'conversation': list(conversation_data)
     }
-    
+
+    if background and WRITE_BEHIND_ENABLED:
+        persistence_queue.submit(_write_session_entry, session_entry,
+                                 key=('session', f"{student_id}_{unit}_{stage}"))
+    else:
+        _write_session_entry(session_entry)
+
+def _write_session_entry(session_entry):
+    """セッションエントリをローカルとGCSに書き込む"""
     # ローカルに保存（常に実施）
     _save_session_local(session_entry)
     
@@ -193,8 +833,13 @@ def save_session_to_db(student_id, unit, stage, conversation_data):
         _save_session_gcs(session_entry)
 
 def _save_session_local(session_entry):
-    """セッションをローカルファイルに保存"""
+    """セッションをローカル（SQLiteまたはJSONファイル）に保存"""
     try:
+        if sqlite_storage:
+            sqlite_storage.save_session(session_entry)
+            print(f"[SESSION_SAVE] SQLite - {session_entry['student_id']}_{session_entry['unit']}_{session_entry['stage']}")
+            return
+        
         sessions = {}
         if os.path.exists(SESSION_STORAGE_FILE):
             with open(SESSION_STORAGE_FILE, 'r', encoding='utf-8') as f:
@@ -215,7 +860,6 @@ def _save_session_local(session_entry):
 def _save_session_gcs(session_entry):
     """セッションをGCSに保存"""
     try:
-        from google.cloud import storage
         student_id = session_entry['student_id']
         unit = session_entry['unit']
         stage = session_entry['stage']
@@ -244,8 +888,12 @@ def load_session_from_db(student_id, unit, stage):
     return _load_session_local(student_id, unit, stage)
 
 def _load_session_local(student_id, unit, stage):
-    """セッションをローカルファイルから復元"""
+    """セッションをローカル（SQLiteまたはJSONファイル）から復元"""
     try:
+        if sqlite_storage:
+            conversation = sqlite_storage.load_session(student_id, unit, stage)
+            return conversation if conversation is not None else []
+        
         if not os.path.exists(SESSION_STORAGE_FILE):
             return []
         
@@ -264,8 +912,6 @@ def _load_session_local(student_id, unit, stage):
 def _load_session_gcs(student_id, unit, stage):
     """セッションをGCSから復元"""
     try:
-        from google.cloud import storage
-        
         # GCSのパス: sessions/{student_id}/{unit}/{stage}.json
         gcs_path = f"sessions/{student_id}/{unit}/{stage}.json"
         blob = bucket.blob(gcs_path)
@@ -280,13 +926,224 @@ def _load_session_gcs(student_id, unit, stage):
     
     return None
 
+# OpenAI API への接続
+# keep-alive の接続プールを使い回し、リクエストごとのTCP/TLS接続のやり直しを避ける
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', '30'))
+OPENAI_KEEPALIVE_SECONDS = float(os.getenv('OPENAI_KEEPALIVE_SECONDS', '60'))
+
+try:
+    import httpx  # openai SDK が使う HTTP クライアント
+except ImportError:
+    httpx = None
+
+class ConnectionReuseCounter:
+    """HTTP接続ごとのリクエスト数を数え、接続の再利用状況を集計する
+
+    httpx のレスポンスに付く network_stream（実際のTCP/TLS接続）で接続を見分ける。
+    """
+
+    def __init__(self, max_tracked=500):
+        self.max_tracked = max_tracked
+        self._connections = OrderedDict()
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._opened = 0
+
+    def record(self, response):
+        stream = response.extensions.get('network_stream')
+        with self._lock:
+            self._requests += 1
+            if stream is None:
+                return
+            count = self._connections.get(stream)
+            if count is None:
+                self._opened += 1
+                count = 0
+            self._connections[stream] = count + 1
+            self._connections.move_to_end(stream)
+            while len(self._connections) > self.max_tracked:
+                self._connections.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            counts = list(self._connections.values())
+            return {
+                'requests': self._requests,
+                'connections_opened': self._opened,
+                'reuse_rate': round(1 - self._opened / self._requests, 3) if self._requests else None,
+                'max_requests_per_connection': max(counts) if counts else 0
+            }
+
+openai_connections = ConnectionReuseCounter()
+openai_async_connections = ConnectionReuseCounter()
+
+def _openai_http_client(asynchronous=False):
+    """接続数の上限と keep-alive 時間を指定した httpx クライアントを作成（httpx がなければ SDK の既定を使う）"""
+    if httpx is None:
+        return None
+    if asynchronous:
+        # 同時に実行する呼び出しはゲートウェイが LLM_MAX_CONCURRENCY 件までに制限している
+        limits = httpx.Limits(max_connections=LLM_MAX_CONCURRENCY, max_keepalive_connections=LLM_MAX_CONCURRENCY,
+                              keepalive_expiry=OPENAI_KEEPALIVE_SECONDS)
+
+        async def on_response(response):
+            openai_async_connections.record(response)
+        return openai.DefaultAsyncHttpxClient(limits=limits, event_hooks={'response': [on_response]})
+    limits = httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE,
+                          keepalive_expiry=OPENAI_KEEPALIVE_SECONDS)
+    return openai.DefaultHttpxClient(limits=limits, event_hooks={'response': [openai_connections.record]})
+
 # OpenAI APIの設定
 api_key = os.getenv('OPENAI_API_KEY')
 try:
-    client = openai.OpenAI(api_key=api_key)
+    client = openai.OpenAI(api_key=api_key, http_client=_openai_http_client())
 except Exception as e:
     client = None
 
+# 非同期LLMゲートウェイ
+# モデル呼び出しは専用スレッドのイベントループで実行し、Flask のスレッドは結果を待つだけにする
+_async_client = None
+
+def _get_async_client():
+    """ゲートウェイのイベントループ内で使う非同期クライアント（初回呼び出し時に作成）"""
+    global _async_client
+    if _async_client is None:
+        # リトライは _acall_openai_with_retry で行うため、SDK自身のリトライは無効にする
+        _async_client = openai.AsyncOpenAI(api_key=api_key, max_retries=0,
+                                           http_client=_openai_http_client(asynchronous=True))
+    return _async_client
+
+class DeadlineExceeded(Exception):
+    """応答の期限までにモデルの応答が得られなかった"""
+
+class LLMGateway:
+    """OpenAI 呼び出しを専用スレッドのイベントループで実行するゲートウェイ
+
+    リトライの待機は asyncio.sleep で行うためスレッドを占有しない。
+    同時に実行するAPI呼び出しは max_concurrency 件までに制限し、超えた分はループ内で待たせる。
+    実行枠（slot）はAPIを呼ぶ間だけ持つ。レート制限の待ち・リトライの待機中は持たないので、
+    送信を待っているまとめ生成が枠を埋めて、優先度の高い対話が割り込めなくなることはない。
+    """
+
+    def __init__(self, max_concurrency=30):
+        self.max_concurrency = max_concurrency
+        self._loop = None
+        self._semaphore = None
+        self._lock = threading.Lock()
+        self._stats = {'submitted': 0, 'completed': 0, 'failed': 0, 'in_flight': 0, 'waiting': 0}
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                ready = threading.Event()
+
+                def run():
+                    asyncio.set_event_loop(loop)
+                    self._semaphore = asyncio.Semaphore(self.max_concurrency)
+                    ready.set()
+                    loop.run_forever()
+
+                threading.Thread(target=run, name='LLM_GATEWAY', daemon=True).start()
+                ready.wait()
+                self._loop = loop
+        return self._loop
+
+    async def _guarded(self, coro_fn, args, kwargs):
+        self._stats['submitted'] += 1
+        try:
+            result = await coro_fn(*args, **kwargs)
+            self._stats['completed'] += 1
+            return result
+        except BaseException:
+            self._stats['failed'] += 1
+            raise
+
+    @asynccontextmanager
+    async def slot(self):
+        """API呼び出し1回分の実行枠（ゲートウェイのイベントループ上で使う）"""
+        self._stats['waiting'] += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self._stats['waiting'] -= 1
+        self._stats['in_flight'] += 1
+        try:
+            yield
+        finally:
+            self._stats['in_flight'] -= 1
+            self._semaphore.release()
+
+    def submit(self, coro_fn, *args, **kwargs):
+        """コルーチン関数をゲートウェイで実行し、concurrent.futures.Future を返す"""
+        loop = self._ensure_loop()
+        return asyncio.run_coroutine_threadsafe(self._guarded(coro_fn, args, kwargs), loop)
+
+    def call(self, coro_fn, *args, timeout=None, **kwargs):
+        """コルーチン関数をゲートウェイで実行し、結果を待って返す"""
+        return self.submit(coro_fn, *args, **kwargs).result(timeout)
+
+    def stream(self, agen_fn, *args, first_item_timeout=None, on_abandon=None, dispatched=None, **kwargs):
+        """非同期ジェネレータをゲートウェイで実行し、出力を同期ジェネレータとして返す
+
+        first_item_timeout 秒以内に最初の出力がなければ DeadlineExceeded を送出する。
+        その際 on_abandon を渡していれば受信は続け、完了後に全文を on_abandon(text) に渡す。
+        dispatched（threading.Event）を渡すと agen_fn にも渡し、agen_fn がセットした時点
+        （APIに送信した時点）から first_item_timeout を数える。
+        """
+        if dispatched is not None:
+            kwargs['dispatched'] = dispatched
+        items = queue.Queue()
+
+        async def pump():
+            try:
+                async for item in agen_fn(*args, **kwargs):
+                    items.put(('item', item))
+                items.put(('end', None))
+            except Exception as e:
+                items.put(('error', e))
+
+        future = self.submit(pump)
+        timeout = first_item_timeout
+        abandoned = False
+        if dispatched is not None and first_item_timeout:
+            _wait_for_dispatch(future, dispatched)
+        try:
+            while True:
+                try:
+                    kind, value = items.get(timeout=timeout)
+                except queue.Empty:
+                    abandoned = True
+                    raise DeadlineExceeded()
+                timeout = None
+                if kind == 'item':
+                    yield value
+                elif kind == 'error':
+                    raise value
+                else:
+                    break
+        finally:
+            if abandoned and on_abandon:
+                def deliver(_):
+                    chunks = []
+                    while not items.empty():
+                        kind, value = items.get_nowait()
+                        if kind == 'error':
+                            return
+                        if kind == 'item':
+                            chunks.append(value)
+                    if chunks:
+                        on_abandon(''.join(chunks))
+                future.add_done_callback(deliver)
+            else:
+                # クライアントが切断した場合などは残りの受信を取りやめる
+                future.cancel()
+
+    def stats(self):
+        return dict(self._stats, max_concurrency=self.max_concurrency)
+
+llm_gateway = LLMGateway(max_concurrency=LLM_MAX_CONCURRENCY)
+
 # マークダウン記法を除去する関数
 def remove_markdown_formatting(text):
     """AIの応答からマークダウン記法を除去する"""
@@ -323,85 +1180,169 @@ def remove_markdown_formatting(text):
     return text.strip()
 
 # 学習進行状況管理機能
-def load_learning_progress():
-    """学習進行状況を読み込み（ローカル JSON のみ）"""
-    # ローカルファイルから読み込み
-    if os.path.exists(LEARNING_PROGRESS_FILE):
-        try:
-            with open(LEARNING_PROGRESS_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except (json.JSONDecodeError, Exception):
-            return {}
-    return {}
+# JSONファイル使用時はプロセス内にキャッシュし、ファイルの更新（mtime・サイズ）を検知したときだけ読み直す。
+# 更新はリクエスト終了時に1回だけ、一時ファイル + rename でまとめて書き込む。
+_progress_lock = threading.RLock()
+_progress_cache = {'stat': None, 'data': None, 'dirty': False}
 
-def save_learning_progress(progress_data):
-    """学習進行状況を保存（ローカル JSON のみ）"""
-    # ローカルファイルに保存
+def _progress_file_stat():
     try:
-        with open(LEARNING_PROGRESS_FILE, 'w', encoding='utf-8') as f:
+        st = os.stat(LEARNING_PROGRESS_FILE)
+        return (st.st_mtime_ns, st.st_size)
+    except FileNotFoundError:
+        return None
+
+def _get_cached_progress():
+    """キャッシュ済みの進行状況（共有オブジェクト）を返す。呼び出し側は _progress_lock を保持すること"""
+    stat = _progress_file_stat()
+    if _progress_cache['data'] is None or (stat != _progress_cache['stat'] and not _progress_cache['dirty']):
+        data = {}
+        if stat is not None:
+            try:
+                with open(LEARNING_PROGRESS_FILE, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except (json.JSONDecodeError, Exception):
+                data = {}
+        _progress_cache.update(stat=stat, data=data, dirty=False)
+    return _progress_cache['data']
+
+def _write_progress_file(progress_data):
+    """一時ファイルに書いてから置き換える（書き込み途中で落ちても元のファイルは壊れない）"""
+    directory = os.path.dirname(os.path.abspath(LEARNING_PROGRESS_FILE))
+    fd, tmp_path = tempfile.mkstemp(prefix='.learning_progress.', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
             json.dump(progress_data, f, ensure_ascii=False, indent=2)
-        print(f"[PROGRESS_SAVE] Local file saved successfully")
-    except Exception as e:
-        print(f"[PROGRESS_SAVE] Error: {e}")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, LEARNING_PROGRESS_FILE)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def flush_learning_progress():
+    """未保存の進行状況をファイルに書き込む"""
+    with _progress_lock:
+        if not _progress_cache['dirty']:
+            return
+        try:
+            _write_progress_file(_progress_cache['data'])
+            _progress_cache.update(stat=_progress_file_stat(), dirty=False)
+            print(f"[PROGRESS_SAVE] Local file saved successfully")
+        except Exception as e:
+            print(f"[PROGRESS_SAVE] Error: {e}")
+
+def _schedule_progress_write():
+    """キャッシュを更新済みとして記録し、リクエスト終了時に1回だけ書き込む"""
+    _progress_cache['dirty'] = True
+    if has_request_context():
+        g._progress_write_pending = True
     else:
-        # ローカルファイルに保存
+        flush_learning_progress()
+
+@app.teardown_request
+def _flush_progress_after_request(exc):
+    if g.pop('_progress_write_pending', False):
+        flush_learning_progress()
+
+def load_learning_progress():
+    """学習進行状況を読み込み（ローカル JSON または SQLite）"""
+    if sqlite_storage:
+        return sqlite_storage.load_all_progress()
+    
+    with _progress_lock:
+        return copy.deepcopy(_get_cached_progress())
+
+def save_learning_progress(progress_data):
+    """学習進行状況を保存（ローカル JSON または SQLite）"""
+    if sqlite_storage:
         try:
-            with open(LEARNING_PROGRESS_FILE, 'w', encoding='utf-8') as f:
-                json.dump(progress_data, f, ensure_ascii=False, indent=2)
-        except Exception:
-            pass
+            sqlite_storage.save_all_progress(progress_data)
+            print(f"[PROGRESS_SAVE] SQLite saved successfully")
+        except Exception as e:
+            print(f"[PROGRESS_SAVE] SQLite Error: {e}")
+        return
+    
+    with _progress_lock:
+        _progress_cache['data'] = copy.deepcopy(progress_data)
+        _progress_cache['dirty'] = True
+        flush_learning_progress()
 
-def get_student_progress(class_number, student_number, unit):
-    """特定の学習者の単元進行状況を取得"""
+def _new_unit_progress():
+    """単元の進行状況の初期値"""
+    return {
+        "current_stage": "prediction",
+        "last_access": datetime.now().isoformat(),
+        "stage_progress": {
+            "prediction": {
+                "started": False,
+                "conversation_count": 0,
+                "summary_created": False,
+                "last_message": ""
+            },
+            "experiment": {
+                "started": False,
+                "completed": False
+            },
+            "reflection": {
+                "started": False,
+                "conversation_count": 0,
+                "summary_created": False
+            }
+        },
+        "conversation_history": [],
+        "reflection_conversation_history": []
+    }
+
+def _progress_student_ids(class_number, student_number):
+    """進行状況のキーとなる学習者IDと、移行対象の旧形式IDを返す"""
     normalized_class = normalize_class_value(class_number)
     class_number = normalized_class if normalized_class is not None else class_number
     legacy_ids = []
     if class_number == '5':
         legacy_ids.append(f"lab_{student_number}")
-    student_id = f"{class_number}_{student_number}"
-    progress_data = load_learning_progress()
-    for legacy_id in legacy_ids:
-        if legacy_id in progress_data and student_id not in progress_data:
-            progress_data[student_id] = progress_data.pop(legacy_id)
-            save_learning_progress(progress_data)
-            break
-    
-    if student_id not in progress_data:
-        progress_data[student_id] = {}
-    
-    if unit not in progress_data[student_id]:
-        progress_data[student_id][unit] = {
-            "current_stage": "prediction",
-            "last_access": datetime.now().isoformat(),
-            "stage_progress": {
-                "prediction": {
-                    "started": False,
-                    "conversation_count": 0,
-                    "summary_created": False,
-                    "last_message": ""
-                },
-                "experiment": {
-                    "started": False,
-                    "completed": False
-                },
-                "reflection": {
-                    "started": False,
-                    "conversation_count": 0,
-                    "summary_created": False
-                }
-            },
-            "conversation_history": [],
-            "reflection_conversation_history": []
+    return f"{class_number}_{student_number}", legacy_ids
+
+def get_progress_for_units(class_number, student_number, units):
+    """学習者の複数単元の進行状況をまとめて取得
+
+    Returns:
+        dict: {unit: progress}（記録がない単元は初期値）
+    """
+    student_id, legacy_ids = _progress_student_ids(class_number, student_number)
+    
+    if sqlite_storage:
+        found = sqlite_storage.load_progress_for_units(student_id, units)
+        if not found:
+            for legacy_id in legacy_ids:
+                if sqlite_storage.has_student(legacy_id) and not sqlite_storage.has_student(student_id):
+                    sqlite_storage.rename_student(legacy_id, student_id)
+                    found = sqlite_storage.load_progress_for_units(student_id, units)
+                    break
+        return {unit: found.get(unit) or _new_unit_progress() for unit in units}
+    
+    with _progress_lock:
+        progress_data = _get_cached_progress()
+        for legacy_id in legacy_ids:
+            if legacy_id in progress_data and student_id not in progress_data:
+                progress_data[student_id] = progress_data.pop(legacy_id)
+                _schedule_progress_write()
+                break
+        
+        student_progress = progress_data.get(student_id, {})
+        return {
+            unit: copy.deepcopy(student_progress[unit]) if unit in student_progress else _new_unit_progress()
+            for unit in units
         }
-    
-    return progress_data[student_id][unit]
+
+def get_student_progress(class_number, student_number, unit):
+    """特定の学習者の単元進行状況を取得"""
+    return get_progress_for_units(class_number, student_number, [unit])[unit]
 
 def update_student_progress(class_number, student_number, unit, prediction_summary_created=False, reflection_summary_created=False):
     """学習者の進行状況を更新（フラグのみ保存）"""
-    normalized_class = normalize_class_value(class_number)
-    class_number = normalized_class if normalized_class is not None else class_number
-    progress_data = load_learning_progress()
-    student_id = f"{class_number}_{student_number}"
+    student_id, _ = _progress_student_ids(class_number, student_number)
     
     # 現在の進行状況を取得
     current_progress = get_student_progress(class_number, student_number, unit)
@@ -413,11 +1354,17 @@ def update_student_progress(class_number, student_number, unit, prediction_summa
         current_progress["stage_progress"]["reflection"]["summary_created"] = True
     
     # 進行状況を保存
-    if student_id not in progress_data:
-        progress_data[student_id] = {}
-    progress_data[student_id][unit] = current_progress
+    if sqlite_storage:
+        try:
+            sqlite_storage.save_progress(student_id, unit, current_progress)
+        except Exception as e:
+            print(f"[PROGRESS_SAVE] SQLite Error: {e}")
+        return current_progress
     
-    save_learning_progress(progress_data)
+    with _progress_lock:
+        progress_data = _get_cached_progress()
+        progress_data.setdefault(student_id, {})[unit] = copy.deepcopy(current_progress)
+        _schedule_progress_write()
     return current_progress
 
 
@@ -502,9 +1449,157 @@ def extract_message_from_json_response(response):
     except (json.JSONDecodeError, Exception) as e:
         return response
 
+def _temperature_for_stage(stage):
+    """stage（学習段階）に応じてtemperatureを設定
+    予想段階: より創造的な回答 (0.8)
+    考察段階: より一貫性のある回答 (0.3)
+    """
+    if stage == 'prediction':
+        return 0.8
+    elif stage == 'reflection':
+        return 0.3
+    return 0.5  # デフォルト
+
 # APIコール用のリトライ関数
-def call_openai_with_retry(prompt, max_retries=3, delay=2, unit=None, stage=None, model_override=None, enable_cache=False):
-    """OpenAI APIを呼び出し、エラー時はリトライする
+# プロンプトキャッシュの利用状況
+# OpenAI は先頭が同じ長いプロンプトを自動でキャッシュする。usage の cached_tokens で効果を確認する
+class PromptCacheStats:
+    """呼び出し種別（stage）ごとにプロンプトトークン数とキャッシュされたトークン数を集計する"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, stage, usage):
+        if usage is None:
+            return
+        prompt_tokens = getattr(usage, 'prompt_tokens', 0) or 0
+        details = getattr(usage, 'prompt_tokens_details', None)
+        cached_tokens = (getattr(details, 'cached_tokens', 0) or 0) if details else 0
+        print(f"[OPENAI] stage={stage or '-'} prompt_tokens={prompt_tokens} cached_tokens={cached_tokens}")
+        with self._lock:
+            entry = self._stats.setdefault(stage or 'other', {'calls': 0, 'prompt_tokens': 0, 'cached_tokens': 0})
+            entry['calls'] += 1
+            entry['prompt_tokens'] += prompt_tokens
+            entry['cached_tokens'] += cached_tokens
+
+    def stats(self):
+        with self._lock:
+            result = {}
+            for stage, entry in self._stats.items():
+                hit_rate = entry['cached_tokens'] / entry['prompt_tokens'] if entry['prompt_tokens'] else 0
+                result[stage] = dict(entry, cached_ratio=round(hit_rate, 3))
+            return result
+
+prompt_cache_stats = PromptCacheStats()
+
+# 呼び出し種別ごとのモデル選択
+# 種別ごとにモデル・max_tokens・応答時間の目標（p95）を決め、目標を超えている間は速いモデルに切り替える
+MODEL_ROUTES = {
+    'dialogue': {
+        'model': os.getenv('MODEL_DIALOGUE', 'gpt-4o-mini'),
+        'max_tokens': int(os.getenv('MAX_TOKENS_DIALOGUE', '600')),
+        'slo_p95_seconds': float(os.getenv('SLO_P95_DIALOGUE', '8')),
+        'timeout': 20
+    },
+    'summary': {
+        'model': os.getenv('MODEL_SUMMARY', 'gpt-4o-mini'),
+        'max_tokens': int(os.getenv('MAX_TOKENS_SUMMARY', '1000')),
+        'slo_p95_seconds': float(os.getenv('SLO_P95_SUMMARY', '20')),
+        'timeout': 40
+    },
+    'final_summary': {
+        'model': os.getenv('MODEL_FINAL_SUMMARY', 'gpt-4o-mini'),
+        'max_tokens': int(os.getenv('MAX_TOKENS_FINAL_SUMMARY', '1200')),
+        'slo_p95_seconds': float(os.getenv('SLO_P95_FINAL_SUMMARY', '25')),
+        'timeout': 40
+    },
+    'context_fold': {
+        'model': os.getenv('MODEL_SUMMARY', 'gpt-4o-mini'),
+        'max_tokens': 800,
+        'slo_p95_seconds': float(os.getenv('SLO_P95_SUMMARY', '20')),
+        'timeout': 30
+    },
+    'other': {
+        'model': 'gpt-4o-mini',
+        'max_tokens': 2000,
+        'slo_p95_seconds': 30,
+        'timeout': 30
+    },
+}
+MODEL_FALLBACK = os.getenv('MODEL_FALLBACK', 'gpt-4.1-nano')
+LATENCY_WINDOW_SECONDS = float(os.getenv('LATENCY_WINDOW_SECONDS', '300'))
+LATENCY_MIN_SAMPLES = 10
+
+class LatencyTracker:
+    """モデルごとの直近の応答時間を記録し、p95 を計算する
+
+    LATENCY_WINDOW_SECONDS より古い記録は捨てるため、代替モデルに切り替えた後も
+    時間がたてば元のモデルに戻る。
+    """
+
+    def __init__(self, window_seconds=300, min_samples=10, max_samples=500):
+        self.window_seconds = window_seconds
+        self.min_samples = min_samples
+        self._samples = {}
+        self._max_samples = max_samples
+        self._lock = threading.Lock()
+
+    def record(self, model, seconds):
+        with self._lock:
+            self._samples.setdefault(model, deque(maxlen=self._max_samples)).append((time.time(), seconds))
+
+    def _recent(self, model):
+        samples = self._samples.get(model)
+        if not samples:
+            return []
+        cutoff = time.time() - self.window_seconds
+        while samples and samples[0][0] < cutoff:
+            samples.popleft()
+        return sorted(seconds for _, seconds in samples)
+
+    def percentile(self, model, q):
+        """直近の応答時間のパーセンタイル（記録が少なければ None）"""
+        with self._lock:
+            recent = self._recent(model)
+        if len(recent) < self.min_samples:
+            return None
+        return recent[min(len(recent) - 1, int(len(recent) * q))]
+
+    def stats(self):
+        with self._lock:
+            models = {model: self._recent(model) for model in list(self._samples)}
+        return {
+            model: {
+                'samples': len(recent),
+                'p50': round(recent[len(recent) // 2], 2) if recent else None,
+                'p95': round(recent[min(len(recent) - 1, int(len(recent) * 0.95))], 2) if recent else None
+            }
+            for model, recent in models.items()
+        }
+
+model_latency = LatencyTracker(window_seconds=LATENCY_WINDOW_SECONDS, min_samples=LATENCY_MIN_SAMPLES)
+_model_routing_stats = {'calls': {}, 'fallbacks': 0}
+
+def _call_type_for_stage(stage):
+    return 'dialogue' if stage in ('prediction', 'reflection') else 'other'
+
+def route_model(call_type, model_override=None):
+    """呼び出し種別に応じて (モデル, max_tokens, タイムアウト秒) を決める"""
+    route = MODEL_ROUTES.get(call_type) or MODEL_ROUTES['other']
+    model = model_override or route['model']
+    if not model_override and MODEL_FALLBACK and MODEL_FALLBACK != model:
+        p95 = model_latency.percentile(model, 0.95)
+        if p95 is not None and p95 > route['slo_p95_seconds']:
+            _model_routing_stats['fallbacks'] += 1
+            model = MODEL_FALLBACK
+    calls = _model_routing_stats['calls'].setdefault(call_type, {})
+    calls[model] = calls.get(model, 0) + 1
+    return model, route['max_tokens'], route['timeout']
+
+def call_openai_with_retry(prompt, max_retries=3, delay=2, unit=None, stage=None, model_override=None, call_type=None,
+                           deadline_seconds=None, on_late_reply=None):
+    """OpenAI APIを呼び出し、エラー時はリトライする（LLMゲートウェイ経由）
     
     Args:
         prompt: 文字列またはメッセージリスト
@@ -512,8 +1607,11 @@ def call_openai_with_retry(prompt, max_retries=3, delay=2, unit=None, stage=None
         delay: リトライ間隔（秒）
         unit: 単元名
         stage: 学習段階
-        model_override: モデルオーバーライド
-        enable_cache: プロンプトキャッシング有効化（システムメッセージに対して有効）
+        model_override: モデルオーバーライド（指定時はモデルの自動切り替えを行わない）
+        call_type: 呼び出し種別（dialogue / summary / final_summary / context_fold、省略時は stage から判断）
+        deadline_seconds: 応答の期限（秒）。超えたら DeadlineExceeded を送出し、期限後のリトライは行わない
+            （レート制限・同時実行数の待ち行列にいる間は数えず、APIに送信した時点から数える）
+        on_late_reply: 期限を超えた呼び出しを続け、完了後に応答を渡すコールバック（省略時は打ち切る）
     """
     if client is None:
         return "AI システムの初期化に問題があります。管理者に連絡してください。"
@@ -525,71 +1623,617 @@ def call_openai_with_retry(prompt, max_retries=3, delay=2, unit=None, stage=None
         # promptが文字列の場合（従来フォーマット）
         messages = [{"role": "user", "content": prompt}]
     
-    # キャッシング有効時、システムメッセージにキャッシュ制御を追加
-    if enable_cache:
-        for msg in messages:
-            if msg.get('role') == 'system':
-                msg['cache_control'] = {'type': 'ephemeral'}
-    
-    for attempt in range(max_retries):
+    report = {}
+    dispatched = threading.Event()
+    future = llm_gateway.submit(_acall_openai_with_retry, messages, max_retries, delay, stage, model_override,
+                                *_request_rate_limit_identity(), report,
+                                call_type=call_type or _call_type_for_stage(stage),
+                                deadline_seconds=deadline_seconds, dispatched=dispatched)
+    try:
+        if deadline_seconds:
+            _wait_for_dispatch(future, dispatched)
+        return future.result(deadline_seconds)
+    except concurrent.futures.TimeoutError:
+        if on_late_reply:
+            def deliver(done_future):
+                if not done_future.cancelled() and done_future.exception() is None:
+                    result = done_future.result()
+                    if not _is_openai_error_message(result):
+                        on_late_reply(result)
+            future.add_done_callback(deliver)
+        else:
+            future.cancel()
+        raise DeadlineExceeded()
+    finally:
+        _record_queue_wait(report)
+
+def _wait_for_dispatch(future, dispatched):
+    """呼び出しがAPIに送信されるまで（その前に終わった場合は終わるまで）待つ
+
+    応答の期限は送信した時点から数える。混雑時にこちらの待ち行列で待った分で期限切れにしないため。
+    ただし DEADLINE_QUEUE_MAX_SECONDS を超えて送信されない場合は、そこから期限を数え始める。
+    """
+    future.add_done_callback(lambda _: dispatched.set())
+    if not dispatched.wait(DEADLINE_QUEUE_MAX_SECONDS):
+        print(f"[DEADLINE] Still queued after {DEADLINE_QUEUE_MAX_SECONDS}s")
+
+# OpenAI 呼び出しの障害対策（リトライ間隔・サーキットブレーカー）
+# 期限付きの呼び出しが待ち行列で待つ最大秒数（これを超えたら期限を数え始める）
+DEADLINE_QUEUE_MAX_SECONDS = float(os.getenv('DEADLINE_QUEUE_MAX_SECONDS', '60'))
+OPENAI_BACKOFF_MAX = float(os.getenv('OPENAI_BACKOFF_MAX', '20'))
+CIRCUIT_WINDOW_SIZE = int(os.getenv('CIRCUIT_WINDOW_SIZE', '20'))
+CIRCUIT_MIN_CALLS = int(os.getenv('CIRCUIT_MIN_CALLS', '5'))
+CIRCUIT_FAILURE_RATE = float(os.getenv('CIRCUIT_FAILURE_RATE', '0.5'))
+CIRCUIT_OPEN_SECONDS = float(os.getenv('CIRCUIT_OPEN_SECONDS', '30'))
+
+# ユーザーに返す定型文
+OPENAI_MESSAGE_API_KEY = "APIキーの設定に問題があります。管理者に連絡してください。"
+OPENAI_MESSAGE_RATE_LIMIT = "API利用制限に達しました。しばらく待ってから再度お試しください。"
+OPENAI_MESSAGE_NETWORK = "ネットワーク接続に問題があります。インターネット接続を確認してください。"
+OPENAI_MESSAGE_BAD_REQUEST = "リクエストの形式に問題があります。管理者に連絡してください。"
+OPENAI_MESSAGE_PERMISSION = "APIの利用権限に問題があります。管理者に連絡してください。"
+OPENAI_MESSAGE_UNAVAILABLE = "複数回の試行後もAPIに接続できませんでした。しばらく待ってから再度お試しください。"
+
+class CircuitOpenError(Exception):
+    """サーキットブレーカーが開いているため呼び出しを行わなかった"""
+
+class OpenAIStreamError(Exception):
+    """ストリーミング呼び出しが応答を返せなかった（message は児童に表示する定型文）"""
+
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+class CircuitBreaker:
+    """直近の呼び出しの失敗率が高いときにAPI呼び出しを一時停止する
+
+    closed: 通常どおり呼び出す。直近 window_size 件のうち失敗の割合が failure_rate 以上になったら open へ
+    open: open_seconds の間は呼び出さずにすぐ失敗を返す。経過後は half_open へ
+    half_open: 1件だけ試しに呼び出し、成功したら closed、失敗したら再び open へ
+    """
+
+    def __init__(self, window_size=20, min_calls=5, failure_rate=0.5, open_seconds=30):
+        self.window_size = window_size
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.open_seconds = open_seconds
+        self.state = 'closed'
+        self._results = deque(maxlen=window_size)
+        self._opened_at = 0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+        self._stats = {'opened': 0, 'half_opened': 0, 'closed': 0, 'rejected': 0}
+
+    def _transition(self, state):
+        print(f"[CIRCUIT] {self.state} -> {state}")
+        self.state = state
+        if state == 'open':
+            self._opened_at = time.time()
+            self._stats['opened'] += 1
+        elif state == 'half_open':
+            self._stats['half_opened'] += 1
+        else:
+            self._stats['closed'] += 1
+            self._results.clear()
+        self._probe_in_flight = False
+
+    def allow(self):
+        """呼び出してよいかを返す（half_open では試しの1件だけ許可）"""
+        with self._lock:
+            if self.state == 'open' and time.time() - self._opened_at >= self.open_seconds:
+                self._transition('half_open')
+            if self.state == 'closed':
+                return True
+            if self.state == 'half_open' and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            self._stats['rejected'] += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.state == 'half_open':
+                self._transition('closed')
+            else:
+                self._results.append(True)
+
+    def record_failure(self):
+        with self._lock:
+            if self.state == 'half_open':
+                self._transition('open')
+                return
+            self._results.append(False)
+            failures = self._results.count(False)
+            if (self.state == 'closed' and len(self._results) >= self.min_calls
+                    and failures / len(self._results) >= self.failure_rate):
+                self._transition('open')
+
+    def release_probe(self):
+        """成功・失敗のどちらとも数えずに試しの呼び出し枠を戻す（設定エラーや中断時）"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def stats(self):
+        with self._lock:
+            failures = self._results.count(False)
+            return dict(self._stats, state=self.state,
+                        window_calls=len(self._results), window_failures=failures)
+
+openai_circuit = CircuitBreaker(window_size=CIRCUIT_WINDOW_SIZE, min_calls=CIRCUIT_MIN_CALLS,
+                                failure_rate=CIRCUIT_FAILURE_RATE, open_seconds=CIRCUIT_OPEN_SECONDS)
+_openai_retry_stats = {'retries': 0, 'retry_after_honored': 0, 'gave_up': 0}
+
+def _retry_after_seconds(error):
+    """エラー応答の Retry-After（retry-after-ms）ヘッダーを秒で返す"""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except (TypeError, ValueError):
+        return None
+    return None
+
+def _backoff_seconds(attempt, base_delay, error=None):
+    """次のリトライまでの待ち時間（指数バックオフ＋ジッター、Retry-After があればそれに従う）"""
+    retry_after = _retry_after_seconds(error) if error is not None else None
+    if retry_after is not None:
+        _openai_retry_stats['retry_after_honored'] += 1
+        return retry_after
+    return random.uniform(0, min(OPENAI_BACKOFF_MAX, base_delay * (2 ** attempt)))
+
+def _classify_openai_error(error):
+    """例外を (リトライするか, 障害として数えるか, 最終的に返す定型文) に分類する"""
+    if isinstance(error, openai.AuthenticationError):
+        return False, False, OPENAI_MESSAGE_API_KEY
+    if isinstance(error, openai.PermissionDeniedError):
+        return False, False, OPENAI_MESSAGE_PERMISSION
+    if isinstance(error, (openai.BadRequestError, openai.UnprocessableEntityError, openai.NotFoundError)):
+        return False, False, OPENAI_MESSAGE_BAD_REQUEST
+    if isinstance(error, openai.RateLimitError):
+        # 利用枠の超過は待っても回復しない
+        quota_exceeded = getattr(error, 'code', None) == 'insufficient_quota'
+        return not quota_exceeded, True, OPENAI_MESSAGE_RATE_LIMIT
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError)):
+        return True, True, OPENAI_MESSAGE_NETWORK
+    if isinstance(error, openai.InternalServerError):
+        return True, True, OPENAI_MESSAGE_UNAVAILABLE
+    return True, True, f"予期しないエラーが発生しました: {str(error)[:100]}..."
+
+# OpenAI 呼び出しのレート制限（送信側）
+# RPM・TPM のトークンバケットで送信を平準化し、待っている呼び出しは児童ごとに順番に送る
+OPENAI_RPM_LIMIT = int(os.getenv('OPENAI_RPM_LIMIT', '500'))
+OPENAI_TPM_LIMIT = int(os.getenv('OPENAI_TPM_LIMIT', '200000'))
+RATE_LIMIT_SQLITE_PATH = os.getenv('RATE_LIMIT_SQLITE_PATH', 'rate_limit.sqlite3')
+# 共有ストアのロック待ちの上限（秒）。取れなければ少し待ってから取り直す
+RATE_LIMIT_BUSY_TIMEOUT = float(os.getenv('RATE_LIMIT_BUSY_TIMEOUT', '0.05'))
+RATE_LIMIT_BUSY_RETRY_SECONDS = float(os.getenv('RATE_LIMIT_BUSY_RETRY_SECONDS', '0.05'))
+
+# 優先度（数字が小さいほど先に送る）
+PRIORITY_INTERACTIVE = 0  # 対話（/chat, /reflect_chat）
+PRIORITY_BACKGROUND = 1   # まとめ生成など
+INTERACTIVE_ENDPOINTS = {'chat', 'chat_stream', 'reflect_chat', 'reflect_chat_stream'}
+
+class SharedTokenBucket:
+    """1分あたりのリクエスト数・トークン数のトークンバケット
+
+    残量はSQLiteに保存し、BEGIN IMMEDIATE のロックで同じホストの複数ワーカーから共有する。
+    ロック待ちでイベントループを止めないよう、SQLiteの操作は専用のスレッドで行う（try_acquire_async）。
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS buckets (
+            name TEXT PRIMARY KEY,
+            level REAL NOT NULL,
+            updated_at REAL NOT NULL
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path, limits):
+        self.path = path
+        self.limits = limits  # {'requests': 1分あたりの上限, 'tokens': 1分あたりの上限}
+        self.busy = 0  # ロックが取れなかった回数
+        self._conn = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='rate-limit')
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = _connect_sqlite(self.path, timeout=RATE_LIMIT_BUSY_TIMEOUT)
+            self._conn.executescript(self.SCHEMA)
+        return self._conn
+
+    async def try_acquire_async(self, amounts):
+        """try_acquire を専用のスレッドで実行する（イベントループから呼ぶ）"""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self.try_acquire, amounts)
+
+    async def refund_async(self, amounts):
+        """refund を専用のスレッドで実行する（イベントループから呼ぶ）"""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self.refund, amounts)
+
+    def refund(self, amounts):
+        """消費した量を戻す（送信枠を受け取った後に取り消された呼び出しの分）
+
+        Returns:
+            戻せたかどうか（ロックが取れなければ戻さない）
+        """
+        conn = self._connection()
+        now = time.time()
         try:
-            import time
-            start_time = time.time()
-            
-            # stage（学習段階）に応じてtemperatureを設定
-            # 予想段階: より創造的な回答 (0.8)
-            # 考察段階: より一貫性のある回答 (0.3)
-            if stage == 'prediction':
-                temperature = 0.8
-            elif stage == 'reflection':
-                temperature = 0.3
+            conn.execute('BEGIN IMMEDIATE')
+        except sqlite3.OperationalError as e:
+            if 'locked' not in str(e):
+                raise
+            self.busy += 1
+            return False
+        try:
+            for name, limit in self.limits.items():
+                row = conn.execute("SELECT level, updated_at FROM buckets WHERE name = ?", (name,)).fetchone()
+                if row is None:
+                    continue
+                level = min(limit, row[0] + (now - row[1]) * limit / 60.0 + min(amounts.get(name, 0), limit))
+                conn.execute("UPDATE buckets SET level = ?, updated_at = ? WHERE name = ?", (level, now, name))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return True
+
+    def try_acquire(self, amounts):
+        """amounts（{'requests': 1, 'tokens': n}）を消費する
+
+        Returns:
+            0: 消費できた / 正の数: 必要な量がたまるまでの秒数（消費はしない）
+            他のワーカーがロックを持ったままの場合も、取り直すまでの秒数を返す
+        """
+        conn = self._connection()
+        now = time.time()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+        except sqlite3.OperationalError as e:
+            if 'locked' not in str(e):
+                raise
+            self.busy += 1
+            return RATE_LIMIT_BUSY_RETRY_SECONDS
+        try:
+            levels = {}
+            wait = 0.0
+            for name, limit in self.limits.items():
+                rate = limit / 60.0
+                row = conn.execute("SELECT level, updated_at FROM buckets WHERE name = ?", (name,)).fetchone()
+                level = limit if row is None else min(limit, row[0] + (now - row[1]) * rate)
+                needed = min(amounts.get(name, 0), limit)
+                levels[name] = level - needed
+                if level < needed:
+                    wait = max(wait, (needed - level) / rate)
+            if wait == 0:
+                for name, level in levels.items():
+                    conn.execute(
+                        "INSERT OR REPLACE INTO buckets (name, level, updated_at) VALUES (?, ?, ?)",
+                        (name, level, now)
+                    )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return wait
+
+class FairRateLimiter:
+    """トークンバケットの前に置く公平キュー
+
+    優先度の高い呼び出しから送り、同じ優先度の中では児童ごとに1件ずつ順番に送るため、
+    たくさん送る児童がいても他の児童が待たされ続けることはない。
+    """
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self._queues = {}  # 優先度 -> OrderedDict(児童ID -> deque[(future, amounts)])
+        self._wakeup = None
+        self._dispatcher = None
+        self._stats = {'granted': 0, 'waited': 0, 'wait_ms_total': 0, 'wait_ms_max': 0, 'errors': 0, 'refunded': 0}
+
+    async def acquire(self, student_id, priority, tokens):
+        """送信してよくなるまで待ち、待った時間（ミリ秒）を返す"""
+        loop = asyncio.get_running_loop()
+        if self._dispatcher is None:
+            self._wakeup = asyncio.Event()
+            self._dispatcher = loop.create_task(self._dispatch())
+        future = loop.create_future()
+        amounts = {'requests': 1, 'tokens': tokens}
+        queue_for_priority = self._queues.setdefault(priority, OrderedDict())
+        queue_for_priority.setdefault(student_id, deque()).append((future, amounts))
+        self._wakeup.set()
+        start_time = time.time()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 送信枠を受け取った直後に取り消された
+                loop.create_task(self._refund(amounts))
+            raise
+        wait_ms = int((time.time() - start_time) * 1000)
+        self._stats['granted'] += 1
+        self._stats['wait_ms_total'] += wait_ms
+        self._stats['wait_ms_max'] = max(self._stats['wait_ms_max'], wait_ms)
+        if wait_ms >= 100:
+            self._stats['waited'] += 1
+        return wait_ms
+
+    async def _refund(self, amounts):
+        try:
+            if await self.bucket.refund_async(amounts):
+                self._stats['refunded'] += 1
+        except Exception as e:
+            print(f"[RATE_LIMIT] Refund error: {e}")
+
+    def _next_waiter(self):
+        """次に送る呼び出しを返す（キャンセル済みは取り除く）"""
+        for priority in sorted(self._queues):
+            students = self._queues[priority]
+            while students:
+                student_id, waiters = next(iter(students.items()))
+                while waiters and waiters[0][0].done():
+                    waiters.popleft()
+                if waiters:
+                    return priority, student_id, waiters
+                del students[student_id]
+        return None
+
+    async def _dispatch(self):
+        while True:
+            waiter = self._next_waiter()
+            if waiter is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            priority, student_id, waiters = waiter
+            future, amounts = waiters[0]
+            try:
+                wait = await self.bucket.try_acquire_async(amounts)
+            except Exception as e:
+                # 共有ストアに問題があっても呼び出しは止めない
+                print(f"[RATE_LIMIT] Bucket error: {e}")
+                self._stats['errors'] += 1
+                wait = 0
+            if wait > 0:
+                # 待っている間に優先度の高い呼び出しが来たらそちらを先に送る
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=min(wait, 1.0))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            waiters.popleft()
+            students = self._queues[priority]
+            # 送った児童は列の最後に回す
+            students.move_to_end(student_id)
+            if not waiters:
+                del students[student_id]
+            if future.done():
+                # 送信枠を取っている間に取り消された呼び出しの分は戻す
+                await self._refund(amounts)
             else:
-                temperature = 0.5  # デフォルト
-            
-            model_name = model_override if model_override else "gpt-4o-mini"
+                future.set_result(None)
 
-            response = client.chat.completions.create(
-                model=model_name,
-                messages=messages,
-                max_tokens=2000,
-                temperature=temperature,
-                timeout=30
-            )
+    def stats(self):
+        waiting = sum(len(waiters) for students in self._queues.values() for waiters in students.values())
+        granted = self._stats['granted']
+        return dict(self._stats, waiting=waiting, store_busy=self.bucket.busy,
+                    wait_ms_avg=round(self._stats['wait_ms_total'] / granted) if granted else 0,
+                    rpm_limit=self.bucket.limits['requests'], tpm_limit=self.bucket.limits['tokens'])
+
+openai_rate_limiter = FairRateLimiter(SharedTokenBucket(
+    RATE_LIMIT_SQLITE_PATH, {'requests': OPENAI_RPM_LIMIT, 'tokens': OPENAI_TPM_LIMIT}
+))
+
+def _request_rate_limit_identity():
+    """レート制限の公平キューで使う (児童ID, 優先度) をリクエストから決める"""
+    if not has_request_context():
+        return 'system', PRIORITY_BACKGROUND
+    student_id = f"{session.get('class_number')}_{session.get('student_number')}"
+    priority = PRIORITY_INTERACTIVE if request.endpoint in INTERACTIVE_ENDPOINTS else PRIORITY_BACKGROUND
+    return student_id, priority
+
+def _record_queue_wait(report):
+    """レート制限で待った時間をリクエストに記録する（X-Queue-Wait-Ms ヘッダーで返す）"""
+    if report.get('queue_wait_ms') is None or not has_request_context():
+        return
+    g.queue_wait_ms = g.get('queue_wait_ms', 0) + report['queue_wait_ms']
+
+async def _acall_openai_with_retry(messages, max_retries, delay, stage, model_override,
+                                   student_id='system', priority=PRIORITY_BACKGROUND, report=None,
+                                   call_type='other', deadline_seconds=None, dispatched=None):
+    """call_openai_with_retry の本体（ゲートウェイのイベントループ上で実行）
+
+    deadline_seconds は最初にAPIへ送信した時点から数え、dispatched（threading.Event）をその時点でセットする。
+    """
+    report = report if report is not None else {}
+    deadline = None
+    prompt_tokens = count_message_tokens(messages)
+    message = OPENAI_MESSAGE_UNAVAILABLE
+    for attempt in range(max_retries):
+        if not openai_circuit.allow():
+            # 障害中はAPIを呼ばずにすぐ返す
+            return OPENAI_MESSAGE_UNAVAILABLE
+        # リトライのたびに選び直す（遅延が続いていれば代替モデルに切り替わる）
+        model_name, max_tokens, timeout = route_model(call_type, model_override)
+        wait_ms = await openai_rate_limiter.acquire(student_id, priority, prompt_tokens + max_tokens)
+        report['queue_wait_ms'] = report.get('queue_wait_ms', 0) + wait_ms
+        start_time = time.time()
+        try:
+            temperature = _temperature_for_stage(stage)
+
+            async with llm_gateway.slot():
+                if deadline is None and deadline_seconds:
+                    deadline = time.time() + deadline_seconds
+                if dispatched is not None:
+                    dispatched.set()
+                response = await _get_async_client().chat.completions.create(
+                    model=model_name,
+                    messages=messages,
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                    timeout=timeout
+                )
+            model_latency.record(model_name, time.time() - start_time)
+            
+            prompt_cache_stats.record(stage, getattr(response, 'usage', None))
             
             if response.choices and response.choices[0].message.content:
+                openai_circuit.record_success()
                 content = response.choices[0].message.content
                 # マークダウン除去を削除（MDファイルのプロンプトに従う）
                 return content
             else:
                 raise Exception("空の応答が返されました")
                 
+        except asyncio.CancelledError:
+            # 期限切れなどで打ち切られた
+            openai_circuit.release_probe()
+            raise
         except Exception as e:
-            error_msg = str(e)
-            
-            if "API_KEY" in error_msg.upper() or "invalid_api_key" in error_msg.lower():
-                return "APIキーの設定に問題があります。管理者に連絡してください。"
-            elif "QUOTA" in error_msg.upper() or "LIMIT" in error_msg.upper() or "rate_limit_exceeded" in error_msg.lower():
-                return "API利用制限に達しました。しばらく待ってから再度お試しください。"
-            elif "TIMEOUT" in error_msg.upper() or "DNS" in error_msg.upper() or "503" in error_msg:
-                if attempt < max_retries - 1:
-                    wait_time = delay * (attempt + 1)
-                    time.sleep(wait_time)
-                    continue
-                else:
-                    return "ネットワーク接続に問題があります。インターネット接続を確認してください。"
-            elif "400" in error_msg or "INVALID" in error_msg.upper():
-                return "リクエストの形式に問題があります。管理者に連絡してください。"
-            elif "403" in error_msg or "PERMISSION" in error_msg.upper():
-                return "APIの利用権限に問題があります。管理者に連絡してください。"
+            retryable, counts_as_failure, message = _classify_openai_error(e)
+            print(f"[OPENAI] Attempt {attempt + 1}/{max_retries} ({model_name}) failed: {type(e).__name__}: {str(e)[:100]}")
+            if isinstance(e, openai.APITimeoutError):
+                # タイムアウトも遅延として数える
+                model_latency.record(model_name, time.time() - start_time)
+            if counts_as_failure:
+                openai_circuit.record_failure()
             else:
-                if attempt < max_retries - 1:
-                    wait_time = delay * (attempt + 1)
-                    time.sleep(wait_time)
+                # 設定の問題はAPI側の障害ではないので、試しの呼び出し枠だけ戻す
+                openai_circuit.release_probe()
+            if not retryable or attempt >= max_retries - 1:
+                break
+            wait_time = _backoff_seconds(attempt, delay, e)
+            if wait_time > OPENAI_BACKOFF_MAX:
+                break
+            if deadline and time.time() + wait_time > deadline:
+                # 期限を過ぎた呼び出しはリトライしない
+                break
+            _openai_retry_stats['retries'] += 1
+            await asyncio.sleep(wait_time)
+    
+    _openai_retry_stats['gave_up'] += 1
+    return message
+
+def stream_openai_with_retry(prompt, max_retries=3, delay=2, unit=None, stage=None, model_override=None, report=None,
+                             call_type=None, first_token_deadline=None, on_late_reply=None):
+    """OpenAI APIをストリーミングで呼び出し、受信したテキストを順に返すジェネレータ（LLMゲートウェイ経由）
+    
+    最初のテキストを受信する前にリトライ可能なエラーで失敗した場合は call_openai_with_retry で
+    応答全体を取得して返す（リトライの扱いを通常の呼び出しと揃えるため）。
+    認証・権限・リクエスト形式のエラーやブレーカーが開いている場合、フォールバックも失敗した場合は
+    OpenAIStreamError（児童に表示する定型文付き）を送出する。受信途中で失敗した場合は元の例外を送出する。
+    report に辞書を渡すと、レート制限で待った時間（queue_wait_ms）を書き込む。
+    first_token_deadline 秒以内に最初のテキストが届かなければ DeadlineExceeded を送出する
+    （APIに送信した時点から数える。on_late_reply を渡すと受信は続け、完了後に全文を渡す）。
+    """
+    if client is None:
+        raise OpenAIStreamError("AI システムの初期化に問題があります。管理者に連絡してください。")
+    
+    messages = prompt if isinstance(prompt, list) else [{"role": "user", "content": prompt}]
+    report = report if report is not None else {}
+    student_id, priority = _request_rate_limit_identity()
+    call_type = call_type or _call_type_for_stage(stage)
+    received = False
+    try:
+        for delta in llm_gateway.stream(_astream_openai, messages, stage, model_override,
+                                        student_id, priority, report, call_type=call_type,
+                                        first_item_timeout=first_token_deadline, on_abandon=on_late_reply,
+                                        dispatched=threading.Event()):
+            received = True
+            yield delta
+    except Exception as e:
+        if received or isinstance(e, DeadlineExceeded):
+            raise
+        if isinstance(e, CircuitOpenError):
+            # 障害中は通常の呼び出しも行わない
+            raise OpenAIStreamError(OPENAI_MESSAGE_UNAVAILABLE) from e
+        retryable, _, message = _classify_openai_error(e)
+        if not retryable:
+            # 設定の問題は呼び直しても回復しない（ブレーカー・レート制限に二重に数えない）
+            print(f"[STREAM] Not retryable: {type(e).__name__}: {str(e)[:100]}")
+            raise OpenAIStreamError(message) from e
+        print(f"[STREAM] Falling back to non-streaming call: {type(e).__name__}: {str(e)[:100]}")
+        remaining = None
+        if first_token_deadline:
+            # 期限は送信した時点から数える（送信前に失敗した場合は残り全部）
+            remaining = max(1, first_token_deadline - (time.time() - report.get('dispatched_at', time.time())))
+        # ストリーミングで1回試した分を差し引く
+        content = call_openai_with_retry(messages, max_retries=max(1, max_retries - 1), delay=delay,
+                                         unit=unit, stage=stage, model_override=model_override, call_type=call_type,
+                                         deadline_seconds=remaining, on_late_reply=on_late_reply)
+        if _is_openai_error_message(content):
+            raise OpenAIStreamError(content) from e
+        yield content
+        return
+    
+    if not received:
+        raise Exception("空の応答が返されました")
+
+async def _astream_openai(messages, stage, model_override,
+                          student_id='system', priority=PRIORITY_BACKGROUND, report=None, call_type='other',
+                          dispatched=None):
+    """ストリーミング呼び出しの本体（ゲートウェイのイベントループ上で実行）
+
+    APIに送信する時点で dispatched（threading.Event）をセットし、report に dispatched_at を書き込む。
+    """
+    if not openai_circuit.allow():
+        raise CircuitOpenError()
+    model_name, max_tokens, timeout = route_model(call_type, model_override)
+    wait_ms = await openai_rate_limiter.acquire(
+        student_id, priority, count_message_tokens(messages) + max_tokens)
+    if report is not None:
+        report['queue_wait_ms'] = wait_ms
+    start_time = time.time()
+    try:
+        async with llm_gateway.slot():
+            if report is not None:
+                report['dispatched_at'] = time.time()
+            if dispatched is not None:
+                dispatched.set()
+            stream = await _get_async_client().chat.completions.create(
+                model=model_name,
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=_temperature_for_stage(stage),
+                timeout=timeout,
+                stream=True,
+                stream_options={"include_usage": True}
+            )
+            async for chunk in stream:
+                if getattr(chunk, 'usage', None):
+                    prompt_cache_stats.record(stage, chunk.usage)
+                if not chunk.choices:
                     continue
-                else:
-                    return f"予期しないエラーが発生しました: {error_msg[:100]}..."
-                    
-    return "複数回の試行後もAPIに接続できませんでした。しばらく待ってから再度お試しください。"
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    yield delta
+    except Exception as e:
+        _, counts_as_failure, _ = _classify_openai_error(e)
+        if counts_as_failure:
+            openai_circuit.record_failure()
+        else:
+            openai_circuit.release_probe()
+        raise
+    except BaseException:
+        # クライアントの切断などで中断された
+        openai_circuit.release_probe()
+        raise
+    openai_circuit.record_success()
+    model_latency.record(model_name, time.time() - start_time)
+
+def _sse_event(event, payload):
+    """Server-Sent Events の1イベント分の文字列を作成"""
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+def _sse_response(generator):
+    """ストリーミング応答（プロキシでバッファされないようにヘッダーを付与）"""
+    return Response(stream_with_context(generator), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 # 学習単元のデータ
 UNITS = [
@@ -599,28 +2243,135 @@ UNITS = [
     "水を冷やし続けた時の温度と様子"
 ]
 
+# プロンプト・課題文のレジストリ
+# prompts/ と tasks/ のファイルを起動時にすべてメモリへ読み込み、リクエスト処理中はファイルを開かない。
+# 編集されたファイルはバックグラウンドで更新日時を確認して読み込み直す（教員用APIからも再読込可）
+TASKS_DIR = Path('tasks')
+PROMPT_RELOAD_INTERVAL = float(os.getenv('PROMPT_RELOAD_INTERVAL', '10'))
+
+class PromptRegistry:
+    """プロンプト・課題文・初期メッセージ・テンプレートをメモリに保持するレジストリ
+
+    ファイルごとに更新日時を覚えておき、refresh() で変更・追加・削除されたファイルだけを読み直す。
+    ファイルから組み立てた値（描画済みテンプレートなど）は derived() でキャッシュし、
+    いずれかのファイルが変わったら作り直す。
+    """
+
+    def __init__(self, sources):
+        self.sources = sources  # (ディレクトリ, globパターン) のリスト
+        self._files = {}
+        self._derived = {}
+        self._lock = threading.Lock()
+        self._watcher = None
+        self.loaded_at = None
+        self.reload_count = 0
+
+    def _scan(self):
+        found = {}
+        for directory, pattern in self.sources:
+            for path in directory.glob(pattern):
+                try:
+                    found[path] = path.stat().st_mtime_ns
+                except OSError:
+                    continue
+        return found
+
+    def refresh(self, force=False):
+        """変更されたファイルを読み直す
+
+        Returns:
+            読み直した（または削除された）ファイルのパスのリスト
+        """
+        with self._lock:
+            found = self._scan()
+            files = dict(self._files)
+            changed = []
+            for path, mtime in found.items():
+                entry = files.get(path)
+                if not force and entry and entry[0] == mtime:
+                    continue
+                try:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        files[path] = (mtime, f.read())
+                    changed.append(str(path))
+                except (OSError, UnicodeDecodeError) as e:
+                    print(f"[PROMPTS] Failed to load {path}: {e}")
+            for path in set(files) - set(found):
+                del files[path]
+                changed.append(str(path))
+            if changed or force:
+                self._files = files
+                self._derived = {}
+                self.loaded_at = datetime.now().isoformat()
+                self.reload_count += 1
+        if changed and self.reload_count > 1:
+            print(f"[PROMPTS] Reloaded: {', '.join(changed)}")
+        return changed
+
+    def text(self, path):
+        """ファイルの内容（読み込まれていなければ None）"""
+        entry = self._files.get(Path(path))
+        return entry[1] if entry else None
+
+    def derived(self, key, build):
+        """ファイルの内容から組み立てた値をキャッシュして返す"""
+        derived = self._derived
+        if key not in derived:
+            derived[key] = build()
+        return derived[key]
+
+    def start_watcher(self, interval):
+        """interval 秒ごとに更新を確認するスレッドを開始"""
+        if interval <= 0 or self._watcher:
+            return
+
+        def watch():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print(f"[PROMPTS] Watcher error: {e}")
+
+        self._watcher = threading.Thread(target=watch, name='PROMPT_WATCHER', daemon=True)
+        self._watcher.start()
+
+    def stats(self):
+        return {
+            'files': sorted(str(path) for path in self._files),
+            'loaded_at': self.loaded_at,
+            'reload_count': self.reload_count,
+            'reload_interval': PROMPT_RELOAD_INTERVAL
+        }
+
+prompt_registry = PromptRegistry([(PROMPTS_DIR, '*.md'), (PROMPTS_DIR, '*.json'), (TASKS_DIR, '*.txt')])
+prompt_registry.refresh()
+prompt_registry.start_watcher(PROMPT_RELOAD_INTERVAL)
+startup_timer.mark('prompt_loading')
+
 # 課題文を読み込む関数
 def load_task_content(unit_name):
-    try:
-        with open(f'tasks/{unit_name}.txt', 'r', encoding='utf-8') as f:
-            return f.read().strip()
-    except FileNotFoundError:
+    content = prompt_registry.text(TASKS_DIR / f'{unit_name}.txt')
+    if content is None:
         return f"{unit_name}について実験を行います。どのような結果になると予想しますか？"
+    return content.strip()
 
 INITIAL_MESSAGES_FILE = PROMPTS_DIR / 'initial_messages.json'
 
-@lru_cache(maxsize=1)
-def _load_initial_messages():
-    try:
-        with open(INITIAL_MESSAGES_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except FileNotFoundError:
+def _parse_initial_messages():
+    content = prompt_registry.text(INITIAL_MESSAGES_FILE)
+    if content is None:
         print(f"[INIT_MSG] Warning: {INITIAL_MESSAGES_FILE} not found.")
         return {}
+    try:
+        return json.loads(content)
     except json.JSONDecodeError as e:
         print(f"[INIT_MSG] JSON decode error: {e}")
         return {}
 
+def _load_initial_messages():
+    return prompt_registry.derived('initial_messages', _parse_initial_messages)
+
 
 def get_initial_ai_message(unit_name, stage='prediction'):
     """初期メッセージを取得する"""
@@ -643,36 +2394,421 @@ def get_initial_ai_message(unit_name, stage='prediction'):
     
     return message
 
-# 単元ごとのプロンプトを読み込む関数
-def load_unit_prompt(unit_name):
-    """単元専用のプロンプトファイルを読み込む"""
-    try:
-        prompt_path = PROMPTS_DIR / f"{unit_name}.md"
-        with open(prompt_path, 'r', encoding='utf-8') as f:
-            return f.read().strip()
-    except FileNotFoundError:
-        return "児童の発言をよく聞いて、適切な質問で考えを引き出してください。"
+FALLBACK_QUESTIONS_FILE = PROMPTS_DIR / 'fallback_questions.json'
+
+def _parse_fallback_questions():
+    content = prompt_registry.text(FALLBACK_QUESTIONS_FILE)
+    if content is None:
+        return {}
+    try:
+        return json.loads(content)
+    except json.JSONDecodeError as e:
+        print(f"[FALLBACK] JSON decode error: {e}")
+        return {}
+
+def get_fallback_question(unit_name, stage, turn_count):
+    """AIが応答できないときに返す問いかけを取得する（対話の回数に応じて順に使う）"""
+    questions = prompt_registry.derived('fallback_questions', _parse_fallback_questions)
+    stage_questions = questions.get(stage, {})
+    candidates = stage_questions.get(unit_name) or stage_questions.get('_default') or []
+    if isinstance(candidates, str):
+        candidates = [candidates]
+    if not candidates:
+        return "そう思ったのはどうしてかな？もう少しくわしく教えてね。"
+    return candidates[max(turn_count - 1, 0) % len(candidates)]
+
+# 単元ごとのプロンプトを読み込む関数
+def load_unit_prompt(unit_name):
+    """単元専用のプロンプトを取得する（レジストリから）"""
+    def build():
+        content = prompt_registry.text(PROMPTS_DIR / f"{unit_name}.md")
+        if content is None:
+            return "児童の発言をよく聞いて、適切な質問で考えを引き出してください。"
+        return content.strip()
+    return prompt_registry.derived(('unit_prompt', unit_name), build)
+
+def load_prompt_template(filename):
+    """汎用テンプレートを取得する（レジストリから）"""
+    content = prompt_registry.text(PROMPTS_DIR / filename)
+    if content is None:
+        print(f"[PROMPTS] Warning: template '{filename}' not found")
+        return ""
+    return content
+
+def render_prompt_template(template: str, **placeholders):
+    """テンプレート内の{{KEY}}を置換"""
+    rendered = template
+    for key, value in placeholders.items():
+        rendered = rendered.replace(f"{{{{{key}}}}}", str(value) if value is not None else "")
+    return rendered
+
+def build_reflection_system_prompt(unit_prompt):
+    """考察段階のシステムプロンプト（児童によらず同じ内容になるもの）を作成
+
+    描画結果はレジストリにキャッシュし、テンプレートか単元プロンプトが変わるまで使い回す。
+    """
+    def build():
+        template = load_prompt_template('reflection_system_template.md')
+        if not template:
+            return unit_prompt
+        return render_prompt_template(template, UNIT_PROMPT=unit_prompt).strip()
+    return prompt_registry.derived(('reflection_system_prompt', unit_prompt), build)
+
+
+# 学習ログ（ローカル）の保存形式
+# logs/learning_log_YYYYMMDD.jsonl : 1行1エントリの追記専用ログ
+# logs/learning_log_YYYYMMDD.idx   : 各行のバイト位置とフィルタ用キーを記録した索引
+# logs/learning_log_YYYYMMDD.json  : 旧形式（JSON配列）。読み込みのみ対応
+LOG_DIR = 'logs'
+LOG_INDEX_KEYS = ('class_num', 'seat_num', 'unit', 'log_type')
+_learning_log_lock = threading.Lock()
+
+try:
+    import fcntl  # 複数ワーカーからの同時追記を防ぐ（POSIXのみ）
+except ImportError:
+    fcntl = None
+
+def _learning_log_paths(date):
+    """指定日のログ本体・索引・旧形式ファイルのパスを返す"""
+    base = os.path.join(LOG_DIR, f"learning_log_{date}")
+    return f"{base}.jsonl", f"{base}.idx", f"{base}.json"
+
+def _make_log_index_entry(log_entry, offset, length):
+    """索引の1行分を作成"""
+    index_entry = {'offset': offset, 'length': length}
+    for key in LOG_INDEX_KEYS:
+        index_entry[key] = log_entry.get(key)
+    return index_entry
+
+def _append_learning_log_local(date, log_entry):
+    """ログ1件をJSONLに追記し、索引にも1行追記する（既存データは読み込まない）"""
+    os.makedirs(LOG_DIR, exist_ok=True)
+    log_file, index_file, _ = _learning_log_paths(date)
+    line = (json.dumps(log_entry, ensure_ascii=False) + '\n').encode('utf-8')
+
+    with _learning_log_lock:
+        with open(log_file, 'ab') as f:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0, os.SEEK_END)
+                offset = f.tell()
+                f.write(line)
+                f.flush()
+                index_entry = _make_log_index_entry(log_entry, offset, len(line))
+                with open(index_file, 'a', encoding='utf-8') as idx:
+                    idx.write(json.dumps(index_entry, ensure_ascii=False) + '\n')
+            finally:
+                if fcntl:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+class LearningLogIndex:
+    """1日分の学習ログの転置索引（クラス → 出席番号 → 単元 → 種別 → エントリの位置）
+
+    位置はローカルでは (バイト位置, 長さ)、GCS ではキャッシュしたログ一覧の添字。
+    書き込み（add）と読み出し（lookup / distinct）は同じロックで行う（読み出し中に木が変わらないようにする）。
+    """
+
+    def __init__(self):
+        self.tree = {}
+        self.size = 0
+        self._lock = threading.Lock()
+
+    def add(self, entry, position):
+        with self._lock:
+            node = self.tree
+            for key in LOG_INDEX_KEYS[:-1]:
+                node = node.setdefault(entry.get(key), {})
+            node.setdefault(entry.get(LOG_INDEX_KEYS[-1]), []).append(position)
+            self.size += 1
+
+    def _nodes(self, filters, depth):
+        """先頭から depth 段目までフィルタを当てはめたノードの一覧"""
+        nodes = [self.tree]
+        for key in LOG_INDEX_KEYS[:depth]:
+            expected = filters.get(key)
+            if expected is None:
+                nodes = [child for node in nodes for child in node.values()]
+            else:
+                nodes = [node[expected] for node in nodes if expected in node]
+        return nodes
+
+    def lookup(self, filters):
+        """フィルタ条件に一致するエントリの位置を、ログ内の順に返す"""
+        with self._lock:
+            return sorted(position for leaf in self._nodes(filters, len(LOG_INDEX_KEYS)) for position in leaf)
+
+    def distinct(self, key, filters=None):
+        """key（例: 'unit'）の値の一覧"""
+        depth = LOG_INDEX_KEYS.index(key)
+        with self._lock:
+            return {value for node in self._nodes(filters or {}, depth) for value in node}
+
+# 日付ごとの索引のキャッシュ（索引ファイルの増えた分だけを読み足す）
+LOG_ENTRY_CACHE_SIZE = int(os.getenv('LOG_ENTRY_CACHE_SIZE', '20000'))
+_local_log_indexes = {}
+_local_log_index_lock = threading.Lock()
+_log_entry_cache = OrderedDict()
+_log_index_stats = {'index_lines_read': 0, 'entries_read': 0, 'entry_cache_hits': 0, 'repaired': 0, 'skipped': 0}
+
+def _read_new_log_index_lines(state, index_file):
+    """索引ファイルのうち、まだ読んでいない行を索引に加える"""
+    if not os.path.exists(index_file) or os.path.getsize(index_file) <= state['index_read']:
+        return
+    with open(index_file, 'rb') as idx:
+        idx.seek(state['index_read'])
+        for raw in idx:
+            if not raw.endswith(b'\n'):
+                break  # 書き込み途中の行は次回に回す
+            state['index_read'] += len(raw)
+            try:
+                index_entry = json.loads(raw.decode('utf-8'))
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                continue
+            if index_entry['offset'] in state['offsets']:
+                continue
+            state['offsets'].add(index_entry['offset'])
+            if not index_entry.get('skipped'):
+                state['index'].add(index_entry, (index_entry['offset'], index_entry['length']))
+            state['indexed_end'] = max(state['indexed_end'], index_entry['offset'] + index_entry['length'])
+            _log_index_stats['index_lines_read'] += 1
+
+def _repair_learning_log_index(state, log_file, index_file, date):
+    """索引に反映されていない行（クラッシュ時など）を索引ファイルに補完する
+
+    読めない行は skipped の印を付けた索引エントリとして記録し、次回からは読み直さない。
+    """
+    with open(log_file, 'rb') as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)  # 追記中のワーカーが索引を書き終えるのを待つ
+        try:
+            _read_new_log_index_lines(state, index_file)
+            missing = []
+            f.seek(state['indexed_end'])
+            offset = state['indexed_end']
+            for raw in f:
+                if not raw.endswith(b'\n'):
+                    break
+                try:
+                    log_entry = json.loads(raw.decode('utf-8'))
+                    missing.append(_make_log_index_entry(log_entry, offset, len(raw)))
+                except (json.JSONDecodeError, UnicodeDecodeError):
+                    print(f"[LOG_INDEX] Unreadable line skipped for {date} at offset {offset}")
+                    missing.append({'offset': offset, 'length': len(raw), 'skipped': True})
+                offset += len(raw)
+            if missing:
+                with open(index_file, 'a', encoding='utf-8') as idx:
+                    for index_entry in missing:
+                        idx.write(json.dumps(index_entry, ensure_ascii=False) + '\n')
+                skipped = sum(1 for index_entry in missing if index_entry.get('skipped'))
+                print(f"[LOG_INDEX] Repaired {len(missing) - skipped} entries for {date} ({skipped} unreadable)")
+                _log_index_stats['repaired'] += len(missing) - skipped
+                _log_index_stats['skipped'] += skipped
+            _read_new_log_index_lines(state, index_file)
+        finally:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+def _local_log_index(date):
+    """指定日の索引を返す（初回は索引ファイル全体、以降は増えた行だけを読む）。ログがなければ None"""
+    log_file, index_file, _ = _learning_log_paths(date)
+    if not os.path.exists(log_file):
+        return None
+    with _local_log_index_lock:
+        state = _local_log_indexes.get(date)
+        if state is None:
+            state = {'index': LearningLogIndex(), 'offsets': set(), 'index_read': 0, 'indexed_end': 0}
+            _local_log_indexes[date] = state
+        _read_new_log_index_lines(state, index_file)
+        if os.path.getsize(log_file) > state['indexed_end']:
+            with _learning_log_lock:
+                _repair_learning_log_index(state, log_file, index_file, date)
+        return state['index']
+
+def _log_matches_filters(entry, filters):
+    """ログ（または索引エントリ）がフィルタ条件に一致するか"""
+    for key, expected in filters.items():
+        if expected is None:
+            continue
+        if entry.get(key) != expected:
+            return False
+    return True
+
+def _load_legacy_learning_logs(date):
+    """旧形式（JSON配列）のログを読み込む"""
+    _, _, legacy_file = _learning_log_paths(date)
+    if not os.path.exists(legacy_file):
+        return []
+    try:
+        with open(legacy_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (json.JSONDecodeError, FileNotFoundError):
+        return []
+
+def _load_learning_logs_local(date, filters):
+    """ローカルの学習ログを読み込み（旧形式JSON → JSONLの順）
+
+    索引で該当するエントリの位置だけを選んで読み込む。読み込んだエントリはキャッシュし、
+    同じページの再表示ではファイルを読み直さない（返すログは読み取り専用として扱う）。
+    """
+    log_file, _, _ = _learning_log_paths(date)
+    logs = [log for log in _load_legacy_learning_logs(date) if _log_matches_filters(log, filters)]
+
+    index = _local_log_index(date)
+    if index is None:
+        return logs
+    targets = index.lookup(filters)
+    missing = []
+    with _local_log_index_lock:
+        for offset, length in targets:
+            if (date, offset) in _log_entry_cache:
+                _log_entry_cache.move_to_end((date, offset))
+            else:
+                missing.append((offset, length))
+    _log_index_stats['entry_cache_hits'] += len(targets) - len(missing)
+
+    parsed = {}
+    if missing:
+        with open(log_file, 'rb') as f:
+            for offset, length in missing:
+                f.seek(offset)
+                try:
+                    parsed[offset] = json.loads(f.read(length).decode('utf-8'))
+                except (json.JSONDecodeError, UnicodeDecodeError):
+                    continue
+        _log_index_stats['entries_read'] += len(parsed)
+
+    with _local_log_index_lock:
+        for offset, entry in parsed.items():
+            _log_entry_cache[(date, offset)] = entry
+        for offset, _ in targets:
+            entry = parsed.get(offset) or _log_entry_cache.get((date, offset))
+            if entry is not None:
+                logs.append(entry)
+        while len(_log_entry_cache) > LOG_ENTRY_CACHE_SIZE:
+            _log_entry_cache.popitem(last=False)
 
-def load_prompt_template(filename):
-    """汎用テンプレートを読み込み"""
-    try:
-        template_path = PROMPTS_DIR / filename
-        with open(template_path, 'r', encoding='utf-8') as f:
-            return f.read()
-    except FileNotFoundError:
-        print(f"[PROMPTS] Warning: template '{filename}' not found")
-        return ""
+    return logs
 
-def render_prompt_template(template: str, **placeholders):
-    """テンプレート内の{{KEY}}を置換"""
-    rendered = template
-    for key, value in placeholders.items():
-        rendered = rendered.replace(f"{{{{{key}}}}}", str(value) if value is not None else "")
-    return rendered
+# 学習ログ（GCS）の保存形式
+# logs/learning_log_YYYYMMDD/{時刻}_{log_id}.json : 1エントリ1オブジェクト（書き込み時）
+# logs/learning_log_YYYYMMDD.json                 : 統合済みの日次ファイル（JSON配列）
+GCS_LOG_COMPACTION_THRESHOLD = int(os.getenv('GCS_LOG_COMPACTION_THRESHOLD', '200'))
+GCS_LOG_DOWNLOAD_WORKERS = 8
+
+def _gcs_log_daily_path(date):
+    return f"logs/learning_log_{date}.json"
+
+def _gcs_log_shard_prefix(date):
+    return f"logs/learning_log_{date}/"
+
+def _gcs_log_shard_path(date, log_entry):
+    """時刻順に並ぶよう、タイムスタンプを先頭にしたオブジェクト名にする"""
+    stamp = log_entry['timestamp'].replace(':', '').replace('-', '').replace('.', '')
+    return f"{_gcs_log_shard_prefix(date)}{stamp}_{log_entry['log_id']}.json"
+
+def _list_gcs_log_shards(date):
+    return list(bucket.list_blobs(prefix=_gcs_log_shard_prefix(date)))
+
+def _download_gcs_daily_logs(date):
+    """日次ファイルを読み込み、(ログ一覧, generation) を返す。存在しない場合は generation=0"""
+    blob = bucket.get_blob(_gcs_log_daily_path(date))
+    if blob is None:
+        return [], 0
+    return json.loads(blob.download_as_bytes().decode('utf-8')), blob.generation
+
+def _download_gcs_log_shard_pairs(shard_blobs):
+    """エントリオブジェクトを並列にダウンロードし、(読めた (blob, エントリ) の一覧, 失敗数) を返す
+
+    統合処理で削除済み（NotFound）のオブジェクトは飛ばし、失敗数には数えない。
+    """
+    from google.api_core.exceptions import NotFound
+
+    def _download(blob):
+        try:
+            return blob, json.loads(blob.download_as_bytes().decode('utf-8')), False
+        except NotFound:
+            # 統合処理で削除済み
+            return blob, None, False
+        except Exception as e:
+            print(f"[GCS_LOAD] Shard download failed: {blob.name} ({type(e).__name__})")
+            return blob, None, True
+
+    if not shard_blobs:
+        return [], 0
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=GCS_LOG_DOWNLOAD_WORKERS) as executor:
+        results = list(executor.map(_download, shard_blobs))
+    pairs = [(blob, entry) for blob, entry, _ in results if entry is not None]
+    failed = sum(1 for _, _, error in results if error)
+    return pairs, failed
+
+def _download_gcs_log_shards(shard_blobs):
+    """エントリオブジェクトを並列にダウンロードし、読めたエントリの一覧を返す"""
+    pairs, _ = _download_gcs_log_shard_pairs(shard_blobs)
+    return [entry for _, entry in pairs]
+
+def _merge_learning_logs(*log_lists):
+    """ログを log_id で重複排除し、時刻順に並べる（log_id のない旧ログはそのまま残す）"""
+    merged = []
+    seen = set()
+    for logs in log_lists:
+        for log in logs:
+            log_id = log.get('log_id')
+            if log_id:
+                if log_id in seen:
+                    continue
+                seen.add(log_id)
+            merged.append(log)
+    merged.sort(key=lambda log: log.get('timestamp', ''))
+    return merged
+
+def compact_gcs_learning_logs(date):
+    """未統合のエントリを日次ファイルへまとめ、統合済みのエントリを削除する
 
+    日次ファイルは generation 条件付きで更新するため、同時に統合処理が走っても
+    一方が失敗するだけでログは失われない。統合中に追加されたエントリは次回に回る。
+
+    Returns:
+        int: 統合したエントリ数
+    """
+    if not (USE_GCS and bucket):
+        return 0
+    try:
+        shard_blobs = _list_gcs_log_shards(date)
+        if not shard_blobs:
+            return 0
+        
+        daily_logs, generation = _download_gcs_daily_logs(date)
+        shard_pairs, failed = _download_gcs_log_shard_pairs(shard_blobs)
+        shard_logs = [entry for _, entry in shard_pairs]
+        merged = _merge_learning_logs(daily_logs, shard_logs)
+        
+        bucket.blob(_gcs_log_daily_path(date)).upload_from_string(
+            json.dumps(merged, ensure_ascii=False, indent=2).encode('utf-8'),
+            content_type='application/json',
+            if_generation_match=generation
+        )
+        
+        # 日次ファイルに入ったエントリのオブジェクトだけを削除する
+        # 読めなかったオブジェクトがある場合は、念のため今回は何も削除しない（次回の統合で再度まとめる）
+        if failed:
+            print(f"[GCS_COMPACT] {date}: {failed} shards failed to download, skipping deletion")
+        else:
+            for blob, _ in shard_pairs:
+                try:
+                    blob.delete()
+                except Exception as e:
+                    print(f"[GCS_COMPACT] Delete failed: {blob.name} ({type(e).__name__})")
+        
+        print(f"[GCS_COMPACT] {date}: merged {len(shard_logs)} entries (total {len(merged)})")
+        return len(shard_logs)
+    except Exception as e:
+        print(f"[GCS_COMPACT] ERROR - {type(e).__name__}: {str(e)}")
+        return 0
 
 # 学習ログを保存する関数
-def save_learning_log(student_number, unit, log_type, data, class_number=None):
+def save_learning_log(student_number, unit, log_type, data, class_number=None, background=False):
     """学習ログをGCSまたはローカルJSONに保存
     
     Args:
@@ -681,6 +2817,7 @@ def save_learning_log(student_number, unit, log_type, data, class_number=None):
         log_type: ログタイプ
         data: ログデータ
         class_number: クラス番号 (例: "1", "2") - 省略時は student_number から自動解析
+        background: True の場合は書き込み遅延キュー経由で保存する
     """
     class_number = normalize_class_value(class_number) or class_number
     # parse_student_info を使って正しくパースする
@@ -706,6 +2843,7 @@ def save_learning_log(student_number, unit, log_type, data, class_number=None):
             class_display = str(student_number)
     
     log_entry = {
+        'log_id': uuid.uuid4().hex,
         'timestamp': datetime.now().isoformat(),
         'student_number': student_number,
         'class_num': class_num,
@@ -716,77 +2854,130 @@ def save_learning_log(student_number, unit, log_type, data, class_number=None):
         'data': data
     }
     
+    if background and WRITE_BEHIND_ENABLED:
+        persistence_queue.submit(_write_learning_log_entry, log_entry)
+    else:
+        _write_learning_log_entry(log_entry)
+    
+    # 教員用クラスタリングの追跡中の組み合わせに反映する
+    cluster_service.notify(log_entry)
+
+def _write_learning_log_entry(log_entry):
+    """ログエントリをGCSまたはローカルに書き込む"""
+    log_date = log_entry['timestamp'][:10].replace('-', '')
+    class_display = log_entry['class_display']
+    unit = log_entry['unit']
+    log_type = log_entry['log_type']
+    
     if USE_GCS:
-        # GCS に保存
+        # GCS に保存（1エントリ1オブジェクト。日次ファイルはダウンロードしない）
         try:
-            log_date = datetime.now().strftime('%Y%m%d')
-            log_filename = f"logs/learning_log_{log_date}.json"
-            
-            print(f"[GCS_SAVE] START - path: {log_filename}, class: {class_display}, unit: {unit}, type: {log_type}")
+            shard_path = _gcs_log_shard_path(log_date, log_entry)
             
-            # GCS からファイルを読み込み
-            blob = bucket.blob(log_filename)
-            logs = []
-            try:
-                content = blob.download_as_string()
-                logs = json.loads(content.decode('utf-8'))
-            except Exception:
-                logs = []
+            print(f"[GCS_SAVE] START - path: {shard_path}, class: {class_display}, unit: {unit}, type: {log_type}")
             
-            # ログエントリを追加
-            logs.append(log_entry)
-            
-            # GCS に保存
+            blob = bucket.blob(shard_path)
             blob.upload_from_string(
-                json.dumps(logs, ensure_ascii=False, indent=2).encode('utf-8'),
-                content_type='application/json'
+                json.dumps(log_entry, ensure_ascii=False).encode('utf-8'),
+                content_type='application/json',
+                if_generation_match=0  # 同名オブジェクトを上書きしない
             )
             print(f"[GCS_SAVE] SUCCESS - saved to GCS")
+            _remember_gcs_learning_log(log_date, log_entry)
         except Exception as e:
             print(f"[GCS_SAVE] ERROR - {type(e).__name__}: {str(e)}")
             import traceback
             traceback.print_exc()
     else:
-        # ローカルファイルに保存
-        log_filename = f"learning_log_{datetime.now().strftime('%Y%m%d')}.json"
-        os.makedirs('logs', exist_ok=True)
-        log_file = f"logs/{log_filename}"
-        
-        logs = []
-        if os.path.exists(log_file):
-            try:
-                with open(log_file, 'r', encoding='utf-8') as f:
-                    logs = json.load(f)
-            except (json.JSONDecodeError, FileNotFoundError):
-                logs = []
-        
-        logs.append(log_entry)
-        
-        with open(log_file, 'w', encoding='utf-8') as f:
-            json.dump(logs, f, ensure_ascii=False, indent=2)
+        # ローカルファイルに追記（JSON Lines + 索引）
+        try:
+            _append_learning_log_local(log_date, log_entry)
+        except Exception as e:
+            print(f"[LOG_SAVE] Local Error - {type(e).__name__}: {str(e)}")
+
+# GCS のログは日付ごとにキャッシュし、転置索引で絞り込む
+# このインスタンスで書いたログはすぐに加え、他のインスタンスのログは TTL ごとの再読み込みで反映する
+GCS_LOG_CACHE_TTL = int(os.getenv('GCS_LOG_CACHE_TTL', '30'))
+_gcs_log_cache = {}
+_gcs_log_cache_lock = threading.Lock()
+
+def _index_learning_logs(logs):
+    index = LearningLogIndex()
+    for position, log in enumerate(logs):
+        index.add(log, position)
+    return index
+
+def _gcs_cached_learning_logs(date):
+    """指定日のログ一覧と索引を返す（キャッシュが古ければ GCS から読み直す）"""
+    with _gcs_log_cache_lock:
+        cached = _gcs_log_cache.get(date)
+        if cached is not None and time.time() - cached['loaded_at'] < GCS_LOG_CACHE_TTL:
+            return cached
+
+    # GCS から読み込み（日次ファイル + 未統合のエントリ）
+    log_filename = _gcs_log_daily_path(date)
+    print(f"[GCS_LOAD] START - loading logs from: {log_filename}")
+    
+    shard_blobs = _list_gcs_log_shards(date)
+    if len(shard_blobs) >= GCS_LOG_COMPACTION_THRESHOLD and compact_gcs_learning_logs(date):
+        shard_blobs = _list_gcs_log_shards(date)
+    
+    daily_logs, _ = _download_gcs_daily_logs(date)
+    shard_logs = _download_gcs_log_shards(shard_blobs)
+    logs = _merge_learning_logs(daily_logs, shard_logs)
+    print(f"[GCS_LOAD] SUCCESS - loaded {len(logs)} logs from {date} ({len(shard_logs)} uncompacted)")
+
+    cached = {
+        'logs': logs,
+        'index': _index_learning_logs(logs),
+        'log_ids': {log.get('log_id') for log in logs if log.get('log_id')},
+        'loaded_at': time.time()
+    }
+    with _gcs_log_cache_lock:
+        _gcs_log_cache[date] = cached
+    return cached
+
+def _remember_gcs_learning_log(date, log_entry):
+    """GCS に書き込んだログを、その日のキャッシュにも加える"""
+    with _gcs_log_cache_lock:
+        cached = _gcs_log_cache.get(date)
+        if cached is None or log_entry['log_id'] in cached['log_ids']:
+            return
+        cached['log_ids'].add(log_entry['log_id'])
+        cached['index'].add(log_entry, len(cached['logs']))
+        cached['logs'].append(log_entry)
+
+def get_learning_log_units(date):
+    """指定日のログに含まれる単元の一覧（索引から求め、ログ本体は読まない）"""
+    if USE_GCS:
+        try:
+            units = _gcs_cached_learning_logs(date)['index'].distinct('unit')
+        except Exception as e:
+            print(f"[GCS_LOAD] ERROR - {type(e).__name__}: {str(e)}")
+            units = set()
+    else:
+        index = _local_log_index(date)
+        units = index.distinct('unit') if index else set()
+        units.update(log.get('unit') for log in _load_legacy_learning_logs(date))
+    return sorted(unit for unit in units if unit)
 
 # 学習ログを読み込む関数
-def load_learning_logs(date=None):
-    """指定日の学習ログを読み込み（GCSまたはローカル）"""
+def load_learning_logs(date=None, class_num=None, seat_num=None, unit=None, log_type=None):
+    """指定日の学習ログを読み込み（GCSまたはローカル）
+
+    Args:
+        date: 日付 (YYYYMMDD)。省略時は今日
+        class_num, seat_num, unit, log_type: 指定した項目が一致するログのみ返す
+    """
     if date is None:
         date = datetime.now().strftime('%Y%m%d')
-    
+    filters = {'class_num': class_num, 'seat_num': seat_num, 'unit': unit, 'log_type': log_type}
+
     if USE_GCS:
-        # GCS から読み込み
+        # GCS から読み込み（GCS_LOG_CACHE_TTL 秒の間は、索引付きでキャッシュした一覧から選ぶ）
         try:
-            log_filename = f"logs/learning_log_{date}.json"
-            print(f"[GCS_LOAD] START - loading logs from: {log_filename}")
-            
-            blob = bucket.blob(log_filename)
-            try:
-                content = blob.download_as_string()
-                logs = json.loads(content.decode('utf-8'))
-                log_count = len(logs)
-                print(f"[GCS_LOAD] SUCCESS - loaded {log_count} logs from {date}")
-                return logs
-            except Exception as e:
-                print(f"[GCS_LOAD] File not found: {log_filename}")
-                return []
+            cached = _gcs_cached_learning_logs(date)
+            return [cached['logs'][position] for position in cached['index'].lookup(filters)]
         except Exception as e:
             print(f"[GCS_LOAD] ERROR - {type(e).__name__}: {str(e)}")
             import traceback
@@ -794,16 +2985,10 @@ def load_learning_logs(date=None):
             return []
     else:
         # ローカルファイルから読み込み
-        log_filename = f"learning_log_{date}.json"
-        log_file = f"logs/{log_filename}"
-        
-        if not os.path.exists(log_file):
-            return []
-        
         try:
-            with open(log_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except (json.JSONDecodeError, FileNotFoundError):
+            return _load_learning_logs_local(date, filters)
+        except Exception as e:
+            print(f"[LOG_LOAD] Local Error - {type(e).__name__}: {str(e)}")
             return []
 
 def get_available_log_dates():
@@ -812,16 +2997,16 @@ def get_available_log_dates():
     import os
     
     # ローカルファイル
-    dates = []
-    log_files = glob.glob("logs/learning_log_*.json")
+    dates = set()
+    log_files = glob.glob("logs/learning_log_*.json") + glob.glob("logs/learning_log_*.jsonl")
     for file in log_files:
         filename = os.path.basename(file)
-        if filename.startswith('learning_log_') and filename.endswith('.json'):
-            date_str = filename[13:-5]
+        if filename.startswith('learning_log_'):
+            date_str = filename[13:].split('.', 1)[0]
             if len(date_str) == 8 and date_str.isdigit():
-                dates.append(date_str)
+                dates.add(date_str)
     
-    dates.sort(reverse=True)  # 新しい順
+    dates = sorted(dates, reverse=True)  # 新しい順
     print(f"[DATES] Found {len(dates)} log dates: {dates[:5]}")
     
     return dates
@@ -896,6 +3081,237 @@ def load_error_logs(date=None):
     except (json.JSONDecodeError, FileNotFoundError):
         return []
 
+# 埋め込みベクトルのキャッシュ（分析のたびに同じテキストの埋め込みを取得し直さない）
+EMBEDDING_MODEL = os.getenv('EMBEDDING_MODEL', 'text-embedding-3-small')
+EMBEDDING_CACHE_DIR = Path(os.getenv('EMBEDDING_CACHE_DIR', 'embedding_cache'))
+EMBEDDING_CACHE_MEMORY_ENTRIES = int(os.getenv('EMBEDDING_CACHE_MEMORY_ENTRIES', '5000'))
+EMBEDDING_BATCH_SIZE = int(os.getenv('EMBEDDING_BATCH_SIZE', '256'))
+EMBEDDING_CACHE_MAX_SHARDS = int(os.getenv('EMBEDDING_CACHE_MAX_SHARDS', '64'))
+
+class EmbeddingCache:
+    """テキストの埋め込みベクトルを (モデル, テキストのハッシュ) で保存するキャッシュ
+
+    モデルごとのディレクトリに、保存1回分ずつのシャード（{名前}.keys.npy: テキストの SHA-256、
+    {名前}.vectors.npy: float32 の行列）を追加していく。既存のファイルは書き換えないので、
+    保存にかかる時間はその回のベクトル数だけで決まり、複数のワーカーが同時に保存しても壊れない。
+    シャードが max_shards を超えたら、ファイルロックを取った1つのワーカーが1つにまとめ直す。
+    行列はメモリマップで読み、よく使うベクトルだけをメモリ上のLRUに置く。
+    """
+
+    def __init__(self, directory, memory_entries=5000, max_shards=64):
+        self.directory = Path(directory)
+        self.memory_entries = memory_entries
+        self.max_shards = max_shards
+        self._memory = OrderedDict()
+        self._files = {}  # モデル -> {'index': {キー: (シャード, 行番号)}, 'shards': {シャード: メモリマップ}}
+        self._lock = threading.Lock()
+        self._stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'stored': 0, 'compactions': 0}
+
+    @staticmethod
+    def make_key(text):
+        # 16進表記で保存する（numpy の固定長バイト列は末尾の NUL を落とすため、生のダイジェストは使わない）
+        return hashlib.sha256(text.encode('utf-8')).hexdigest().encode('ascii')
+
+    def _model_dir(self, model):
+        return self.directory / (secure_filename(model) or 'model')
+
+    @staticmethod
+    def _shard_names(model_dir):
+        # キーのファイルは最後に置くので、キーのファイルがあるシャードだけを完成したものとして扱う
+        return sorted(path.name[:-len('.keys.npy')] for path in model_dir.glob('*.keys.npy'))
+
+    @staticmethod
+    def _write_array(path, array):
+        """書き込み途中のファイルを読まないよう、一時ファイルに書いてから置き換える"""
+        import numpy as np
+        temp_path = path.with_name(path.name + '.tmp')
+        with open(temp_path, 'wb') as f:
+            np.save(f, array)
+        os.replace(temp_path, path)
+
+    def _refresh_locked(self, model):
+        """まだ読んでいないシャード（他のワーカーが追加したものを含む）を索引に加える"""
+        import numpy as np
+        model_dir = self._model_dir(model)
+        names = self._shard_names(model_dir)
+        state = self._files.get(model)
+        if state is None or not set(state['shards']).issubset(names):
+            # まとめ直しで消えたシャードがあれば読み直す
+            state = self._files[model] = {'index': {}, 'shards': {}}
+        for name in names:
+            if name in state['shards']:
+                continue
+            try:
+                keys = np.load(model_dir / f"{name}.keys.npy")
+                vectors = np.load(model_dir / f"{name}.vectors.npy", mmap_mode='r')
+            except Exception as e:
+                # まとめ直しの途中で消えた場合は、まとめた側のシャードに同じベクトルがある
+                print(f"[EMBEDDING_CACHE] Shard skipped ({model}/{name}): {type(e).__name__}")
+                continue
+            state['shards'][name] = vectors
+            for row, key in enumerate(keys[:len(vectors)]):
+                state['index'].setdefault(bytes(key), (name, row))
+        return state
+
+    def _remember_locked(self, memory_key, vector):
+        self._memory[memory_key] = vector
+        self._memory.move_to_end(memory_key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def get_many(self, model, texts):
+        """テキストごとのベクトル（float32）を返す。キャッシュにないものは None"""
+        results = []
+        with self._lock:
+            state = self._refresh_locked(model)
+            for text in texts:
+                memory_key = (model, self.make_key(text))
+                vector = self._memory.get(memory_key)
+                if vector is not None:
+                    self._memory.move_to_end(memory_key)
+                    self._stats['memory_hits'] += 1
+                else:
+                    location = state['index'].get(memory_key[1])
+                    if location is not None:
+                        shard, row = location
+                        vector = state['shards'][shard][row].copy()
+                        self._remember_locked(memory_key, vector)
+                        self._stats['disk_hits'] += 1
+                    else:
+                        self._stats['misses'] += 1
+                results.append(vector)
+        return results
+
+    def put_many(self, model, texts, new_vectors):
+        """新しく取得したベクトルをメモリに置き、まだ保存されていないものを新しいシャードとして保存する"""
+        import numpy as np
+        new_vectors = np.asarray(new_vectors, dtype=np.float32)
+        model_dir = self._model_dir(model)
+        with self._lock:
+            state = self._refresh_locked(model)
+            new_rows = OrderedDict()
+            for text, vector in zip(texts, new_vectors):
+                key = self.make_key(text)
+                self._remember_locked((model, key), vector)
+                if key not in state['index']:
+                    new_rows[key] = vector
+            if not new_rows:
+                return
+            try:
+                model_dir.mkdir(parents=True, exist_ok=True)
+                name = f"{int(time.time() * 1000):013d}_{uuid.uuid4().hex[:8]}"
+                # ベクトルを先に、キーを最後に書く
+                self._write_array(model_dir / f"{name}.vectors.npy", np.vstack(list(new_rows.values())))
+                self._write_array(model_dir / f"{name}.keys.npy", np.array(list(new_rows), dtype='S64'))
+                self._stats['stored'] += len(new_rows)
+                shard_count = len(self._shard_names(model_dir))
+            except Exception as e:
+                print(f"[EMBEDDING_CACHE] Save error ({model}): {e}")
+                return
+        if shard_count > self.max_shards:
+            self._compact(model)
+
+    def _compact(self, model):
+        """シャードを1つにまとめ直す（他のワーカーがまとめている間は何もしない）"""
+        if fcntl is None:
+            return
+        import numpy as np
+        model_dir = self._model_dir(model)
+        with open(model_dir / '.compact.lock', 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return
+            try:
+                names = self._shard_names(model_dir)
+                if len(names) <= self.max_shards:
+                    return
+                seen, keys, vectors = set(), [], []
+                for name in names:
+                    shard_keys = np.load(model_dir / f"{name}.keys.npy")
+                    shard_vectors = np.load(model_dir / f"{name}.vectors.npy")
+                    for key, vector in zip(shard_keys, shard_vectors):
+                        if bytes(key) not in seen:
+                            seen.add(bytes(key))
+                            keys.append(key)
+                            vectors.append(vector)
+                # 名前の先頭を最後のシャードと同じ時刻にして、まとめた後も時刻順に並ぶようにする
+                merged = f"{names[-1].split('_')[0]}_{uuid.uuid4().hex[:8]}"
+                self._write_array(model_dir / f"{merged}.vectors.npy", np.vstack(vectors))
+                self._write_array(model_dir / f"{merged}.keys.npy", np.array(keys, dtype='S64'))
+                for name in names:
+                    for suffix in ('.keys.npy', '.vectors.npy'):
+                        try:
+                            (model_dir / f"{name}{suffix}").unlink()
+                        except FileNotFoundError:
+                            pass
+                with self._lock:
+                    self._stats['compactions'] += 1
+                print(f"[EMBEDDING_CACHE] Compacted {model}: {len(names)} shards, {len(keys)} vectors")
+            except Exception as e:
+                print(f"[EMBEDDING_CACHE] Compaction error ({model}): {e}")
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def stats(self):
+        with self._lock:
+            lookups = self._stats['memory_hits'] + self._stats['disk_hits'] + self._stats['misses']
+            hits = lookups - self._stats['misses']
+            return dict(self._stats, memory_entries=len(self._memory),
+                        shards=sum(len(state['shards']) for state in self._files.values()),
+                        hit_rate=round(hits / lookups, 3) if lookups else None)
+
+embedding_cache = EmbeddingCache(EMBEDDING_CACHE_DIR, memory_entries=EMBEDDING_CACHE_MEMORY_ENTRIES,
+                                 max_shards=EMBEDDING_CACHE_MAX_SHARDS)
+_embedding_api_stats = {'requests': 0, 'texts': 0}
+
+def get_embeddings(texts, model=EMBEDDING_MODEL):
+    """テキストの埋め込みを float32 の行列で返す
+
+    キャッシュにないテキストだけを EMBEDDING_BATCH_SIZE 件ずつまとめて API に送る。
+    """
+    import numpy as np
+    vectors = embedding_cache.get_many(model, texts)
+    missing = list(OrderedDict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+    if missing:
+        if client is None:
+            raise RuntimeError('OpenAI client is not initialized')
+        fetched = {}
+        for start in range(0, len(missing), EMBEDDING_BATCH_SIZE):
+            batch = missing[start:start + EMBEDDING_BATCH_SIZE]
+            response = client.embeddings.create(input=batch, model=model)
+            _embedding_api_stats['requests'] += 1
+            _embedding_api_stats['texts'] += len(batch)
+            batch_vectors = [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+            embedding_cache.put_many(model, batch, batch_vectors)
+            fetched.update(zip(batch, np.asarray(batch_vectors, dtype=np.float32)))
+        vectors = [vector if vector is not None else fetched[text] for text, vector in zip(texts, vectors)]
+    print(f"[EMBEDDING] {len(texts)} texts, {len(missing)} fetched from API")
+    return np.vstack(vectors) if vectors else np.zeros((0, 0), dtype=np.float32)
+
+def _log_student_key(log):
+    """ログの学生を識別するキー（クラスと出席番号の組み合わせ、なければ生徒番号）と表示名を返す"""
+    class_num = log.get('class_num')
+    seat_num = log.get('seat_num')
+    student_num = log.get('student_number') or '不明'
+    if class_num and seat_num:
+        return f"{class_num}_{seat_num}", log.get('class_display') or f"{class_num}組{seat_num}番"
+    return student_num, log.get('class_display') or str(student_num)
+
+def _group_student_messages(logs):
+    """対話ログを学生ごとの発言リストにまとめる（ログの順序を保つ）"""
+    student_messages = {}
+    for log in logs:
+        student_id = log.get('student_number', '不明')
+        msg = (log.get('data') or {}).get('user_message', '')
+        if msg:
+            student_messages.setdefault(student_id, []).append(msg)
+    return student_messages
+
+def _cluster_count(student_count):
+    """学生数に応じたクラスタ数（2〜5）"""
+    return min(max(2, student_count // 3), 5)
+
 def perform_clustering_analysis(unit_logs, unit_name, class_num):
     """学生の対話をエンベディング＆クラスタリング分析
     
@@ -908,6 +3324,8 @@ def perform_clustering_analysis(unit_logs, unit_name, class_num):
         dict: クラスタリング結果
     """
     try:
+        from sklearn.cluster import KMeans
+        
         print(f"[CLUSTERING] Starting analysis for {class_num}_{unit_name}")
         
         # 予想と考察を分離
@@ -922,14 +3340,7 @@ def perform_clustering_analysis(unit_logs, unit_name, class_num):
                 continue
             
             # 学生ごとに対話をグループ化
-            student_messages = {}
-            for log in phase_logs:
-                student_id = log.get('student_number', '不明')
-                msg = log.get('data', {}).get('user_message', '')
-                if msg:
-                    if student_id not in student_messages:
-                        student_messages[student_id] = []
-                    student_messages[student_id].append(msg)
+            student_messages = _group_student_messages(phase_logs)
             
             if not student_messages:
                 clustering_results[phase_name] = {'clusters': [], 'message': 'テキストデータがありません'}
@@ -941,17 +3352,11 @@ def perform_clustering_analysis(unit_logs, unit_name, class_num):
             
             print(f"[CLUSTERING] Getting embeddings for {len(student_ids)} students...")
             
-            # OpenAI Embedding API を使用
-            client = openai.OpenAI(api_key=os.environ.get('OPENAI_API_KEY'))
-            embeddings_response = client.embeddings.create(
-                input=student_texts,
-                model="text-embedding-3-small"
-            )
-            
-            embeddings = np.array([e.embedding for e in embeddings_response.data])
+            # OpenAI Embedding API を使用（前回の分析から変わっていないテキストはキャッシュを使う）
+            embeddings = get_embeddings(student_texts)
             
             # クラスタ数を決定（学生数に基づいて、最大5クラスタ）
-            n_clusters = min(max(2, len(student_ids) // 3), 5)
+            n_clusters = _cluster_count(len(student_ids))
             
             print(f"[CLUSTERING] Performing KMeans clustering with {n_clusters} clusters...")
             
@@ -992,6 +3397,205 @@ def perform_clustering_analysis(unit_logs, unit_name, class_num):
             '考察段階': {'clusters': [], 'error': str(e)}
         }
 
+# 教員用クラスタリング（バックグラウンドで計算し、最新の結果をすぐに返す）
+CLUSTER_UPDATE_INTERVAL = float(os.getenv('CLUSTER_UPDATE_INTERVAL', '30'))
+CLUSTER_RELOAD_SECONDS = float(os.getenv('CLUSTER_RELOAD_SECONDS', '600'))
+CLUSTER_TRACK_SECONDS = float(os.getenv('CLUSTER_TRACK_SECONDS', '3600'))
+CLUSTER_PHASES = {'prediction': 'prediction_chat', 'reflection': 'reflection_chat'}
+
+class ClusterService:
+    """日付・クラス・単元・段階ごとのクラスタリング結果を、バックグラウンドのスレッドで計算・更新する
+
+    - 教員が結果を求めた組み合わせだけを追跡し、CLUSTER_TRACK_SECONDS 求められなければ追跡をやめる
+    - 新しい対話ログは save_learning_log から受け取り、CLUSTER_UPDATE_INTERVAL ごとにまとめて反映する
+      （発言が増えた学生のベクトルだけで MiniBatchKMeans を partial_fit し、全員のクラスタを付け直す）
+    - 他のインスタンスで書かれたログも取り込むため、CLUSTER_RELOAD_SECONDS ごとにログを読み直して学習し直す
+    """
+
+    def __init__(self, update_interval=30, reload_seconds=600, track_seconds=3600):
+        self.update_interval = update_interval
+        self.reload_seconds = reload_seconds
+        self.track_seconds = track_seconds
+        self._jobs = {}
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stats = {'full_fits': 0, 'incremental_updates': 0, 'reloads': 0, 'errors': 0}
+
+    @staticmethod
+    def _new_job():
+        return {
+            'entries': {},          # log_id -> (timestamp, 学生のキー, 表示名, 発言)
+            'changed': set(),       # 前回の計算後に発言が増えた学生
+            'model': None,
+            'snapshot': None,
+            'pending': True,        # 計算に反映していない変更がある（成功するまで立てたまま）
+            'revision': 0,          # 発言を取り込むたびに増やす
+            'error': None,          # 直近の計算の失敗（成功したら消す）
+            'loaded_at': None,
+            'computed_at': None,
+            'failed_at': None,
+            'last_requested': time.time()
+        }
+
+    def snapshot(self, key):
+        """key = (日付, クラス番号, 単元, 段階) の最新の結果を返す（なければ計算を依頼して pending を返す）"""
+        with self._condition:
+            self._ensure_worker_locked()
+            job = self._jobs.get(key)
+            if job is None:
+                job = self._jobs[key] = self._new_job()
+                self._condition.notify()
+            job['last_requested'] = time.time()
+            snapshot = job['snapshot']
+            if job['error'] is not None:
+                # 前回の結果があれば一緒に返す（古い結果であることは age_seconds で分かる）
+                result = dict(snapshot or {}, status='error', error=job['error'])
+                if snapshot is not None:
+                    result['age_seconds'] = round(time.time() - job['computed_at'], 1)
+                return result
+            if snapshot is None:
+                return {'status': 'pending'}
+            return dict(snapshot, status='ready', updating=job['pending'],
+                        age_seconds=round(time.time() - job['computed_at'], 1))
+
+    def notify(self, log_entry):
+        """保存された対話ログを、追跡中の組み合わせに取り込む"""
+        phase = next((p for p, log_type in CLUSTER_PHASES.items() if log_type == log_entry.get('log_type')), None)
+        message = (log_entry.get('data') or {}).get('user_message')
+        if phase is None or not message:
+            return
+        date = log_entry['timestamp'][:10].replace('-', '')
+        with self._condition:
+            for class_num in (log_entry.get('class_num'), None):
+                job = self._jobs.get((date, class_num, log_entry.get('unit'), phase))
+                if job is not None and log_entry['log_id'] not in job['entries']:
+                    student, label = _log_student_key(log_entry)
+                    job['entries'][log_entry['log_id']] = (log_entry['timestamp'], student, label, message)
+                    job['changed'].add(student)
+                    job['revision'] += 1
+                    job['pending'] = True
+
+    def _ensure_worker_locked(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='CLUSTER_WORKER', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait(timeout=self.update_interval)
+                now = time.time()
+                for key in [k for k, job in self._jobs.items() if now - job['last_requested'] > self.track_seconds]:
+                    del self._jobs[key]
+                due = []
+                for key, job in self._jobs.items():
+                    reload = job['loaded_at'] is None or now - job['loaded_at'] > self.reload_seconds
+                    recent = job['computed_at'] is not None and now - job['computed_at'] < self.update_interval
+                    # 失敗した組み合わせは update_interval の間をあけて再試行する
+                    failed_recently = job['failed_at'] is not None and now - job['failed_at'] < self.update_interval
+                    if (job['pending'] or reload) and not (recent and job['snapshot'] is not None) and not failed_recently:
+                        due.append((key, job, reload))
+            for key, job, reload in due:
+                try:
+                    self._update(key, job, reload)
+                except Exception as e:
+                    self._stats['errors'] += 1
+                    print(f"[CLUSTER] Update error {key}: {type(e).__name__}: {e}")
+                    with self._condition:
+                        job['error'] = f"{type(e).__name__}: {str(e)[:200]}"
+                        job['failed_at'] = time.time()
+
+    def _update(self, key, job, reload):
+        date, class_num, unit, phase = key
+        if reload:
+            logs = load_learning_logs(date, class_num=class_num, unit=unit, log_type=CLUSTER_PHASES[phase])
+            with self._condition:
+                for log in logs:
+                    message = (log.get('data') or {}).get('user_message')
+                    log_id = log.get('log_id') or f"{log.get('timestamp')}_{log.get('student_number')}"
+                    if message and log_id not in job['entries']:
+                        student, label = _log_student_key(log)
+                        job['entries'][log_id] = (log.get('timestamp', ''), student, label, message)
+                job['model'] = None
+                job['loaded_at'] = time.time()
+            self._stats['reloads'] += 1
+
+        # pending と changed は計算が成功してから下ろす（失敗したら次の周期でやり直す）
+        with self._condition:
+            revision = job['revision']
+            changed = set(job['changed'])
+            # 学生はクラスと出席番号で分ける（クラスを指定しない場合に、別のクラスの同じ番号をまとめない）
+            student_messages, student_labels = {}, {}
+            for _, student, label, message in sorted(job['entries'].values(), key=lambda entry: entry[0]):
+                student_messages.setdefault(student, []).append(message)
+                student_labels[student] = label
+
+        student_ids = list(student_messages)
+        student_texts = [' '.join(student_messages[sid]) for sid in student_ids]
+        snapshot = {'student_count': len(student_ids), 'clusters': []}
+        if len(student_ids) == 1:
+            snapshot['clusters'] = [{'cluster_id': 0, 'students': student_ids, 'student_count': 1,
+                                     'student_labels': [student_labels[student_ids[0]]],
+                                     'sample_text': student_texts[0][:200]}]
+        elif student_ids:
+            snapshot['clusters'], snapshot['mode'] = self._cluster(job, student_ids, student_texts, changed)
+            for cluster in snapshot['clusters']:
+                cluster['student_labels'] = [student_labels[sid] for sid in cluster['students']]
+
+        snapshot['computed_at'] = datetime.now().isoformat()
+        with self._condition:
+            job['snapshot'] = snapshot
+            job['computed_at'] = time.time()
+            job['changed'] -= changed
+            job['pending'] = job['revision'] != revision
+            job['error'] = None
+            job['failed_at'] = None
+        print(f"[CLUSTER] {key}: {len(student_ids)} students, {len(snapshot['clusters'])} clusters ({snapshot.get('mode', '-')})")
+
+    def _cluster(self, job, student_ids, student_texts, changed):
+        import numpy as np
+        from sklearn.cluster import MiniBatchKMeans
+
+        embeddings = get_embeddings(student_texts)
+        n_clusters = _cluster_count(len(student_ids))
+        model = job['model']
+        if model is None or model.n_clusters != n_clusters:
+            model = MiniBatchKMeans(n_clusters=n_clusters, random_state=42, n_init=3, batch_size=256)
+            model.fit(embeddings)
+            job['model'] = model
+            mode = 'full'
+            self._stats['full_fits'] += 1
+        else:
+            rows = [i for i, sid in enumerate(student_ids) if sid in changed]
+            if rows:
+                model.partial_fit(embeddings[rows])
+            mode = 'incremental'
+            self._stats['incremental_updates'] += 1
+
+        labels = model.predict(embeddings)
+        distances = model.transform(embeddings)
+        clusters = []
+        for cid in sorted(set(labels.tolist())):
+            members = np.flatnonzero(labels == cid)
+            # 代表の発言はクラスタの中心に最も近い学生のもの
+            representative = members[np.argmin(distances[members, cid])]
+            clusters.append({
+                'cluster_id': cid,
+                'students': [student_ids[i] for i in members],
+                'student_count': len(members),
+                'sample_text': student_texts[representative][:200]
+            })
+        return clusters, mode
+
+    def stats(self):
+        with self._condition:
+            return dict(self._stats, tracked=len(self._jobs),
+                        pending=sum(1 for job in self._jobs.values() if job['pending']),
+                        failing=sum(1 for job in self._jobs.values() if job['error'] is not None))
+
+cluster_service = ClusterService(update_interval=CLUSTER_UPDATE_INTERVAL, reload_seconds=CLUSTER_RELOAD_SECONDS,
+                                 track_seconds=CLUSTER_TRACK_SECONDS)
+
 def parse_student_info(student_number):
     """生徒番号からクラスと出席番号を取得
     
@@ -1061,6 +3665,116 @@ def api_test():
             'message': f'API接続テスト失敗: {str(e)}'
         }), 500
 
+# ヘルスチェック（結果はTTLの間キャッシュし、全リクエストで共有する）
+HEALTH_CHECK_TTL = int(os.getenv('HEALTH_CHECK_TTL', '30'))
+HEALTH_CHECK_FAILURE_TTL = 5
+HEALTH_CHECK_TIMEOUT = 5
+
+class CachedProbe:
+    """外部サービスの疎通確認結果をキャッシュする
+
+    キャッシュ切れの際は最初のリクエストだけが確認を行い、同時に来た他のリクエストはその結果を使う。
+    """
+
+    def __init__(self, name, check, ttl=30, failure_ttl=5):
+        self.name = name
+        self.check = check
+        self.ttl = ttl
+        self.failure_ttl = failure_ttl
+        self._lock = threading.Lock()
+        self._result = None
+        self._expires_at = 0
+
+    def get(self):
+        if self._result is not None and time.time() < self._expires_at:
+            return self._result
+        with self._lock:
+            if self._result is not None and time.time() < self._expires_at:
+                return self._result
+            start_time = time.time()
+            try:
+                self.check()
+                result = {'ok': True}
+            except Exception as e:
+                print(f"[HEALTH] {self.name} check failed: {type(e).__name__}: {str(e)[:100]}")
+                result = {'ok': False, 'error': type(e).__name__}
+            result['latency_ms'] = int((time.time() - start_time) * 1000)
+            result['checked_at'] = datetime.now().isoformat()
+            self._result = result
+            self._expires_at = time.time() + (self.ttl if result['ok'] else self.failure_ttl)
+            return result
+
+def _check_openai():
+    """モデル情報の取得でOpenAI APIへの疎通を確認する（補完は実行しない）"""
+    if client is None:
+        raise RuntimeError('OpenAI client is not initialized')
+    client.models.retrieve('gpt-4o-mini', timeout=HEALTH_CHECK_TIMEOUT)
+
+def _check_gcs():
+    """オブジェクト一覧を1件だけ取得してバケットへの疎通を確認する"""
+    next(iter(bucket.list_blobs(max_results=1, timeout=HEALTH_CHECK_TIMEOUT)), None)
+
+openai_probe = CachedProbe('openai', _check_openai, ttl=HEALTH_CHECK_TTL, failure_ttl=HEALTH_CHECK_FAILURE_TTL)
+gcs_probe = CachedProbe('gcs', _check_gcs, ttl=HEALTH_CHECK_TTL, failure_ttl=HEALTH_CHECK_FAILURE_TTL)
+
+# 起動時の接続ウォームアップ（最初の児童のリクエストが接続の確立を待たないようにする）
+HTTP_WARMUP = os.getenv('HTTP_WARMUP', 'true').lower() == 'true'
+
+async def _awarm_openai():
+    async with llm_gateway.slot():
+        await _get_async_client().models.retrieve(MODEL_ROUTES['dialogue']['model'], timeout=HEALTH_CHECK_TIMEOUT)
+
+def warm_up_connections():
+    """OpenAI（同期・非同期クライアント）と GCS への接続を先に確立しておく"""
+    start_time = time.time()
+    results = {}
+    if client is not None:
+        results['openai'] = openai_probe.get()['ok']
+        try:
+            llm_gateway.call(_awarm_openai, timeout=HEALTH_CHECK_TIMEOUT + 1)
+            results['openai_async'] = True
+        except Exception as e:
+            print(f"[WARMUP] openai_async failed: {type(e).__name__}")
+            results['openai_async'] = False
+    if USE_GCS and bucket:
+        results['gcs'] = gcs_probe.get()['ok']
+    print(f"[WARMUP] {results} ({int((time.time() - start_time) * 1000)}ms)")
+
+def _gcs_pool_stats():
+    """GCS 用接続プールの接続数とリクエスト数（urllib3 のプールごとの集計を合計）"""
+    if _gcs_http_adapter is None:
+        return None
+    stats = {'pool_size': HTTP_POOL_SIZE, 'requests': 0, 'connections_opened': 0}
+    pools = _gcs_http_adapter.poolmanager.pools
+    for key in list(pools.keys()):
+        pool = pools.get(key)
+        if pool is not None:
+            stats['requests'] += pool.num_requests
+            stats['connections_opened'] += pool.num_connections
+    if stats['requests']:
+        stats['reuse_rate'] = round(1 - stats['connections_opened'] / stats['requests'], 3)
+    return stats
+
+if HTTP_WARMUP:
+    threading.Thread(target=warm_up_connections, name='HTTP_WARMUP', daemon=True).start()
+
+@app.route('/healthz')
+def healthz():
+    """生存確認（外部サービスには接続しない）"""
+    return jsonify({'status': 'ok'})
+
+@app.route('/readyz')
+def readyz():
+    """準備完了確認（OpenAI・GCSへの疎通をキャッシュ付きで確認）"""
+    checks = {'openai': openai_probe.get()}
+    if USE_GCS and bucket:
+        checks['gcs'] = gcs_probe.get()
+    ready = all(check['ok'] for check in checks.values())
+    return jsonify({
+        'status': 'ready' if ready else 'unavailable',
+        'checks': checks
+    }), 200 if ready else 503
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -1099,8 +3813,9 @@ def select_unit():
     
     # 各単元の進行状況をチェック
     unit_progress = {}
+    progress_by_unit = get_progress_for_units(class_number, student_number, UNITS)
     for unit in UNITS:
-        progress = get_student_progress(class_number, student_number, unit)
+        progress = progress_by_unit[unit]
         needs_resumption = check_resumption_needed(class_number, student_number, unit)
         stage_progress = progress.get('stage_progress', {})
         
@@ -1185,7 +3900,7 @@ def prediction():
         
         # まとめが完了している場合は保存されたまとめを復元
         if prediction_summary_created and not session.get('prediction_summary'):
-            logs = load_learning_logs(datetime.now().strftime('%Y%m%d'))
+            logs = load_learning_logs(datetime.now().strftime('%Y%m%d'), unit=unit, log_type='prediction_summary')
             for log in logs:
                 if (log.get('student_number') == student_number and 
                     log.get('unit') == unit and 
@@ -1217,87 +3932,688 @@ def prediction():
         conversation_history = [{'role': 'assistant', 'content': initial_ai_message}]
         session['conversation'] = conversation_history
     
-    return render_template('prediction.html', unit=unit, task_content=task_content, 
-                         prediction_summary_created=prediction_summary_created, 
-                         initial_ai_message=initial_ai_message,
-                         conversation_history=conversation_history)
+    return render_template('prediction.html', unit=unit, task_content=task_content, 
+                         prediction_summary_created=prediction_summary_created, 
+                         initial_ai_message=initial_ai_message,
+                         conversation_history=conversation_history)
+
+# 会話コンテキストのトークン予算
+# 予算を超えたら直近の発言だけをそのまま残し、それより前は要約して送る
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', '8000'))
+CONTEXT_KEEP_MESSAGES = int(os.getenv('CONTEXT_KEEP_MESSAGES', '8'))
+
+try:
+    import tiktoken
+    _token_encoding = tiktoken.get_encoding('o200k_base')
+except Exception:
+    _token_encoding = None
+
+@lru_cache(maxsize=512)
+def count_tokens(text):
+    """テキストのトークン数を数える（tiktoken がない場合は文字種から概算）"""
+    if not text:
+        return 0
+    if _token_encoding is not None:
+        return len(_token_encoding.encode(text))
+    # 英数字は4文字で約1トークン、かな・漢字は o200k_base で平均して約0.7トークン、その他の文字は1トークンとみなす
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    cjk_chars = sum(1 for ch in text if '\u3040' <= ch <= '\u30ff' or '\u4e00' <= ch <= '\u9fff')
+    return (ascii_chars + 3) // 4 + (cjk_chars * 7 + 9) // 10 + (len(text) - ascii_chars - cjk_chars)
+
+def count_message_tokens(messages):
+    """メッセージリストのトークン数（1件ごとの書式分として4トークンを加算）"""
+    return sum(count_tokens(msg.get('content') or '') + 4 for msg in messages)
+
+class ConversationWindow:
+    """トークン予算内に収まるように対話履歴を組み立てる
+
+    システムプロンプトと直近 keep_messages 件の発言はそのまま送り、
+    予算を超えた場合はそれより前の発言を要約（ローリングサマリー）に置き換える。
+    要約はゲートウェイで優先度を下げて作り、リクエストは待たせない。
+    できあがるまでは前回の要約と、予算に収まるだけの直近の発言を送る
+    （まとめの生成では児童の発言を落とさず、予算を超えてもそのまま送る）。
+    できあがった要約は次のリクエストでセッションに保存し、以降は新しく古くなった発言だけを追加で要約する。
+    """
+
+    FOLD_TTL = 600  # 取りに来られないまま残っている要約を捨てるまでの秒数
+
+    def __init__(self, token_budget=6000, keep_messages=8):
+        self.token_budget = token_budget
+        self.keep_messages = keep_messages
+        self._lock = threading.Lock()
+        self._folds = {}  # (児童ID, 単元, state_key) -> 作成中・作成済みの要約
+        self._stats = {'requests': 0, 'folds': 0, 'fold_failures': 0, 'truncated': 0,
+                       'prompt_tokens_total': 0, 'prompt_tokens_max': 0}
+
+    @staticmethod
+    def _turns_hash(turns):
+        payload = json.dumps([[msg.get('role'), msg.get('content')] for msg in turns], ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def build(self, system_content, conversation, state_key, trailing=(), context=(), drop_oldest=True):
+        """送信するメッセージリストを作成する
+
+        Args:
+            system_content: システムプロンプト
+            conversation: 対話履歴（role/content の辞書のリスト）
+            state_key: ローリングサマリーを保存するセッションのキー
+            trailing: 対話履歴の後ろに付けるメッセージ（まとめの指示など）
+            context: システムプロンプトの直後に付ける児童ごとの情報（予想など）
+            drop_oldest: 要約ができるまで、予算を超えた古い発言を落とすか（まとめでは False）
+
+        Returns:
+            (messages, prompt_stats)
+        """
+        # 先頭は児童によらず同じ内容にして、プロンプトキャッシュが効くようにする
+        head = [{"role": "system", "content": system_content}] + list(context)
+        turns = [{"role": msg['role'], "content": msg['content']} for msg in conversation]
+        tail = list(trailing)
+        fixed_tokens = count_message_tokens(head) + count_message_tokens(tail)
+        owner = (f"{session.get('class_number')}_{session.get('student_number')}", session.get('unit'), state_key)
+
+        # 保存済みの要約は、要約した範囲の発言が変わっていない場合だけ使う
+        state = session.get(state_key) or {}
+        folded = state.get('count', 0)
+        digest = state.get('summary', '')
+        if folded and (folded > len(turns) or state.get('hash') != self._turns_hash(turns[:folded])):
+            folded, digest = 0, ''
+
+        # バックグラウンドでできあがった要約があれば取り込む
+        finished = self._take_fold(owner, turns)
+        if finished and finished['count'] > folded:
+            folded, digest = finished['count'], finished['summary']
+            session[state_key] = {'count': folded, 'summary': digest, 'hash': finished['hash']}
+
+        def total_tokens(start):
+            return fixed_tokens + count_message_tokens(self._digest_messages(digest)) + count_message_tokens(turns[start:])
+
+        start = folded
+        if total_tokens(start) > self.token_budget and len(turns) - folded > self.keep_messages:
+            fold_until = len(turns) - self.keep_messages
+            self._schedule_fold(owner, digest, turns[folded:fold_until], fold_until,
+                                self._turns_hash(turns[:fold_until]))
+            # 要約ができるまでは、予算に収まるところまで古い発言を落として送る
+            while drop_oldest and total_tokens(start) > self.token_budget and start < fold_until:
+                start += 1
+            if start > folded:
+                with self._lock:
+                    self._stats['truncated'] += 1
+
+        messages = head + self._digest_messages(digest) + turns[start:] + tail
+        prompt_stats = {
+            'prompt_tokens': count_message_tokens(messages),
+            'messages': len(messages),
+            'folded_messages': folded,
+            'dropped_messages': start - folded,
+            'token_budget': self.token_budget
+        }
+        with self._lock:
+            self._stats['requests'] += 1
+            self._stats['prompt_tokens_total'] += prompt_stats['prompt_tokens']
+            self._stats['prompt_tokens_max'] = max(self._stats['prompt_tokens_max'], prompt_stats['prompt_tokens'])
+        if has_request_context():
+            g.prompt_stats = prompt_stats
+        print(f"[CONTEXT] {state_key}: {prompt_stats['prompt_tokens']} tokens, "
+              f"{prompt_stats['messages']} messages, {folded} folded, {start - folded} dropped")
+        return messages, prompt_stats
+
+    @staticmethod
+    def _digest_messages(digest):
+        if not digest:
+            return []
+        return [{"role": "system", "content": f"## これまでの対話の要約（前半）\n{digest}"}]
+
+    def _take_fold(self, owner, turns):
+        """できあがった要約のうち、今の対話履歴に使えるものを取り出す（なければ None）"""
+        with self._lock:
+            entry = self._folds.get(owner)
+            if entry is None or not entry['future'].done():
+                return None
+            del self._folds[owner]
+        if entry['count'] > len(turns) or entry['hash'] != self._turns_hash(turns[:entry['count']]):
+            return None
+        try:
+            result = entry['future'].result()
+        except BaseException as e:
+            result = None
+            print(f"[CONTEXT] Fold error: {type(e).__name__}")
+        with self._lock:
+            if result and not _is_openai_error_message(result):
+                self._stats['folds'] += 1
+                return {'count': entry['count'], 'summary': result.strip(), 'hash': entry['hash']}
+            self._stats['fold_failures'] += 1
+        return None
+
+    def _schedule_fold(self, owner, digest, turns, count, turns_hash):
+        """既存の要約に古くなった発言を加えた新しい要約の作成を始める（同じ児童の作成中があれば何もしない）"""
+        transcript = '\n'.join(
+            f"{'児童' if msg['role'] == 'user' else 'AI'}: {msg['content']}" for msg in turns
+        )
+        prompt = [
+            {"role": "system", "content": "あなたは小学生と理科学習支援AIの対話記録を整理する係です。"
+                                          "児童の発言は言葉づかいと順序をできるだけそのまま残し、AIの発言は要点だけにして、"
+                                          "箇条書きで簡潔にまとめてください。記録にない内容は追加しないでください。"},
+            {"role": "user", "content": f"【これまでの要約】\n{digest or 'なし'}\n\n【追加する対話】\n{transcript}"}
+        ]
+        with self._lock:
+            now = time.time()
+            for key in [k for k, e in self._folds.items() if now - e['created'] > self.FOLD_TTL]:
+                self._folds.pop(key)['future'].cancel()
+            entry = self._folds.get(owner)
+            if entry and (not entry['future'].done() or entry['hash'] == turns_hash):
+                return
+            future = llm_gateway.submit(_acall_openai_with_retry, prompt, 1, 2, None, None,
+                                        owner[0], PRIORITY_BACKGROUND, None, call_type='context_fold')
+            self._folds[owner] = {'future': future, 'count': count, 'hash': turns_hash, 'created': now}
+        print(f"[CONTEXT] Fold scheduled - {owner[0]} ({owner[2]}, {count} messages)")
+
+    def stats(self):
+        with self._lock:
+            requests_count = self._stats['requests']
+            return dict(self._stats,
+                        prompt_tokens_avg=round(self._stats['prompt_tokens_total'] / requests_count) if requests_count else 0,
+                        folds_pending=sum(1 for e in self._folds.values() if not e['future'].done()),
+                        token_budget=self.token_budget, keep_messages=self.keep_messages)
+
+conversation_window = ConversationWindow(token_budget=CONTEXT_TOKEN_BUDGET, keep_messages=CONTEXT_KEEP_MESSAGES)
+
+@app.after_request
+def _add_prompt_stats_header(response):
+    """このリクエストでモデルに送ったプロンプトのトークン数とレート制限の待ち時間をヘッダーで返す"""
+    prompt_stats = g.get('prompt_stats')
+    if prompt_stats:
+        response.headers['X-Prompt-Tokens'] = str(prompt_stats['prompt_tokens'])
+    if g.get('queue_wait_ms') is not None:
+        response.headers['X-Queue-Wait-Ms'] = str(g.queue_wait_ms)
+    return response
+
+def _build_prediction_messages(unit, conversation):
+    """予想段階の対話用メッセージを作成"""
+    # 単元ごとのプロンプトを読み込み
+    unit_prompt = load_unit_prompt(unit)
+    
+    # 対話履歴を含めてプロンプト作成（予算を超えた古い発言は要約に置き換える）
+    # 初期メッセージは既に conversation に含まれているので、そのまま渡す
+    # 会話が進むので、先回りして生成していたまとめは使えなくなる
+    speculative_summaries.invalidate(_speculation_slot('prediction'))
+    
+    messages, _ = conversation_window.build(unit_prompt, conversation, 'prediction_context')
+    return messages
+
+def _complete_prediction_turn(conversation, unit, user_message, ai_response, delivery=None):
+    """予想段階のAI応答を会話に追加・保存し、クライアントへ返す内容を作成"""
+    # JSON形式のレスポンスの場合は解析して純粋なメッセージを抽出
+    ai_message = extract_message_from_json_response(ai_response)
+    
+    # 予想・考察段階ではマークダウン除去をスキップ（MDファイルのプロンプトに従う）
+    # ai_message = remove_markdown_formatting(ai_message)
+    
+    conversation.append({'role': 'assistant', 'content': ai_message})
+    session['conversation'] = conversation
+    
+    # セッションをDBに保存（ブラウザ閉鎖後の復帰対応）
+    student_id = f"{session.get('class_number')}_{session.get('student_number')}"
+    save_session_to_db(student_id, unit, 'prediction', conversation, background=True)
+    
+    # 学習ログを保存
+    save_learning_log(
+        student_number=session.get('student_number'),
+        unit=unit,
+        log_type='prediction_chat',
+        data={
+            'user_message': user_message,
+            'ai_response': ai_message,
+            **({'delivery': delivery} if delivery else {})
+        },
+        class_number=session.get('class_number'),
+        background=True
+    )
+    
+    # 対話が2回以上あれば、予想のまとめを作成可能
+    # user + AI で最低2セット（2往復）= 4メッセージ以上必要
+    # ただし、実際のユーザーとの往復回数をカウント(AIの初期メッセージは除外)
+    user_messages_count = sum(1 for msg in conversation if msg['role'] == 'user')
+    suggest_summary = user_messages_count >= 2  # ユーザーメッセージが2回以上
+    
+    if suggest_summary:
+        _speculate_summary('prediction', unit, conversation)
+    
+    response_data = {
+        'response': ai_message,
+        'suggest_summary': suggest_summary
+    }
+    if delivery:
+        response_data['delivery'] = delivery
+    return response_data
+
+# 受付制御（インスタンスごとの同時処理数の上限）
+# 上限を超えたリクエストは短時間だけ待たせ、それでも空かなければ 429 と Retry-After を返す
+ADMISSION_MAX_CONCURRENT = int(os.getenv('ADMISSION_MAX_CONCURRENT', '20'))
+ADMISSION_MAX_WAITING = int(os.getenv('ADMISSION_MAX_WAITING', '8'))
+ADMISSION_WAIT_SECONDS = float(os.getenv('ADMISSION_WAIT_SECONDS', '5'))
+
+class AdmissionController:
+    """同時に処理するリクエスト数を制限し、待ち行列があふれたら受付を断る"""
+
+    def __init__(self, max_concurrent=20, max_waiting=8, wait_seconds=5):
+        self.max_concurrent = max_concurrent
+        self.max_waiting = max_waiting
+        self.wait_seconds = wait_seconds
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._waiting = 0
+        self._avg_service_seconds = 5.0
+        self._stats = {'admitted': 0, 'queued': 0, 'rejected': 0}
+
+    def try_acquire(self):
+        """処理枠を確保できたら True（待ち行列が満杯か、待っても空かなければ False）"""
+        with self._condition:
+            if self._in_flight >= self.max_concurrent:
+                if self._waiting >= self.max_waiting:
+                    self._stats['rejected'] += 1
+                    return False
+                self._waiting += 1
+                self._stats['queued'] += 1
+                try:
+                    admitted = self._condition.wait_for(
+                        lambda: self._in_flight < self.max_concurrent, timeout=self.wait_seconds)
+                finally:
+                    self._waiting -= 1
+                if not admitted:
+                    self._stats['rejected'] += 1
+                    return False
+            self._in_flight += 1
+            self._stats['admitted'] += 1
+            return True
+
+    def release(self, service_seconds):
+        with self._condition:
+            self._in_flight -= 1
+            self._avg_service_seconds = self._avg_service_seconds * 0.9 + service_seconds * 0.1
+            self._condition.notify()
+
+    def retry_after(self):
+        """空きが出るまでのおおよその秒数"""
+        with self._condition:
+            queued = self._waiting + 1
+            return max(1, math.ceil(self._avg_service_seconds * queued / self.max_concurrent))
+
+    def stats(self):
+        with self._condition:
+            return dict(self._stats, in_flight=self._in_flight, waiting=self._waiting,
+                        max_concurrent=self.max_concurrent, max_waiting=self.max_waiting,
+                        avg_service_seconds=round(self._avg_service_seconds, 2))
+
+admission_controller = AdmissionController(max_concurrent=ADMISSION_MAX_CONCURRENT,
+                                           max_waiting=ADMISSION_MAX_WAITING,
+                                           wait_seconds=ADMISSION_WAIT_SECONDS)
+
+def admission_controlled(f):
+    """AIを呼び出すエンドポイントに受付制御をかけるデコレータ
+
+    ストリーミング応答の場合は、送信が終わるまで処理枠を保持する。
+    """
+    def decorated_function(*args, **kwargs):
+        if not admission_controller.try_acquire():
+            retry_after = admission_controller.retry_after()
+            print(f"[ADMISSION] Rejected {request.endpoint}: retry after {retry_after}s")
+            response = jsonify({
+                'error': 'ただいま混み合っています。少し待ってからもう一度送ります。',
+                'retry_after': retry_after
+            })
+            response.status_code = 429
+            response.headers['Retry-After'] = str(retry_after)
+            return response
+        
+        start_time = time.time()
+        released = False
+        
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                admission_controller.release(time.time() - start_time)
+        
+        try:
+            response = app.make_response(f(*args, **kwargs))
+        except Exception:
+            release()
+            raise
+        if response.is_streamed:
+            response.call_on_close(release)
+        else:
+            release()
+        return response
+    decorated_function.__name__ = f.__name__
+    return decorated_function
+
+# 応答が遅いとき・障害時の縮退
+# 期限内にAIが応答できなければ、prompts/fallback_questions.json の問いかけをすぐに返して対話を止めない
+DIALOGUE_DEADLINE_SECONDS = float(os.getenv('DIALOGUE_DEADLINE_SECONDS', '12'))
+DIALOGUE_LATE_REPLY = os.getenv('DIALOGUE_LATE_REPLY', 'false').lower() == 'true'
+# 問いかけで代替してよいエラー（API側の障害・混雑によるもの）
+DEGRADABLE_MESSAGES = (OPENAI_MESSAGE_UNAVAILABLE, OPENAI_MESSAGE_NETWORK, OPENAI_MESSAGE_RATE_LIMIT)
+
+class LateReplyStore:
+    """期限後に届いたAIの応答を、児童の画面が取りに来るまで保持する
+
+    応答は、代わりの問いかけを返した時点の会話の長さ・もとの児童の発言と一緒に保存し、
+    その後に児童が発言していない場合だけ渡す。
+    """
+
+    def __init__(self, max_entries=500):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, key, conversation_length, text, user_message):
+        with self._lock:
+            self._entries[key] = (conversation_length, text, user_message)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, conversation_length):
+        """(応答, もとの児童の発言) を返す（渡せるものがなければ None）"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry or entry[0] != conversation_length:
+                return None
+            del self._entries[key]
+            return entry[1], entry[2]
+
+late_replies = LateReplyStore()
+_degradation_stats = {'deadline_exceeded': 0, 'error_fallbacks': 0, 'late_replies_stored': 0, 'late_replies_delivered': 0}
+
+def _dialogue_key(stage):
+    return (f"{session.get('class_number')}_{session.get('student_number')}", session.get('unit'), stage)
+
+def _late_reply_callback(stage, conversation):
+    """期限後に届いた応答を保存するコールバック（DIALOGUE_LATE_REPLY が無効なら None）"""
+    if not DIALOGUE_LATE_REPLY:
+        return None
+    key = _dialogue_key(stage)
+    # 代わりの問いかけを会話に追加した後の長さ
+    conversation_length = len(conversation) + 1
+    user_message = conversation[-1]['content'] if conversation and conversation[-1]['role'] == 'user' else None
+    
+    def store(text):
+        late_replies.put(key, conversation_length, text, user_message)
+        _degradation_stats['late_replies_stored'] += 1
+    return store
+
+def _degrade_dialogue_reply(ai_response, unit, stage, conversation):
+    """AIの応答が得られなかった場合に代わりの問いかけを選ぶ
+
+    Args:
+        ai_response: AIの応答（期限切れの場合は None）
+
+    Returns:
+        (返す文章, delivery) delivery は代わりの問いかけの場合 'fallback'、それ以外は None
+    """
+    if ai_response is None:
+        _degradation_stats['deadline_exceeded'] += 1
+        reason = 'deadline'
+    elif ai_response in DEGRADABLE_MESSAGES:
+        _degradation_stats['error_fallbacks'] += 1
+        reason = 'error'
+    else:
+        return ai_response, None
+    turn_count = sum(1 for msg in conversation if msg['role'] == 'user')
+    print(f"[DEGRADE] {stage}: {reason} -> fallback question (turn {turn_count})")
+    return get_fallback_question(unit, stage, turn_count), 'fallback'
+
+def _call_dialogue(messages, unit, stage, conversation):
+    """対話の応答を期限付きで取得する（間に合わなければ代わりの問いかけ）
+
+    Returns:
+        (返す文章, delivery, 後から応答が届く可能性があるか)
+    """
+    try:
+        ai_response = call_openai_with_retry(messages, unit=unit, stage=stage,
+                                             deadline_seconds=DIALOGUE_DEADLINE_SECONDS,
+                                             on_late_reply=_late_reply_callback(stage, conversation))
+    except DeadlineExceeded:
+        ai_response = None
+    text, delivery = _degrade_dialogue_reply(ai_response, unit, stage, conversation)
+    return text, delivery, ai_response is None and DIALOGUE_LATE_REPLY
+
+# 対話ターンの重複送信対策
+# 画面はターンごとに (client_id, seq) を送り、再送では同じ値を使う
+TURN_DEDUP_TTL = int(os.getenv('TURN_DEDUP_TTL', '300'))
+TURN_DEDUP_RETRY_AFTER = int(os.getenv('TURN_DEDUP_RETRY_AFTER', '2'))
+
+class TurnDeduplicator:
+    """同じターンの再送にはAIを呼び直さず、最初のリクエストの応答を返す
+
+    ターンは (児童ID, 単元, 段階, client_id, seq) で識別し、発言内容も一致する場合だけ同じターンとみなす。
+    処理中に届いた再送は待たせずに 409 を返し、画面に少し後で送り直してもらう（処理枠を使ったまま待たない）。
+    完了した応答は TTL 秒だけ保持する。エラーになったターンは保持せず、再送で再実行する。
+    """
+
+    def __init__(self, ttl=300, max_entries=5000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'turns': 0, 'replayed': 0, 'coalesced': 0}
+
+    def begin(self, key, message):
+        """(最初のリクエストかどうか, 応答を受け取る Future) を返す"""
+        now = time.time()
+        with self._lock:
+            while self._entries:
+                oldest = next(iter(self._entries.values()))
+                if now - oldest['created'] <= self.ttl and len(self._entries) <= self.max_entries:
+                    break
+                self._entries.popitem(last=False)
+            entry = self._entries.get(key)
+            if entry and entry['message'] == message:
+                future = entry['future']
+                self._stats['replayed' if future.done() else 'coalesced'] += 1
+                return False, future
+            future = Future()
+            self._entries[key] = {'message': message, 'future': future, 'created': now}
+            self._entries.move_to_end(key)
+            self._stats['turns'] += 1
+            return True, future
+
+    def finish(self, key, future, response_data, keep=True):
+        """最初のリクエストの応答を、待っている再送に渡す（keep=False なら保持しない）"""
+        if future.done():
+            return
+        if not keep:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry and entry['future'] is future:
+                    del self._entries[key]
+        future.set_result(response_data)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries))
+
+turn_deduplicator = TurnDeduplicator(ttl=TURN_DEDUP_TTL)
+DIALOGUE_ERROR_RESPONSE = {'error': 'AI接続エラーが発生しました。しばらく待ってから再度お試しください。'}
+
+def _begin_chat_turn(stage, user_message):
+    """ターンの重複を確認し、(キー, 最初のリクエストかどうか, Future) を返す
+
+    ターン番号を送らない古い画面からのリクエストは重複確認をしない（キーは None）。
+    """
+    data = request.get_json(silent=True) or {}
+    seq = data.get('seq')
+    if seq is None:
+        return None, True, None
+    key = _dialogue_key(stage) + (str(data.get('client_id', ''))[:64], str(seq)[:32])
+    leader, future = turn_deduplicator.begin(key, user_message)
+    if not leader:
+        print(f"[TURN] Duplicate submit - {key[0]} {stage} seq={seq}")
+    return key, leader, future
+
+def _finish_chat_turn(key, future, response_data):
+    if key is not None:
+        turn_deduplicator.finish(key, future, response_data, keep='error' not in response_data)
+
+def _replayed_turn_response(future, stream=False):
+    """同じターンの最初のリクエストの応答を返す
+
+    まだ処理中なら 409 と Retry-After を返す。画面は同じ client_id・seq で送り直し、完了後の応答を受け取る。
+    """
+    if not future.done():
+        response = jsonify({
+            'error': '前の送信を処理しています。少し待ってからもう一度送ります。',
+            'in_progress': True,
+            'retry_after': TURN_DEDUP_RETRY_AFTER
+        })
+        response.status_code = 409
+        response.headers['Retry-After'] = str(TURN_DEDUP_RETRY_AFTER)
+        return response
+    response_data = future.result()
+    if 'error' not in response_data:
+        response_data = dict(response_data, replayed=True)
+    if stream:
+        # 応答全体を1回の done / error イベントで返す
+        return _sse_response(iter([_sse_event('error' if 'error' in response_data else 'done', response_data)]))
+    return jsonify(response_data), (500 if 'error' in response_data else 200)
+
+@app.route('/chat/late_reply', methods=['GET'])
+def chat_late_reply():
+    """代わりの問いかけを返した後に届いたAIの応答を受け取り、会話の代わりの問いかけと置き換える"""
+    stage = request.args.get('stage', 'prediction')
+    if stage not in ('prediction', 'reflection'):
+        return jsonify({'error': 'stage が不正です'}), 400
+    conversation_key = 'conversation' if stage == 'prediction' else 'reflection_conversation'
+    conversation = session.get(conversation_key, [])
+    late_reply = late_replies.pop(_dialogue_key(stage), len(conversation))
+    if late_reply is None or not conversation or conversation[-1]['role'] != 'assistant':
+        return jsonify({'response': None})
+    text, user_message = late_reply
+    _degradation_stats['late_replies_delivered'] += 1
+    
+    # 代わりの問いかけを届いた応答で置き換える（AIの発言が2つ続かないようにする）
+    unit = session.get('unit')
+    ai_message = extract_message_from_json_response(text)
+    fallback_message = conversation[-1]['content']
+    conversation[-1] = {'role': 'assistant', 'content': ai_message}
+    session[conversation_key] = conversation
+    student_id = f"{session.get('class_number')}_{session.get('student_number')}"
+    save_session_to_db(student_id, unit, stage, conversation, background=True)
+    
+    # 対話ログ（*_chat）とは別の種別で、もとの発言と置き換えた問いかけを残す
+    save_learning_log(
+        student_number=session.get('student_number'),
+        unit=unit,
+        log_type=f'{stage}_late_reply',
+        data={
+            'user_message': user_message,
+            'ai_response': ai_message,
+            'replaced_fallback': fallback_message
+        },
+        class_number=session.get('class_number'),
+        background=True
+    )
+    
+    suggest_summary = sum(1 for msg in conversation if msg['role'] == 'user') >= 2
+    if suggest_summary:
+        _speculate_summary(stage, unit, conversation)
+    return jsonify({'response': ai_message, 'suggest_summary': suggest_summary,
+                    'delivery': 'late', 'replaces_fallback': True})
 
 @app.route('/chat', methods=['POST'])
+@admission_controlled
 def chat():
     user_message = request.json.get('message')
     input_metadata = request.json.get('metadata', {})
     
+    # 同じターンの再送・二重送信には最初の応答を返す
+    turn_key, leader, turn_future = _begin_chat_turn('prediction', user_message)
+    if not leader:
+        return _replayed_turn_response(turn_future)
+    
     conversation = session.get('conversation', [])
     unit = session.get('unit')
-    task_content = session.get('task_content')
-    student_number = session.get('student_number')
     
     # 対話履歴に追加
     conversation.append({'role': 'user', 'content': user_message})
     
-    # 単元ごとのプロンプトを読み込み
-    unit_prompt = load_unit_prompt(unit)
-    
-    # 対話履歴を含めてプロンプト作成
-    # OpenAI APIに送信するためにメッセージ形式で構築
-    messages = [
-        {"role": "system", "content": unit_prompt}
-    ]
-    
-    # 対話履歴をメッセージフォーマットで追加
-    # 初期メッセージは既に conversation に含まれているので、そのまま追加
-    for msg in conversation:
-        messages.append({
-            "role": msg['role'],
-            "content": msg['content']
-        })
-    
     try:
-        ai_response = call_openai_with_retry(messages, unit=unit, stage='prediction', enable_cache=True)
-        
-        # JSON形式のレスポンスの場合は解析して純粋なメッセージを抽出
-        ai_message = extract_message_from_json_response(ai_response)
-        
-        # 予想・考察段階ではマークダウン除去をスキップ（MDファイルのプロンプトに従う）
-        # ai_message = remove_markdown_formatting(ai_message)
-        
-        conversation.append({'role': 'assistant', 'content': ai_message})
-        session['conversation'] = conversation
-        
-        # セッションをDBに保存（ブラウザ閉鎖後の復帰対応）
-        student_id = f"{session.get('class_number')}_{session.get('student_number')}"
-        save_session_to_db(student_id, unit, 'prediction', conversation)
-        
-        # 学習ログを保存
-        save_learning_log(
-            student_number=session.get('student_number'),
-            unit=unit,
-            log_type='prediction_chat',
-            data={
-                'user_message': user_message,
-                'ai_response': ai_message
-            },
-            class_number=session.get('class_number')
-        )
-        
-        # 対話が2回以上あれば、予想のまとめを作成可能
-        # user + AI で最低2セット（2往復）= 4メッセージ以上必要
-        # ただし、実際のユーザーとの往復回数をカウント(AIの初期メッセージは除外)
-        user_messages_count = sum(1 for msg in conversation if msg['role'] == 'user')
-        suggest_summary = user_messages_count >= 2  # ユーザーメッセージが2回以上
-        
-        response_data = {
-            'response': ai_message,
-            'suggest_summary': suggest_summary
-        }
-        
+        messages = _build_prediction_messages(unit, conversation)
+        ai_response, delivery, late_reply_pending = _call_dialogue(messages, unit, 'prediction', conversation)
+        response_data = _complete_prediction_turn(conversation, unit, user_message, ai_response, delivery=delivery)
+        response_data['late_reply_pending'] = late_reply_pending
+        _finish_chat_turn(turn_key, turn_future, response_data)
         return jsonify(response_data)
         
     except Exception as e:
         import traceback
         traceback.print_exc()
+        _finish_chat_turn(turn_key, turn_future, DIALOGUE_ERROR_RESPONSE)
         return jsonify({'error': f'AI接続エラーが発生しました。しばらく待ってから再度お試しください。'}), 500
 
+@app.route('/chat/stream', methods=['POST'])
+@admission_controlled
+def chat_stream():
+    """/chat のストリーミング版（Server-Sent Events）
+    
+    event: delta → {"text": 受信した文字列}
+    event: done  → /chat と同じ内容（response は JSON 抽出後の最終テキスト）
+    event: error → {"error": メッセージ}
+    """
+    user_message = request.json.get('message')
+    
+    # 同じターンの再送・二重送信には最初の応答を返す
+    turn_key, leader, turn_future = _begin_chat_turn('prediction', user_message)
+    if not leader:
+        return _replayed_turn_response(turn_future, stream=True)
+    
+    conversation = session.get('conversation', [])
+    unit = session.get('unit')
+    
+    conversation.append({'role': 'user', 'content': user_message})
+    
+    def generate():
+        chunks = []
+        report = {}
+        try:
+            messages = _build_prediction_messages(unit, conversation)
+            try:
+                for delta in stream_openai_with_retry(messages, unit=unit, stage='prediction', report=report,
+                                                      first_token_deadline=DIALOGUE_DEADLINE_SECONDS,
+                                                      on_late_reply=_late_reply_callback('prediction', conversation)):
+                    chunks.append(delta)
+                    yield _sse_event('delta', {'text': delta})
+                ai_response = ''.join(chunks)
+            except DeadlineExceeded:
+                ai_response = None
+            except OpenAIStreamError as e:
+                if e.message not in DEGRADABLE_MESSAGES:
+                    # 設定の問題などは代わりの問いかけにせず、エラーとして返す
+                    yield _sse_event('error', {'error': e.message})
+                    return
+                ai_response = e.message
+            late_reply_pending = ai_response is None and DIALOGUE_LATE_REPLY
+            ai_response, delivery = _degrade_dialogue_reply(ai_response, unit, 'prediction', conversation)
+            response_data = _complete_prediction_turn(conversation, unit, user_message, ai_response, delivery=delivery)
+            response_data['late_reply_pending'] = late_reply_pending
+            response_data['queue_wait_ms'] = report.get('queue_wait_ms', 0)
+            # レスポンスヘッダー送信後のため、セッションはここで直接保存する
+            app.session_interface.save_session_now(session)
+            _finish_chat_turn(turn_key, turn_future, response_data)
+            yield _sse_event('done', response_data)
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            yield _sse_event('error', {'error': 'AI接続エラーが発生しました。しばらく待ってから再度お試しください。'})
+        finally:
+            # 途中で接続が切れた場合も、待っている再送を解放する
+            _finish_chat_turn(turn_key, turn_future, DIALOGUE_ERROR_RESPONSE)
+    
+    response = _sse_response(generate())
+    # 最初の読み出し前に接続が切れると generate() の finally は実行されないため、閉じる時にも解放する
+    response.call_on_close(lambda: _finish_chat_turn(turn_key, turn_future, DIALOGUE_ERROR_RESPONSE))
+    return response
+
 @app.route('/report_error', methods=['POST'])
 def report_error():
     """児童からのエラー報告を受け取る"""
@@ -1331,7 +4647,330 @@ def report_error():
         print(f"[ERROR_REPORT] Error: {str(e)}")
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+# まとめ生成結果のキャッシュ
+SUMMARY_CACHE_MAX_ENTRIES = int(os.getenv('SUMMARY_CACHE_MAX_ENTRIES', '1000'))
+
+# call_openai_with_retry がエラー時に返す定型文の書き出し（キャッシュしない）
+OPENAI_ERROR_PREFIXES = (
+    'AI システムの初期化に問題があります',
+    'APIキーの設定に問題があります',
+    'API利用制限に達しました',
+    'ネットワーク接続に問題があります',
+    'リクエストの形式に問題があります',
+    'APIの利用権限に問題があります',
+    '予期しないエラーが発生しました',
+    '複数回の試行後もAPIに接続できませんでした',
+)
+
+def _is_openai_error_message(text):
+    return isinstance(text, str) and text.startswith(OPENAI_ERROR_PREFIXES)
+
+class SummaryCache:
+    """生成したまとめを入力内容のハッシュで保存するキャッシュ
+
+    同じ入力（学習者・単元・段階・会話・予想）に対する再送は保存済みの結果を返し、
+    生成中に届いた同じ入力のリクエストは進行中の生成結果を待って受け取る。
+    メモリ上のLRUに加え、STORAGE_BACKEND=sqlite の場合はSQLiteにも保存してワーカー間で共有する。
+    """
+
+    def __init__(self, max_entries=1000, storage=None):
+        self.max_entries = max_entries
+        self.storage = storage
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'coalesced': 0}
+
+    @staticmethod
+    def make_key(*parts):
+        payload = json.dumps(parts, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _get_locked(self, key):
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+            return value
+        if self.storage:
+            try:
+                value = self.storage.load_cached_summary(key)
+            except Exception as e:
+                print(f"[SUMMARY_CACHE] Load error: {e}")
+                value = None
+            if value is not None:
+                self._remember_locked(key, value)
+        return value
+
+    def _remember_locked(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            value = self._get_locked(key)
+            if value is not None:
+                self._stats['hits'] += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._remember_locked(key, value)
+        if self.storage:
+            try:
+                self.storage.save_cached_summary(key, value)
+            except Exception as e:
+                print(f"[SUMMARY_CACHE] Save error: {e}")
+
+    def get_or_create(self, key, create, aliases=()):
+        """key に対応するまとめを返す。なければ create() で生成する
+
+        生成結果がエラーの定型文の場合はキャッシュしない。
+        aliases（冪等キーなど）にも同じ結果を保存する。
+
+        Returns:
+            (まとめ, 今回生成したかどうか)
+        """
+        with self._lock:
+            value = self._get_locked(key)
+            if value is not None:
+                self._stats['hits'] += 1
+                return value, False
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._inflight[key] = future
+                self._stats['misses'] += 1
+            else:
+                self._stats['coalesced'] += 1
+
+        if not leader:
+            return future.result(), False
+
+        try:
+            value = create()
+            if not _is_openai_error_message(value):
+                for cache_key in (key, *aliases):
+                    self.put(cache_key, value)
+            future.set_result(value)
+            return value, True
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries), in_flight=len(self._inflight))
+
+summary_cache = SummaryCache(max_entries=SUMMARY_CACHE_MAX_ENTRIES, storage=sqlite_storage)
+
+def _summary_cache_keys(stage, conversation, prediction_summary=''):
+    """まとめのキャッシュキーと、クライアントの冪等キーに対応する別名を返す"""
+    student_id = f"{session.get('class_number')}_{session.get('student_number')}"
+    unit = session.get('unit')
+    turns = [[msg.get('role'), msg.get('content')] for msg in conversation]
+    cache_key = SummaryCache.make_key('summary', student_id, unit, stage, turns, prediction_summary)
+    idempotency_key = request.headers.get('Idempotency-Key') or (request.get_json(silent=True) or {}).get('idempotency_key')
+    aliases = ()
+    if idempotency_key:
+        aliases = (SummaryCache.make_key('idempotency', student_id, unit, stage, str(idempotency_key)[:200]),)
+    return cache_key, aliases
+
+def _prediction_summary_messages(unit, conversation):
+    """予想のまとめを作成するためのメッセージを構築"""
+    # 単元のプロンプトを読み込み（要約の指示は既にプロンプトファイルに含まれている）
+    unit_prompt = load_unit_prompt(unit)
+    
+    # メッセージフォーマットで構築（対話履歴のあとに要約を促すメッセージを付ける）
+    messages, _ = conversation_window.build(
+        unit_prompt + "\n\n【重要】以下の会話内容のみをもとに、児童の話した言葉や順序を活かして、予想をまとめてください。会話に含まれていない内容は追加しないでください。",
+        conversation,
+        'prediction_context',
+        trailing=[{
+            "role": "user",
+            "content": "これまでの話をもとに、予想をまとめてください。児童の話した順序と言葉を活かし、口語を自然な書き言葉に整えてください。会話に含まれていない内容は追加しないでください。"
+        }],
+        # まとめでは児童の最初の発言も落とさない
+        drop_oldest=False
+    )
+    return messages
+
+def _final_summary_messages(unit, reflection_conversation, prediction_summary):
+    """考察のまとめを作成するためのメッセージを構築"""
+    # 単元のプロンプトを読み込み（考察の指示は既にプロンプトファイルに含まれている）
+    unit_prompt = load_unit_prompt(unit)
+    
+    # メッセージフォーマットで構築（対話履歴のあとに考察作成を促すメッセージを付ける）
+    messages, _ = conversation_window.build(
+        unit_prompt + "\n\n【重要】以下の会話内容のみをもとに、児童の話した言葉や考えを活かして、考察をまとめてください。会話に含まれていない内容は追加しないでください。",
+        reflection_conversation,
+        'reflection_context',
+        trailing=[{
+            "role": "user",
+            "content": f"""これまでの話と以下の予想をもとに、考察をまとめてください。児童の思考過程と対話内容を尊重しながら、文章で表現してください。会話に含まれていない内容は追加しないでください。
+
+【作成した予想】
+{prediction_summary}"""
+        }],
+        drop_oldest=False
+    )
+    return messages
+
+# まとめの投機的生成（会話がまとめ可能になった時点で先回りして生成しておく）
+SPECULATIVE_SUMMARY = os.getenv('SPECULATIVE_SUMMARY', 'false').lower() == 'true'
+SPECULATIVE_SUMMARY_TTL = int(os.getenv('SPECULATIVE_SUMMARY_TTL', '1800'))
+# 最後の発言から生成を始めるまでの秒数（この間に次の発言があれば API を呼ばずに取り消す）
+SPECULATIVE_SUMMARY_DELAY = float(os.getenv('SPECULATIVE_SUMMARY_DELAY', '15'))
+# まとめを求められたとき、生成中の結果を待つ最大秒数（超えたら通常どおり生成する）
+SPECULATIVE_SUMMARY_GRACE = float(os.getenv('SPECULATIVE_SUMMARY_GRACE', '3'))
+
+async def _aspeculate(delay, state, *args, **kwargs):
+    """delay 秒待ってから _acall_openai_with_retry を呼ぶ（待っている間に取り消されれば呼ばない）"""
+    await asyncio.sleep(delay)
+    state['started'] = True
+    return await _acall_openai_with_retry(*args, **kwargs)
+
+class SpeculativeSummaries:
+    """まとめを先回りして生成し、児童がまとめを求めたときに使えるようにしておく
+
+    生成は児童・単元・段階ごとに1件だけ持ち、会話の内容（まとめのキャッシュキー）と結びつける。
+    会話が進んだら古い生成は取り消し、キーが一致しない結果は使わない。
+    生成は最後の発言から delay 秒たってから始め（その前に次の発言があれば API は呼ばない）、
+    バックグラウンド優先度で行って対話の応答より後回しにする。
+    """
+
+    def __init__(self, enabled=False, ttl=1800, delay=15, grace=3):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.delay = delay
+        self.grace = grace
+        self._slots = {}
+        self._lock = threading.Lock()
+        self._stats = {'scheduled': 0, 'hits': 0, 'waited': 0, 'misses': 0, 'invalidated': 0,
+                       'debounced': 0, 'failed': 0, 'grace_expired': 0}
+
+    def schedule(self, slot, key, messages, call_type, student_id):
+        """slot のまとめ生成を開始する（同じ key で生成済み・生成中なら何もしない）"""
+        if not self.enabled or client is None:
+            return
+        with self._lock:
+            entry = self._slots.get(slot)
+            if entry and entry['key'] == key:
+                return
+            self._discard_locked(slot)
+            self._prune_locked()
+            state = {'started': False}
+            future = llm_gateway.submit(_aspeculate, self.delay, state, messages, 3, 2, None, None,
+                                        student_id, PRIORITY_BACKGROUND, None, call_type=call_type)
+            self._slots[slot] = {'key': key, 'future': future, 'state': state, 'created': time.time()}
+            self._stats['scheduled'] += 1
+        print(f"[SPECULATIVE] Scheduled {call_type} - {slot[0]} ({slot[2]})")
+
+    def invalidate(self, slot):
+        """会話が進んだときに、その児童・段階の生成を取り消す"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._discard_locked(slot)
+
+    def take(self, slot, key):
+        """key に一致する生成結果を取り出す。使えなければ None
+
+        生成中なら grace 秒だけ待つ。まだ始まっていない場合や間に合わない場合は取り消し、
+        呼び出し側が通常どおり生成する（待ち時間が長くなりすぎないようにする）。
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._slots.get(slot)
+            if entry is None or entry['key'] != key or time.time() - entry['created'] > self.ttl:
+                self._stats['misses'] += 1
+                return None
+            del self._slots[slot]
+            future = entry['future']
+            if not future.done():
+                if not entry['state']['started']:
+                    future.cancel()
+                    self._stats['misses'] += 1
+                    return None
+                self._stats['waited'] += 1
+        try:
+            text = future.result(self.grace)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            print(f"[SPECULATIVE] Not ready within {self.grace}s - {slot[0]} ({slot[2]})")
+            with self._lock:
+                self._stats['grace_expired'] += 1
+            return None
+        except Exception as e:
+            future.cancel()
+            print(f"[SPECULATIVE] Unusable result: {type(e).__name__}")
+            text = None
+        with self._lock:
+            if text is None or _is_openai_error_message(text):
+                self._stats['failed'] += 1
+                return None
+            self._stats['hits'] += 1
+        return text
+
+    def _discard_locked(self, slot):
+        entry = self._slots.pop(slot, None)
+        if entry:
+            entry['future'].cancel()
+            if entry['state']['started']:
+                self._stats['invalidated'] += 1
+            else:
+                self._stats['debounced'] += 1
+
+    def _prune_locked(self):
+        now = time.time()
+        for slot in [s for s, e in self._slots.items() if now - e['created'] > self.ttl]:
+            self._slots.pop(slot)['future'].cancel()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, enabled=self.enabled, pending=len(self._slots))
+
+speculative_summaries = SpeculativeSummaries(enabled=SPECULATIVE_SUMMARY, ttl=SPECULATIVE_SUMMARY_TTL,
+                                             delay=SPECULATIVE_SUMMARY_DELAY, grace=SPECULATIVE_SUMMARY_GRACE)
+
+def _speculation_slot(stage):
+    return (f"{session.get('class_number')}_{session.get('student_number')}", session.get('unit'), stage)
+
+def _speculate_summary(stage, unit, conversation):
+    """まとめ可能になった会話について、まとめの生成を先に始めておく"""
+    if not speculative_summaries.enabled:
+        return
+    if stage == 'prediction' and session.get('prediction_summary'):
+        return
+    # /summary・/final_summary が受け付けない短い会話は生成しない
+    user_content = ' '.join(msg.get('content') or '' for msg in conversation if msg['role'] == 'user')
+    if len(user_content) < 10:
+        return
+    try:
+        # 生成済みのまとめがある会話は、メッセージを組み立てずに終える
+        prediction_summary = session.get('prediction_summary', '') if stage == 'reflection' else ''
+        cache_key, _ = _summary_cache_keys(stage, conversation, prediction_summary)
+        if summary_cache.get(cache_key) is not None:
+            return
+        if stage == 'prediction':
+            messages = _prediction_summary_messages(unit, conversation)
+            call_type = 'summary'
+        else:
+            messages = _final_summary_messages(unit, conversation, prediction_summary)
+            call_type = 'final_summary'
+        slot = _speculation_slot(stage)
+        speculative_summaries.schedule(slot, cache_key, messages, call_type, slot[0])
+    except Exception as e:
+        print(f"[SPECULATIVE] Schedule error: {e}")
+
 @app.route('/summary', methods=['POST'])
+@admission_controlled
 def summary():
     conversation = session.get('conversation', [])
     unit = session.get('unit')
@@ -1341,6 +4980,14 @@ def summary():
         print(f"[SUMMARY] Already created: {session.get('prediction_summary')[:50]}...")
         return jsonify({'summary': session.get('prediction_summary')})
     
+    # 同じ冪等キーで生成済みならそのまま返す（再送・二重クリック対策）
+    cache_key, idempotency_aliases = _summary_cache_keys('prediction', conversation)
+    for alias in idempotency_aliases:
+        cached_summary = summary_cache.get(alias)
+        if cached_summary is not None:
+            session['prediction_summary'] = cached_summary
+            return jsonify({'summary': cached_summary, 'cached': True})
+    
     # ユーザーの発言をチェック（初期メッセージを除く）
     user_messages = [msg for msg in conversation if msg['role'] == 'user']
     
@@ -1375,40 +5022,24 @@ def summary():
             'is_insufficient': True
         }), 400
     
-    # 単元のプロンプトを読み込み（要約の指示は既にプロンプトファイルに含まれている）
-    unit_prompt = load_unit_prompt(unit)
-    
-    # メッセージフォーマットで構築
-    messages = [
-        {"role": "system", "content": unit_prompt + "\n\n【重要】以下の会話内容のみをもとに、児童の話した言葉や順序を活かして、予想をまとめてください。会話に含まれていない内容は追加しないでください。"}
-    ]
-    
-    # 対話履歴をメッセージフォーマットで追加
-    for msg in conversation:
-        messages.append({
-            "role": msg['role'],
-            "content": msg['content']
-        })
-    
-    # 最後に要約を促すメッセージを追加
-    messages.append({
-        "role": "user",
-        "content": "これまでの話をもとに、予想をまとめてください。児童の話した順序と言葉を活かし、口語を自然な書き言葉に整えてください。会話に含まれていない内容は追加しないでください。"
-    })
-    
-    try:
-        summary_response = call_openai_with_retry(messages, model_override="gpt-4o-mini", enable_cache=True)
+    class_number = session.get('class_number')
+    student_number = session.get('student_number')
+    speculation_slot = _speculation_slot('prediction')
+    
+    def generate_summary():
+        # 先回りして生成済みのまとめがあればそれを使う（同じ会話内容の場合のみ）
+        summary_response = speculative_summaries.take(speculation_slot, cache_key)
+        if summary_response is None:
+            # メッセージ（古い発言の要約を含む）はキャッシュにない場合だけ組み立てる
+            messages = _prediction_summary_messages(unit, conversation)
+            summary_response = call_openai_with_retry(messages, call_type='summary')
+        else:
+            print(f"[SUMMARY] Served from speculative generation - {class_number}_{student_number}")
         
         # JSON形式のレスポンスの場合は解析して純粋なメッセージを抽出
         summary_text = extract_message_from_json_response(summary_response)
         
-        # セッションに保存してから、フラグとログを更新
-        session['prediction_summary'] = summary_text
-        session.modified = True
-        
         # 予想まとめを永続ストレージに保存（セッション切れ対策）
-        class_number = session.get('class_number')
-        student_number = session.get('student_number')
         student_id = f"{class_number}_{student_number}"
         _save_summary_to_db(student_id, unit, 'prediction', summary_text)
         
@@ -1433,8 +5064,16 @@ def summary():
             },
             class_number=class_number
         )
+        return summary_text
+    
+    try:
+        # 同じ会話内容のまとめは一度だけ生成する（生成中の同じリクエストはその結果を待つ）
+        summary_text, created = summary_cache.get_or_create(cache_key, generate_summary, aliases=idempotency_aliases)
+        
+        session['prediction_summary'] = summary_text
+        session.modified = True
         
-        return jsonify({'summary': summary_text})
+        return jsonify({'summary': summary_text, 'cached': not created})
     except Exception as e:
         return jsonify({'error': f'まとめ生成中にエラーが発生しました。'}), 500
 
@@ -1518,7 +5157,6 @@ def _save_summary_local(summary_entry):
 def _save_summary_gcs(summary_entry):
     """サマリーをGCSに保存"""
     try:
-        from google.cloud import storage
         student_id = summary_entry['student_id']
         unit = summary_entry['unit']
         stage = summary_entry['stage']
@@ -1583,9 +5221,14 @@ def _save_summary_to_db(student_id, unit, stage, summary_text):
         print(f"[SUMMARY_SAVE] Local save failed: {e}")
 
 def _save_summary_local(student_id, unit, stage, summary_text):
-    """サマリーをローカルファイルに保存"""
+    """サマリーをローカル（SQLiteまたはJSONファイル）に保存"""
     try:
-        summary_file = 'summary_storage.json'
+        if sqlite_storage:
+            sqlite_storage.save_summary(student_id, unit, stage, summary_text)
+            print(f"[SUMMARY_SAVE_LOCAL] {student_id}_{unit}_{stage} saved to SQLite")
+            return
+        
+        summary_file = SUMMARY_STORAGE_FILE
         
         # 既存のファイルを読み込む
         if os.path.exists(summary_file):
@@ -1617,8 +5260,6 @@ def _save_summary_local(student_id, unit, stage, summary_text):
 def _save_summary_gcs(student_id, unit, stage, summary_text):
     """サマリーをGCSに保存"""
     try:
-        from google.cloud import storage
-        
         # GCSのパス: summaries/{student_id}/{unit}/{stage}_summary.json
         gcs_path = f"summaries/{student_id}/{unit}/{stage}_summary.json"
         blob = bucket.blob(gcs_path)
@@ -1652,9 +5293,12 @@ def _load_summary_from_db(student_id, unit, stage):
     return _load_summary_local(student_id, unit, stage)
 
 def _load_summary_local(student_id, unit, stage):
-    """サマリーをローカルファイルから取得"""
+    """サマリーをローカル（SQLiteまたはJSONファイル）から取得"""
     try:
-        summary_file = 'summary_storage.json'
+        if sqlite_storage:
+            return sqlite_storage.load_summary(student_id, unit, stage) or ''
+        
+        summary_file = SUMMARY_STORAGE_FILE
         if not os.path.exists(summary_file):
             return ''
         
@@ -1673,8 +5317,6 @@ def _load_summary_local(student_id, unit, stage):
 def _load_summary_gcs(student_id, unit, stage):
     """サマリーをGCSから取得"""
     try:
-        from google.cloud import storage
-        
         # GCSのパス: summaries/{student_id}/{unit}/{stage}_summary.json
         gcs_path = f"summaries/{student_id}/{unit}/{stage}_summary.json"
         blob = bucket.blob(gcs_path)
@@ -1769,7 +5411,7 @@ def reflection():
         
         # まとめが完了している場合は保存されたまとめを復元
         if reflection_summary_created and not session.get('reflection_summary'):
-            logs = load_learning_logs(datetime.now().strftime('%Y%m%d'))
+            logs = load_learning_logs(datetime.now().strftime('%Y%m%d'), unit=unit, log_type='final_summary')
             for log in logs:
                 if (log.get('student_number') == student_number and 
                     log.get('unit') == unit and 
@@ -1797,7 +5439,7 @@ def reflection():
         
         # まとめが完了している場合は保存されたまとめを復元
         if reflection_summary_created and not session.get('reflection_summary'):
-            logs = load_learning_logs(datetime.now().strftime('%Y%m%d'))
+            logs = load_learning_logs(datetime.now().strftime('%Y%m%d'), unit=unit, log_type='final_summary')
             for log in logs:
                 if (log.get('student_number') == student_number and 
                     log.get('unit') == unit and 
@@ -1838,9 +5480,84 @@ def reflection():
                          reflection_conversation_history=reflection_conversation_history,
                          reflection_resumption_info=resumption_info)
 
+def _build_reflection_messages(unit, prediction_summary, reflection_conversation):
+    """考察段階の対話用メッセージを作成"""
+    # プロンプトファイルからベースプロンプトを取得
+    unit_prompt = load_unit_prompt(unit)
+    
+    # 考察段階のシステムプロンプトを構築
+    # 全児童で共通の部分（考察のルール＋単元の指導内容）を先頭に置き、プロンプトキャッシュが効くようにする
+    reflection_system_prompt = build_reflection_system_prompt(unit_prompt)
+    
+    # 児童ごとの情報は共通部分のあとに置く
+    student_context = [{
+        "role": "system",
+        "content": f"## 児童の予想\n{prediction_summary or '予想がまだ記録されていません。'}"
+    }]
+    
+    # メッセージフォーマットで対話履歴を構築（予算を超えた古い発言は要約に置き換える）
+    # 会話が進むので、先回りして生成していた考察は使えなくなる
+    speculative_summaries.invalidate(_speculation_slot('reflection'))
+    
+    messages, _ = conversation_window.build(reflection_system_prompt, reflection_conversation, 'reflection_context',
+                                            context=student_context)
+    return messages
+
+def _complete_reflection_turn(reflection_conversation, unit, user_message, ai_response, delivery=None):
+    """考察段階のAI応答を会話に追加・保存し、クライアントへ返す内容を作成"""
+    # JSON形式のレスポンスの場合は解析して純粋なメッセージを抽出
+    ai_message = extract_message_from_json_response(ai_response)
+    
+    # 予想・考察段階ではマークダウン除去をスキップ（MDファイルのプロンプトに従う）
+    # ai_message = remove_markdown_formatting(ai_message)
+    
+    reflection_conversation.append({'role': 'assistant', 'content': ai_message})
+    session['reflection_conversation'] = reflection_conversation
+    
+    # セッションをDBに保存（ブラウザ閉鎖後の復帰対応）
+    student_id = f"{session.get('class_number')}_{session.get('student_number')}"
+    save_session_to_db(student_id, unit, 'reflection', reflection_conversation, background=True)
+    
+    # 考察チャットのログを保存
+    save_learning_log(
+        student_number=session.get('student_number'),
+        unit=unit,
+        log_type='reflection_chat',
+        data={
+            'user_message': user_message,
+            'ai_response': ai_message,
+            **({'delivery': delivery} if delivery else {})
+        },
+        class_number=session.get('class_number'),
+        background=True
+    )
+    
+    # 対話が2往復以上あれば、考察のまとめを作成可能
+    # ユーザーメッセージが2回以上必要
+    user_messages_count = sum(1 for msg in reflection_conversation if msg['role'] == 'user')
+    suggest_final_summary = user_messages_count >= 2
+    
+    if suggest_final_summary:
+        _speculate_summary('reflection', unit, reflection_conversation)
+    
+    response_data = {
+        'response': ai_message,
+        'suggest_final_summary': suggest_final_summary
+    }
+    if delivery:
+        response_data['delivery'] = delivery
+    return response_data
+
 @app.route('/reflect_chat', methods=['POST'])
+@admission_controlled
 def reflect_chat():
     user_message = request.json.get('message')
+    
+    # 同じターンの再送・二重送信には最初の応答を返す
+    turn_key, leader, turn_future = _begin_chat_turn('reflection', user_message)
+    if not leader:
+        return _replayed_turn_response(turn_future)
+    
     reflection_conversation = session.get('reflection_conversation', [])
     unit = session.get('unit')
     prediction_summary = session.get('prediction_summary', '')
@@ -1848,111 +5565,92 @@ def reflect_chat():
     # 反省対話履歴に追加
     reflection_conversation.append({'role': 'user', 'content': user_message})
     
-    # プロンプトファイルからベースプロンプトを取得
-    unit_prompt = load_unit_prompt(unit)
-    
-    # 考察段階のシステムプロンプトを構築
-    reflection_system_prompt = f"""
-あなたは小学4年生の理科学習を支援するAIアシスタントです。現在、児童が実験後の「考察段階」に入っています。
-
-## 重要な役割
-児童は実験を終え、その結果と自分の予想を比較しながら、「なぜそうなったのか」，日常生活や既習事項との関連を自分の言葉で考える段階です。
-
-## あなたが守ること（絶対ルール）
-1. **子どもの発言を最優先する**
-   - 子どもの話した内容をそのまま受け止める
-   - 「〜なんだね」「〜だったんだね」と整理する
-   - 子どもの表現を活かす
-
-2. **自然で短い対話を心がける**
-   - 1往復ごとに1つの応答を返す
-   - 一度に3つ以上の質問をしない
-   - やさしく、短く、日常的な言葉を使う
-
-3. **絶対にしてはいけないこと**
-   - 長文のまとめを途中で出さない
-   - 難しい専門用語を使わない
-   - 子どもの考えを否定しない
-   - 要約を勝手に出さない（子どもが「まとめボタン」を押すまで）
-
-## 対話の進め方
-1. 実験結果を聞く：「じっけんではどんなけっかになった？」
-2. 予想との簡単な確認：「さいしょの予そうと同じだった？」
-3. 子どもの考え・気づきを引き出す（ここが最重要）：「それってなぜだと思う？」「何か気づいたことってある？」
-4. 体験や観察の詳しさを引き出す：「そのときどんなようすだった？」
-5. 日常との結びつけ：「ふだんでも同じようなことってある？」
-
-## 単元の指導内容
-{unit_prompt}
-
-## 児童の予想
-{prediction_summary or '予想がまだ記録されていません。'}
-
-## 大事なこと
-- 子どもが何を考えたか、気づいたかを最優先に引き出す
-- 膜の変化（ふくらむ / 凹む）から体積の変化（大きくなる / 小さくなる）を自然に導く
-- 予想との比較は簡単な確認程度
-"""
-    
-    # メッセージフォーマットで対話履歴を構築
-    messages = [
-        {"role": "system", "content": reflection_system_prompt}
-    ]
-    
-    # 対話履歴をメッセージフォーマットで追加
-    for msg in reflection_conversation:
-        messages.append({
-            "role": msg['role'],
-            "content": msg['content']
-        })
-    
     try:
-        ai_response = call_openai_with_retry(messages, unit=unit, stage='reflection', enable_cache=True)
-        
-        # JSON形式のレスポンスの場合は解析して純粋なメッセージを抽出
-        ai_message = extract_message_from_json_response(ai_response)
-        
-        # 予想・考察段階ではマークダウン除去をスキップ（MDファイルのプロンプトに従う）
-        # ai_message = remove_markdown_formatting(ai_message)
-        
-        reflection_conversation.append({'role': 'assistant', 'content': ai_message})
-        session['reflection_conversation'] = reflection_conversation
-        
-        # セッションをDBに保存（ブラウザ閉鎖後の復帰対応）
-        student_id = f"{session.get('class_number')}_{session.get('student_number')}"
-        save_session_to_db(student_id, unit, 'reflection', reflection_conversation)
-        
-        # 考察チャットのログを保存
-        save_learning_log(
-            student_number=session.get('student_number'),
-            unit=unit,
-            log_type='reflection_chat',
-            data={
-                'user_message': user_message,
-                'ai_response': ai_message
-            },
-            class_number=session.get('class_number')
-        )
-        
-        # 対話が2往復以上あれば、考察のまとめを作成可能
-        # ユーザーメッセージが2回以上必要
-        user_messages_count = sum(1 for msg in reflection_conversation if msg['role'] == 'user')
-        suggest_final_summary = user_messages_count >= 2
-        
-        return jsonify({
-            'response': ai_message,
-            'suggest_final_summary': suggest_final_summary
-        })
+        messages = _build_reflection_messages(unit, prediction_summary, reflection_conversation)
+        ai_response, delivery, late_reply_pending = _call_dialogue(messages, unit, 'reflection', reflection_conversation)
+        response_data = _complete_reflection_turn(reflection_conversation, unit, user_message, ai_response,
+                                                  delivery=delivery)
+        response_data['late_reply_pending'] = late_reply_pending
+        _finish_chat_turn(turn_key, turn_future, response_data)
+        return jsonify(response_data)
         
     except Exception as e:
+        _finish_chat_turn(turn_key, turn_future, DIALOGUE_ERROR_RESPONSE)
         return jsonify({'error': f'AI接続エラーが発生しました。しばらく待ってから再度お試しください。'}), 500
 
+@app.route('/reflect_chat/stream', methods=['POST'])
+@admission_controlled
+def reflect_chat_stream():
+    """/reflect_chat のストリーミング版（Server-Sent Events、形式は /chat/stream と同じ）"""
+    user_message = request.json.get('message')
+    
+    # 同じターンの再送・二重送信には最初の応答を返す
+    turn_key, leader, turn_future = _begin_chat_turn('reflection', user_message)
+    if not leader:
+        return _replayed_turn_response(turn_future, stream=True)
+    
+    reflection_conversation = session.get('reflection_conversation', [])
+    unit = session.get('unit')
+    prediction_summary = session.get('prediction_summary', '')
+    
+    reflection_conversation.append({'role': 'user', 'content': user_message})
+    
+    def generate():
+        chunks = []
+        report = {}
+        try:
+            messages = _build_reflection_messages(unit, prediction_summary, reflection_conversation)
+            try:
+                for delta in stream_openai_with_retry(messages, unit=unit, stage='reflection', report=report,
+                                                      first_token_deadline=DIALOGUE_DEADLINE_SECONDS,
+                                                      on_late_reply=_late_reply_callback('reflection', reflection_conversation)):
+                    chunks.append(delta)
+                    yield _sse_event('delta', {'text': delta})
+                ai_response = ''.join(chunks)
+            except DeadlineExceeded:
+                ai_response = None
+            except OpenAIStreamError as e:
+                if e.message not in DEGRADABLE_MESSAGES:
+                    # 設定の問題などは代わりの問いかけにせず、エラーとして返す
+                    yield _sse_event('error', {'error': e.message})
+                    return
+                ai_response = e.message
+            late_reply_pending = ai_response is None and DIALOGUE_LATE_REPLY
+            ai_response, delivery = _degrade_dialogue_reply(ai_response, unit, 'reflection', reflection_conversation)
+            response_data = _complete_reflection_turn(reflection_conversation, unit, user_message, ai_response, delivery=delivery)
+            response_data['late_reply_pending'] = late_reply_pending
+            response_data['queue_wait_ms'] = report.get('queue_wait_ms', 0)
+            # レスポンスヘッダー送信後のため、セッションはここで直接保存する
+            app.session_interface.save_session_now(session)
+            _finish_chat_turn(turn_key, turn_future, response_data)
+            yield _sse_event('done', response_data)
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            yield _sse_event('error', {'error': 'AI接続エラーが発生しました。しばらく待ってから再度お試しください。'})
+        finally:
+            # 途中で接続が切れた場合も、待っている再送を解放する
+            _finish_chat_turn(turn_key, turn_future, DIALOGUE_ERROR_RESPONSE)
+    
+    response = _sse_response(generate())
+    # 最初の読み出し前に接続が切れると generate() の finally は実行されないため、閉じる時にも解放する
+    response.call_on_close(lambda: _finish_chat_turn(turn_key, turn_future, DIALOGUE_ERROR_RESPONSE))
+    return response
+
 @app.route('/final_summary', methods=['POST'])
+@admission_controlled
 def final_summary():
     reflection_conversation = session.get('reflection_conversation', [])
     prediction_summary = session.get('prediction_summary', '')
     unit = session.get('unit')
     
+    # 同じ冪等キーで生成済みならそのまま返す（再送・二重クリック対策）
+    cache_key, idempotency_aliases = _summary_cache_keys('reflection', reflection_conversation, prediction_summary)
+    for alias in idempotency_aliases:
+        cached_summary = summary_cache.get(alias)
+        if cached_summary is not None:
+            return jsonify({'summary': cached_summary, 'cached': True})
+    
     # ユーザーの発言をチェック（初期メッセージを除く）
     user_messages = [msg for msg in reflection_conversation if msg['role'] == 'user']
     
@@ -1987,32 +5685,19 @@ def final_summary():
             'is_insufficient': True
         }), 400
     
-    # 単元のプロンプトを読み込み（考察の指示は既にプロンプトファイルに含まれている）
-    unit_prompt = load_unit_prompt(unit)
-    
-    # メッセージフォーマットで構築
-    messages = [
-        {"role": "system", "content": unit_prompt + "\n\n【重要】以下の会話内容のみをもとに、児童の話した言葉や考えを活かして、考察をまとめてください。会話に含まれていない内容は追加しないでください。"}
-    ]
-    
-    # 対話履歴をメッセージフォーマットで追加
-    for msg in reflection_conversation:
-        messages.append({
-            "role": msg['role'],
-            "content": msg['content']
-        })
-    
-    # 最後に考察作成を促すメッセージを追加
-    messages.append({
-        "role": "user",
-        "content": f"""これまでの話と以下の予想をもとに、考察をまとめてください。児童の思考過程と対話内容を尊重しながら、文章で表現してください。会話に含まれていない内容は追加しないでください。
-
-【作成した予想】
-{prediction_summary}"""
-    })
-    
-    try:
-        final_summary_response = call_openai_with_retry(messages, model_override="gpt-4o-mini", enable_cache=True)
+    class_number = session.get('class_number')
+    student_number = session.get('student_number')
+    speculation_slot = _speculation_slot('reflection')
+    
+    def generate_final_summary():
+        # 先回りして生成済みの考察があればそれを使う（同じ会話内容・予想の場合のみ）
+        final_summary_response = speculative_summaries.take(speculation_slot, cache_key)
+        if final_summary_response is None:
+            # メッセージ（古い発言の要約を含む）はキャッシュにない場合だけ組み立てる
+            messages = _final_summary_messages(unit, reflection_conversation, prediction_summary)
+            final_summary_response = call_openai_with_retry(messages, call_type='final_summary')
+        else:
+            print(f"[FINAL_SUMMARY] Served from speculative generation - {class_number}_{student_number}")
         
         # JSON形式のレスポンスの場合は解析して純粋なメッセージを抽出
         final_summary_text = extract_message_from_json_response(final_summary_response)
@@ -2022,26 +5707,31 @@ def final_summary():
         
         # 考察完了フラグを設定
         update_student_progress(
-            class_number=session.get('class_number'),
-            student_number=session.get('student_number'),
-            unit=session.get('unit'),
+            class_number=class_number,
+            student_number=student_number,
+            unit=unit,
             reflection_summary_created=True
         )
         
         # 最終考察のログを保存
         save_learning_log(
-            student_number=session.get('student_number'),
-            unit=session.get('unit'),
+            student_number=student_number,
+            unit=unit,
             log_type='final_summary',
             data={
                 'final_summary': final_summary_text,
                 'prediction_summary': prediction_summary,
                 'reflection_conversation': reflection_conversation
             },
-            class_number=session.get('class_number')
+            class_number=class_number
         )
+        return final_summary_text
+    
+    try:
+        # 同じ会話内容の考察は一度だけ生成する（生成中の同じリクエストはその結果を待つ）
+        final_summary_text, created = summary_cache.get_or_create(cache_key, generate_final_summary, aliases=idempotency_aliases)
         
-        return jsonify({'summary': final_summary_text})
+        return jsonify({'summary': final_summary_text, 'cached': not created})
     except Exception as e:
         return jsonify({'error': f'最終まとめ生成中にエラーが発生しました。'}), 500
 
@@ -2060,7 +5750,7 @@ def get_prediction_summary():
         return jsonify({'summary': summary})
     
     # セッションにない場合は学習ログから取得を試みる
-    logs = load_learning_logs(datetime.now().strftime('%Y%m%d'))
+    logs = load_learning_logs(datetime.now().strftime('%Y%m%d'), unit=unit, log_type='prediction_summary')
     for log in logs:
         if (log.get('student_number') == student_number and 
             log.get('unit') == unit and 
@@ -2145,26 +5835,12 @@ def teacher_logs():
             class_filter_int = None
     student = request.args.get('student', '')
     
-    logs = load_learning_logs(date)
-    
-    # フィルタリング
-    if unit:
-        logs = [log for log in logs if log.get('unit') == unit]
-    
-    # クラスと出席番号でフィルター（両方を組み合わせる）
-    if class_filter_int is not None and student:
-        # クラスと出席番号の両方が指定された場合
-        logs = [log for log in logs 
-                if log.get('class_num') == class_filter_int 
-                and log.get('seat_num') == int(student)]
-    elif class_filter_int is not None:
-        # クラスのみ指定された場合
-        logs = [log for log in logs 
-                if log.get('class_num') == class_filter_int]
-    elif student:
-        # 出席番号のみ指定された場合（全クラスから該当番号を検索）
-        logs = [log for log in logs 
-                if log.get('seat_num') == int(student)]
+    # 単元・クラス・出席番号で絞り込んで読み込む（索引で該当するログだけを読む）
+    # 出席番号のみ指定された場合は全クラスから該当番号を検索
+    logs = load_learning_logs(date,
+                              class_num=class_filter_int,
+                              seat_num=int(student) if student else None,
+                              unit=unit or None)
     
     # 学生ごとにグループ化（クラスと出席番号の組み合わせで識別）
     students_data = {}
@@ -2227,6 +5903,83 @@ def teacher_logs():
                          available_dates=available_dates,
                          teacher_id=session.get('teacher_id'))
 
+@app.route('/teacher/api/metrics')
+@require_teacher_auth
+def teacher_metrics():
+    """サーバー内部の動作状況（キューの滞留など）を返す"""
+    return jsonify({
+        'persistence': persistence_queue.stats(),
+        'llm_gateway': llm_gateway.stats(),
+        'summary_cache': summary_cache.stats(),
+        'speculative_summary': speculative_summaries.stats(),
+        'turn_dedup': turn_deduplicator.stats(),
+        'startup': startup_timer.stats(),
+        'clusters': cluster_service.stats(),
+        'log_index': dict(_log_index_stats, cached_dates=len(_local_log_indexes) + len(_gcs_log_cache)),
+        'embedding_cache': dict(embedding_cache.stats(), api=dict(_embedding_api_stats)),
+        'http_transport': {
+            'pool_size': HTTP_POOL_SIZE,
+            'openai': openai_connections.stats(),
+            'openai_async': openai_async_connections.stats(),
+            'gcs': _gcs_pool_stats()
+        },
+        'context': conversation_window.stats(),
+        'prompt_cache': prompt_cache_stats.stats(),
+        'openai_circuit': openai_circuit.stats(),
+        'openai_retries': dict(_openai_retry_stats),
+        'rate_limiter': openai_rate_limiter.stats(),
+        'admission': admission_controller.stats(),
+        'degradation': dict(_degradation_stats, deadline_seconds=DIALOGUE_DEADLINE_SECONDS,
+                            late_reply=DIALOGUE_LATE_REPLY),
+        'model_routing': {
+            'routes': MODEL_ROUTES,
+            'fallback_model': MODEL_FALLBACK,
+            'fallbacks': _model_routing_stats['fallbacks'],
+            'calls': _model_routing_stats['calls'],
+            'latency': model_latency.stats()
+        }
+    })
+
+@app.route('/teacher/api/clusters')
+@require_teacher_auth
+def teacher_clusters():
+    """児童の考えのクラスタリング結果（計算済みの最新結果をすぐに返す）
+
+    クエリ: unit（必須）, date（YYYYMMDD、省略時は今日）, class, phase（prediction / reflection、省略時は両方）
+    まだ結果がない段階は status=pending となり、全体は 202 で返す。少し待ってから再取得する。
+    計算に失敗した段階は status=error（error に理由、前回の結果があれば一緒に返す）となり、全体は 500 で返す。
+    """
+    unit = request.args.get('unit', '')
+    if not unit:
+        return jsonify({'error': '単元を指定してください'}), 400
+    date = request.args.get('date', datetime.now().strftime('%Y%m%d'))
+    class_num = normalize_class_value_int(request.args.get('class'))
+    phase = request.args.get('phase')
+    phases = [phase] if phase in CLUSTER_PHASES else list(CLUSTER_PHASES)
+
+    results = {p: cluster_service.snapshot((date, class_num, unit, p)) for p in phases}
+    statuses = {result['status'] for result in results.values()}
+    status_code = 500 if 'error' in statuses else 202 if 'pending' in statuses else 200
+    return jsonify({'date': date, 'class': class_num, 'unit': unit, 'phases': results}), status_code
+
+@app.route('/teacher/api/reload_prompts', methods=['POST'])
+@require_teacher_auth
+def teacher_reload_prompts():
+    """プロンプト・課題文を読み込み直す（編集をすぐに反映したいとき）"""
+    changed = prompt_registry.refresh(force=request.args.get('force') == '1')
+    return jsonify({'status': 'success', 'changed': changed, 'registry': prompt_registry.stats()})
+
+@app.route('/teacher/api/compact_logs', methods=['POST'])
+@require_teacher_auth
+def teacher_compact_logs():
+    """GCS上の未統合ログを日次ファイルへ統合（授業後などに実行）"""
+    date = request.args.get('date', datetime.now().strftime('%Y%m%d'))
+    if not USE_GCS:
+        return jsonify({'status': 'skipped', 'message': 'ローカル環境では統合は不要です'})
+
+    merged_count = compact_gcs_learning_logs(date)
+    return jsonify({'status': 'success', 'date': date, 'merged': merged_count})
+
 @app.route('/teacher/export')
 @require_teacher_auth
 def teacher_export():
@@ -2271,6 +6024,8 @@ def teacher_export():
             content = f"Q: {log['data'].get('user_message', '')}\nA: {log['data'].get('ai_response', '')}"
         elif log.get('log_type') == 'final_summary':
             content = log['data'].get('final_summary', '')
+        elif log.get('log_type') in ('prediction_late_reply', 'reflection_late_reply'):
+            content = f"Q: {log['data'].get('user_message', '')}\nA（後から届いた応答）: {log['data'].get('ai_response', '')}"
         
         writer.writerow({
             'timestamp': log.get('timestamp', ''),
@@ -2398,20 +6153,13 @@ def student_detail():
     
     selected_date = request.args.get('date', default_date)
     
-    # 学習ログを読み込み
-    logs = load_learning_logs(selected_date)
-    
-    # 該当する学生のログを抽出（クラスと出席番号で絞り込み）
+    # 該当する学生のログを読み込み（索引でクラスと出席番号が一致するログだけを読む）
     student_logs = []
     if class_num and seat_num:
-        student_logs = [log for log in logs if 
-                        log.get('class_num') == class_num and 
-                        log.get('seat_num') == seat_num and 
-                        (not unit or log.get('unit') == unit)]
+        student_logs = load_learning_logs(selected_date, class_num=class_num, seat_num=seat_num, unit=unit or None)
     elif student_id:
-        student_logs = [log for log in logs if 
-                        str(log.get('student_number')) == str(student_id) and 
-                        (not unit or log.get('unit') == unit)]
+        student_logs = [log for log in load_learning_logs(selected_date, unit=unit or None) if 
+                        str(log.get('student_number')) == str(student_id)]
         if student_logs:
             class_num = student_logs[0].get('class_num') or class_num
             seat_num = student_logs[0].get('seat_num') or seat_num
@@ -2431,7 +6179,7 @@ def student_detail():
         flash(f'{student_display}のログがありません。日付や単元を変更してお試しください。', 'warning')
     
     # 単元一覧を取得（フィルター用）
-    all_units = list(set([log.get('unit') for log in logs if log.get('unit')]))
+    all_units = get_learning_log_units(selected_date)
     
     return render_template('teacher/student_detail.html',
                          class_num=class_num,
@@ -2494,6 +6242,19 @@ def serve_note_photos(path):
         return jsonify({'error': 'File not found'}), 404
 
 
+@app.cli.command('import-json-storage')
+def import_json_storage_command():
+    """session/summary/learning_progress の JSON ファイルを SQLite に取り込む
+
+    使い方: STORAGE_SQLITE_PATH=science_buddy.sqlite3 flask --app app import-json-storage
+    """
+    storage = sqlite_storage or SQLiteStorage(STORAGE_SQLITE_PATH)
+    counts = storage.import_json_files(SESSION_STORAGE_FILE, SUMMARY_STORAGE_FILE, LEARNING_PROGRESS_FILE)
+    print(f"[STORAGE] Imported into {storage.path}: {counts}")
+
+
+startup_timer.mark('ready')
+
 if __name__ == '__main__':
     # 環境変数からポート番号を取得（CloudRun用）
     port = int(os.environ.get('PORT', 5014))
@@ -0,0 +1,90 @@
+"""起動時間のベンチマーク（コールドスタートの悪化を検出する）
+
+`python -X importtime` で app.py を読み込み、起動にかかった時間と重い依存ライブラリの読み込みを確認する。
+予算を超えた場合や、遅延読み込みにしたライブラリが起動時に読み込まれた場合は終了コード 1 で終わる。
+
+使い方:
+    python scripts/check_startup_time.py [--budget-ms 2000] [--runs 3] [--top 15]
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# 教員用の分析などでしか使わないため、起動時には読み込まないライブラリ
+LAZY_MODULES = ['numpy', 'sklearn', 'google.cloud.storage']
+
+IMPORT_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+STARTUP_LINE = re.compile(r'^\[STARTUP\] (\S+): ([\d.]+)ms$')
+
+
+def measure():
+    """app.py を新しいプロセスで1回読み込み、(段階ごとの時間, 読み込んだモジュール) を返す"""
+    env = dict(os.environ, HTTP_WARMUP='false', PYTHONDONTWRITEBYTECODE='1')
+    # 本番用の GCS 初期化は行わない（ローカル構成の起動時間を測る）
+    env.pop('FLASK_ENV', None)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'],
+                            cwd=ROOT, env=env, capture_output=True, text=True, timeout=120)
+    if result.returncode != 0:
+        sys.stderr.write(result.stderr[-2000:])
+        raise SystemExit(f'app.py の読み込みに失敗しました (exit {result.returncode})')
+
+    phases = {}
+    for line in result.stdout.splitlines():
+        match = STARTUP_LINE.match(line.strip())
+        if match:
+            phases[match.group(1)] = float(match.group(2))
+
+    modules = {}
+    for line in result.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match:
+            modules[match.group(4)] = (int(match.group(2)) / 1000, len(match.group(3)))
+    return phases, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--budget-ms', type=float, default=float(os.getenv('STARTUP_BUDGET_MS', '2000')),
+                        help='起動時間の予算（ミリ秒、既定: 環境変数 STARTUP_BUDGET_MS または 2000）')
+    parser.add_argument('--runs', type=int, default=3, help='計測回数（最も速い回で判定する）')
+    parser.add_argument('--top', type=int, default=15, help='表示する時間のかかったモジュールの数')
+    args = parser.parse_args()
+
+    runs = [measure() for _ in range(args.runs)]
+    phases, modules = min(runs, key=lambda run: sum(run[0].values()))
+    total_ms = sum(phases.values())
+
+    print('起動処理の段階別時間:')
+    for phase, ms in phases.items():
+        print(f'  {phase:<16} {ms:>8.1f} ms')
+    print(f'  {"合計":<14} {total_ms:>8.1f} ms  (予算 {args.budget_ms:.0f} ms, {args.runs} 回中の最速)')
+
+    print(f'\n読み込みに時間のかかったモジュール（上位 {args.top} 件、app.py が直接読み込んだもの）:')
+    # -X importtime の出力は、読み込みの階層が1段深くなるごとに字下げが2文字増える
+    top_level = sorted(((ms, name) for name, (ms, depth) in modules.items() if depth == 3), reverse=True)
+    for ms, name in top_level[:args.top]:
+        print(f'  {ms:>8.1f} ms  {name}')
+
+    failures = []
+    if total_ms > args.budget_ms:
+        failures.append(f'起動時間 {total_ms:.1f} ms が予算 {args.budget_ms:.0f} ms を超えています')
+    for name in LAZY_MODULES:
+        if name in modules:
+            failures.append(f'{name} が起動時に読み込まれています（使う関数の中で読み込んでください）')
+
+    if failures:
+        print('\nNG:')
+        for failure in failures:
+            print(f'  - {failure}')
+        return 1
+    print('\nOK')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,176 @@
+// AI応答をストリーミング（Server-Sent Events）で受け取る共通処理
+// prediction.html / reflection.html から利用する
+
+// 混雑時（429 / 503）は Retry-After の秒数だけ待って自動で再送する
+const BUSY_MAX_RETRIES = 5;
+// 同じターンの前の送信が処理中（409）の場合も、Retry-After の秒数ごとに送り直して応答を受け取る
+const IN_PROGRESS_MAX_RETRIES = 45;
+
+function showBusyNotice(seconds) {
+    const statusDiv = document.getElementById('apiStatus');
+    const messageSpan = document.getElementById('apiStatusMessage');
+    if (!statusDiv || !messageSpan) return;
+    statusDiv.style.display = 'block';
+    messageSpan.textContent = `ただいま混み合っています。${seconds}秒後に自動でもう一度送ります…`;
+}
+
+function hideBusyNotice() {
+    const statusDiv = document.getElementById('apiStatus');
+    if (statusDiv) statusDiv.style.display = 'none';
+}
+
+// fetch と同じ使い方で、混雑時の待機・再送を行う
+function fetchWithBackoff(url, options, onWait = showBusyNotice, attempt = 0) {
+    return fetch(url, options).then(response => {
+        const busy = response.status === 429 || response.status === 503;
+        const inProgress = response.status === 409;
+        if ((busy && attempt < BUSY_MAX_RETRIES) || (inProgress && attempt < IN_PROGRESS_MAX_RETRIES)) {
+            const retryAfter = parseFloat(response.headers.get('Retry-After'));
+            const baseSeconds = isNaN(retryAfter) ? Math.min(2 ** attempt, 10) : retryAfter;
+            // 同時に断られた児童が一斉に再送しないよう、待ち時間をばらつかせる
+            const waitSeconds = baseSeconds + Math.random() * Math.max(1, baseSeconds / 2);
+            if (busy) onWait(Math.ceil(waitSeconds), attempt + 1);
+            return new Promise(resolve => setTimeout(resolve, waitSeconds * 1000))
+                .then(() => fetchWithBackoff(url, options, onWait, attempt + 1));
+        }
+        if (attempt > 0) hideBusyNotice();
+        return response;
+    });
+}
+
+// streamUrl に POST し、受信した文字列を onDelta に渡す。
+// 最終的な応答（通常のJSONエンドポイントと同じ形式）で resolve する。
+// ストリームを読めないブラウザでは fallbackUrl の通常応答を使う。
+function fetchChatReply(streamUrl, fallbackUrl, requestData, onDelta) {
+    const options = {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify(requestData)
+    };
+
+    const canStream = window.ReadableStream && window.TextDecoder &&
+        typeof Response !== 'undefined' && 'body' in Response.prototype;
+
+    if (!canStream) {
+        return fetchWithBackoff(fallbackUrl, options).then(response => {
+            if (!response.ok) {
+                throw new Error(`HTTPエラー: ${response.status} ${response.statusText}`);
+            }
+            return response.json();
+        });
+    }
+
+    return fetchWithBackoff(streamUrl, options).then(response => {
+        if (!response.ok) {
+            throw new Error(`HTTPエラー: ${response.status} ${response.statusText}`);
+        }
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let result = null;
+
+        function handleEvent(rawEvent) {
+            let eventName = 'message';
+            let data = '';
+            rawEvent.split('\n').forEach(line => {
+                if (line.startsWith('event:')) {
+                    eventName = line.slice(6).trim();
+                } else if (line.startsWith('data:')) {
+                    data += line.slice(5).trim();
+                }
+            });
+            if (!data) return;
+
+            const payload = JSON.parse(data);
+            if (eventName === 'delta') {
+                onDelta(payload.text);
+            } else if (eventName === 'done' || eventName === 'error') {
+                result = payload;
+            }
+        }
+
+        function pump() {
+            return reader.read().then(({ done, value }) => {
+                if (value) {
+                    buffer += decoder.decode(value, { stream: true });
+                }
+                let separator;
+                while ((separator = buffer.indexOf('\n\n')) >= 0) {
+                    handleEvent(buffer.slice(0, separator));
+                    buffer = buffer.slice(separator + 2);
+                }
+                if (done) {
+                    if (!result) {
+                        throw new Error('応答が途中で切れました');
+                    }
+                    return result;
+                }
+                return pump();
+            });
+        }
+
+        return pump();
+    });
+}
+
+// 対話のターン番号
+// 新しい発言を送るたびに番号を進め、再試行では同じ番号で送り直す
+// サーバーは同じターンの再送・二重送信に対して、AIを呼び直さずに最初の応答を返す
+const chatClientId = (window.crypto && crypto.randomUUID)
+    ? crypto.randomUUID()
+    : `${Date.now()}-${Math.random().toString(16).slice(2)}`;
+let chatTurnSeq = 0;
+
+function nextChatTurn() {
+    chatTurnSeq += 1;
+    return { client_id: chatClientId, seq: chatTurnSeq };
+}
+
+function currentChatTurn() {
+    return { client_id: chatClientId, seq: chatTurnSeq };
+}
+
+// まとめ生成の冪等キー
+// 会話が変わるまでは同じキーを送り、再送・二重クリックではサーバーが生成済みの結果を返す
+let summaryRequestKey = null;
+
+function summaryIdempotencyKey() {
+    if (!summaryRequestKey) {
+        summaryRequestKey = (window.crypto && crypto.randomUUID)
+            ? crypto.randomUUID()
+            : `${Date.now()}-${Math.random().toString(16).slice(2)}`;
+    }
+    return summaryRequestKey;
+}
+
+function resetSummaryIdempotencyKey() {
+    summaryRequestKey = null;
+}
+
+// 混雑で代わりの問いかけが返ったとき、後から届いたAIの応答を受け取る
+// 児童が次の発言をした後はサーバーが応答を返さないので、そのまま終了する
+// サーバーは会話の代わりの問いかけを届いた応答で置き換えるので、画面でも置き換える（removeLastAIMessage）
+function pollLateReply(stage, onReply, delays = [5, 10, 20]) {
+    if (!delays.length) return;
+    setTimeout(() => {
+        fetch(`/chat/late_reply?stage=${stage}`)
+            .then(response => response.ok ? response.json() : { response: null })
+            .then(data => {
+                if (data.response) {
+                    onReply(data);
+                } else {
+                    pollLateReply(stage, onReply, delays.slice(1));
+                }
+            })
+            .catch(error => console.error('後からの応答の取得に失敗:', error));
+    }, delays[0] * 1000);
+}
+
+// 最後のAIの発言（代わりの問いかけ）を画面から取り除く
+function removeLastAIMessage() {
+    const aiMessages = document.querySelectorAll('#chatMessages .ai-message');
+    if (aiMessages.length) aiMessages[aiMessages.length - 1].remove();
+}